@@ -0,0 +1,152 @@
+import bisect
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List
+import numpy as np
+from api.index_generation import get_index_generation
+
+def prompt_version(system_prompt: str) -> str:
+    """Version of a prompt, answers generated with another prompt are never served"""
+    return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]
+
+class _ScopeEntries:
+    """The entries of one scope, their normalized embeddings are kept in one matrix to compare them in one go.
+
+    The matrix is preallocated and grown geometrically, and the oldest entries are evicted by moving the start of the live rows,
+    so adding an entry doesn't copy the matrix. The live rows are only moved when the matrix is full.
+    """
+
+    def __init__(self, dimensions: int, capacity: int = 16):
+        self._embeddings = np.empty((capacity, dimensions), dtype=np.float32)
+        self._expires_at: List[float] = []
+        self._values: List[Any] = []
+        self._start = 0
+
+    def __len__(self) -> int:
+        return len(self._values) - self._start
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self._embeddings[self._start:len(self._values)]
+
+    def value(self, index: int) -> Any:
+        return self._values[self._start + index]
+
+    def append(self, embedding: np.ndarray, expires_at: float, value: Any):
+        if len(self._values) == len(self._embeddings):
+            self._reallocate(max(16, 2 * (len(self) + 1)))
+        self._embeddings[len(self._values)] = embedding
+        self._expires_at.append(expires_at)
+        self._values.append(value)
+
+    def evict_oldest(self, count: int):
+        for index in range(self._start, self._start + count):
+            self._values[index] = None
+        self._start += count
+
+    def remove_expired(self, now: float):
+        #All entries of the cache have the same ttl, so the expired entries are the oldest
+        self.evict_oldest(bisect.bisect_right(self._expires_at, now, lo=self._start) - self._start)
+
+    def _reallocate(self, capacity: int):
+        """Move the live rows to the start of a matrix with the capacity"""
+        embeddings = np.empty((capacity, self._embeddings.shape[1]), dtype=np.float32)
+        embeddings[:len(self)] = self.embeddings
+        self._embeddings = embeddings
+        self._expires_at = self._expires_at[self._start:]
+        self._values = self._values[self._start:]
+        self._start = 0
+
+class SemanticAnswerCache:
+    """Cache of generated answers, matched on the cosine similarity of the embedding of the question.
+
+    Entries are scoped: only questions asked in the same scope (access context, prompt version, ...) can match.
+    Every scope keeps its own matrix of embeddings, the least recently used scopes are evicted beyond max_scopes.
+    Entries expire after their ttl and the cache is cleared as soon as an ingestion run has written to one of the indexes.
+    """
+
+    def __init__(self, index_names: List[str], max_size_per_scope: int, ttl_seconds: float, similarity_threshold: float, max_scopes: int = 16):
+        self.index_names = index_names
+        self.max_size_per_scope = max_size_per_scope
+        self.max_scopes = max_scopes
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._scopes: OrderedDict[Hashable, _ScopeEntries] = OrderedDict()
+        self._generation = get_index_generation(index_names)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size_per_scope > 0
+
+    def get(self, scope: Hashable, embedding: List[float]) -> Any:
+        """Return the value of the most similar question in the scope, or None when no question is similar enough"""
+        self._clear_if_stale()
+        query = _normalize(embedding)
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is not None:
+                entries.remove_expired(time.monotonic())
+                if not len(entries):
+                    del self._scopes[scope]
+            if entries is None or not len(entries):
+                self.misses += 1
+                return None
+            self._scopes.move_to_end(scope)
+            similarities = entries.embeddings @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entries.value(best)
+
+    def set(self, scope: Hashable, embedding: List[float], value: Any):
+        if not self.enabled:
+            return
+        normalized = _normalize(embedding)
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is None:
+                entries = self._scopes[scope] = _ScopeEntries(len(normalized))
+                #The least recently used scopes are evicted first
+                while len(self._scopes) > self.max_scopes:
+                    self._scopes.popitem(last=False)
+            else:
+                self._scopes.move_to_end(scope)
+            entries.append(normalized, time.monotonic() + self.ttl_seconds, value)
+            #The oldest entries are evicted first
+            if len(entries) > self.max_size_per_scope:
+                entries.evict_oldest(len(entries) - self.max_size_per_scope)
+
+    def clear(self):
+        with self._lock:
+            self._scopes.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "scopes": len(self._scopes),
+                "size": sum(len(entries) for entries in self._scopes.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _clear_if_stale(self):
+        generation = get_index_generation(self.index_names)
+        with self._lock:
+            if generation == self._generation:
+                return
+            self._generation = generation
+            self._scopes.clear()
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
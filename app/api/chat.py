@@ -1,32 +1,100 @@
-from typing import Any, Dict, List
+import asyncio
+import copy
+from typing import Any, AsyncIterator, Dict, List, Tuple
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import LLMResult
 import uuid
 from datetime import datetime
 from chat.chat_state import ChatState
+from chat.metrics import MetricsHandler
 from langchain_core.documents import Document
 import json
-from chat.conversational_rag_chain import create_conversational_rag_chain
+from chat.conversational_rag_chain import DEFAULT_SYSTEM_PROMPT, SESSION_HISTORY_CONFIG, get_cached_conversational_rag_chain, with_session_history
+from chat.backends import get_embedding_deployment
+from chat.cached_embeddings import get_cached_embeddings
 from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.runnables import Runnable, RunnableLambda
 from api.init_services import init_table_client
+from api.interaction_logger import get_interaction_log_writer
+from api.answer_cache import SemanticAnswerCache, prompt_version
 
-def chat(question: str, chat_history: BaseChatMessageHistory):
-    
-    chain=create_conversational_rag_chain(
-        get_session_history=lambda session_id: chat_history
+async def chat(question: str, chat_history: BaseChatMessageHistory, answer_cache: SemanticAnswerCache | None = None):
+    scope, embedding, cached_answer = await get_cached_answer(question, chat_history, answer_cache)
+    if cached_answer is not None:
+        return cached_answer
+
+    chain, state = await prepare_chain(question)
+
+    result = await chain.ainvoke(
+        {"input": question},
+        config={"configurable": {"session_history": chat_history},"callbacks": [CustomHandler(state), MetricsHandler("chat")]},
     )
+    if embedding is not None:
+        answer_cache.set(scope, embedding, copy.deepcopy({"answer": result["answer"], "context": result["context"]}))
+    return result
 
-    ChatState.question = question
-    ChatState.chain_id = str(uuid.uuid4())
+async def stream_chat(question: str, chat_history: BaseChatMessageHistory, answer_cache: SemanticAnswerCache | None = None) -> AsyncIterator[str]:
+    """Stream the chat as Server-Sent Events: a context event as soon as the documents are retrieved,
+    a token event per generated answer chunk and an end event with the full answer"""
+    scope, embedding, cached_answer = await get_cached_answer(question, chat_history, answer_cache)
+    if cached_answer is not None:
+        yield server_sent_event("context", [d.metadata for d in cached_answer["context"]])
+        yield server_sent_event("token", cached_answer["answer"])
+        yield server_sent_event("end", {"answer": cached_answer["answer"]})
+        return
 
-    return chain.invoke(
+    chain, state = await prepare_chain(question)
+
+    answer = ""
+    context = []
+    async for chunk in chain.astream(
         {"input": question},
-        config={"configurable": {"session_id": "abc-123"},"callbacks": [CustomHandler()]},
-    )   
+        config={"configurable": {"session_history": chat_history},"callbacks": [CustomHandler(state), MetricsHandler("chat_stream")]},
+    ):
+        if "context" in chunk:
+            context = chunk["context"]
+            yield server_sent_event("context", [d.metadata for d in chunk["context"]])
+        if "answer" in chunk:
+            answer += chunk["answer"]
+            yield server_sent_event("token", chunk["answer"])
+    if embedding is not None:
+        answer_cache.set(scope, embedding, copy.deepcopy({"answer": answer, "context": context}))
+    yield server_sent_event("end", {"answer": answer})
 
-def log_interaction(question: str, answer: str, prompt: str, documents: List[Document], chain_id: str):
-    table_client = init_table_client()
+async def get_cached_answer(question: str, chat_history: BaseChatMessageHistory, answer_cache: SemanticAnswerCache | None) -> Tuple[Any, List[float] | None, dict | None]:
+    """Look up the answer of a similar question, returns the scope and embedding to cache a new answer with.
+    Only questions without chat history are cached, they are standalone and their answer doesn't depend on the history.
+    A cached answer is added to the chat history like the chain adds a generated answer."""
+    if answer_cache is None or not answer_cache.enabled or chat_history.messages:
+        return None, None, None
+
+    deployment = get_embedding_deployment()
+    #The chat chain always runs with the default prompt for CIB members
+    scope = ("chat", "CIB-lid", prompt_version(DEFAULT_SYSTEM_PROMPT), deployment)
+    #The retriever of the chain embeds the same question, so it gets this embedding from the embedding cache
+    embedding = await get_cached_embeddings(deployment).aembed_query(question)
+    cached_answer = answer_cache.get(scope, embedding)
+    if cached_answer is None:
+        return scope, embedding, None
 
+    cached_answer = copy.deepcopy(cached_answer)
+    cached_chain = with_session_history(RunnableLambda(lambda inputs: {**inputs, **cached_answer}), lambda session_history: session_history, SESSION_HISTORY_CONFIG)
+    result = await cached_chain.ainvoke({"input": question}, config={"configurable": {"session_history": chat_history}})
+    log_interaction(question, cached_answer["answer"], "", cached_answer["context"], str(uuid.uuid4()))
+    return scope, embedding, result
+
+async def prepare_chain(question: str) -> Tuple[Runnable, ChatState]:
+    #The chain is only built on the first request, that sets up the vector stores which does blocking calls to Azure Search
+    chain=await asyncio.to_thread(get_cached_conversational_rag_chain)
+
+    #The state is bound to the context of this request, the retriever and the callbacks of the chain run in a copy of it
+    state = ChatState.start(question, str(uuid.uuid4()))
+    return chain, state
+
+def server_sent_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def log_interaction(question: str, answer: str, prompt: str, documents: List[Document], chain_id: str):
     serializable_documents = []
     for d in documents:
         serializable_documents.append({"page_content": d.page_content, "metadata": d.metadata})
@@ -41,14 +109,18 @@ def log_interaction(question: str, answer: str, prompt: str, documents: List[Doc
             "Timestamp": datetime.now().isoformat(),
             "ChainId": chain_id
         }
-    table_client.create_entity(entity=log_entry)
+    #Written to Table Storage by a background thread, so the request doesn't wait for it
+    get_interaction_log_writer(init_table_client).submit(log_entry)
 
 class CustomHandler(BaseCallbackHandler):
+    def __init__(self, state: ChatState):
+        self.state = state
+
     def on_llm_start(
         self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
     ) -> Any:
-        ChatState.prompt = "\n".join(prompts)
+        self.state.prompt = "\n".join(prompts)
     
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> Any:
-        ChatState.answer = response.generations[0][0].text
-        log_interaction(ChatState.question, ChatState.answer, ChatState.prompt, ChatState.documents, ChatState.chain_id)
\ No newline at end of file
+        self.state.answer = response.generations[0][0].text
+        log_interaction(self.state.question, self.state.answer, self.state.prompt, self.state.documents, self.state.chain_id)
\ No newline at end of file
@@ -0,0 +1,11 @@
+import asyncio
+from typing import Any, Awaitable, Dict
+
+async def fan_out(calls: Dict[str, Awaitable[Any]]) -> Dict[str, Any]:
+    """Await all calls concurrently and return their results by key.
+
+    The total latency is bounded by the slowest call instead of the sum of all calls.
+    If a call raises, the exception is re-raised in the caller.
+    """
+    results = await asyncio.gather(*calls.values())
+    return dict(zip(calls.keys(), results))
@@ -0,0 +1,38 @@
+import logging
+import os
+import time
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Ingestion scripts and the API run in separate processes, often on other hosts, they share the index generations through marker files.
+# INDEX_GENERATION_DIR has to be a directory all of them can reach (like a mounted file share), without it the API never sees an ingestion run.
+INDEX_GENERATION_DIR = os.getenv("INDEX_GENERATION_DIR") or None
+
+def index_generations_shared() -> bool:
+    """Whether the ingestion runs can mark the indexes as changed, the caches of the indexes can only be invalidated when they can"""
+    return INDEX_GENERATION_DIR is not None
+
+def _marker_path(index_name: str) -> str:
+    return os.path.join(INDEX_GENERATION_DIR, f"{index_name}.generation")
+
+def bump_index_generation(index_name: str):
+    """Mark that documents were written to the index, so everything cached for it becomes stale"""
+    if not index_generations_shared():
+        logger.warning("INDEX_GENERATION_DIR is not set, the caches of %s are not invalidated", index_name)
+        return
+    os.makedirs(INDEX_GENERATION_DIR, exist_ok=True)
+    with open(_marker_path(index_name), "w") as marker:
+        marker.write(str(time.time_ns()))
+
+def get_index_generation(index_names: List[str]) -> Tuple[int, ...]:
+    """Return the generation of every index, it changes whenever an ingestion run writes to the index"""
+    if not index_generations_shared():
+        return tuple(0 for _ in index_names)
+    generation = []
+    for index_name in index_names:
+        try:
+            generation.append(os.stat(_marker_path(index_name)).st_mtime_ns)
+        except FileNotFoundError:
+            generation.append(0)
+    return tuple(generation)
@@ -1,26 +1,33 @@
 import os
-from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_community.retrievers import AzureAISearchRetriever
 from langchain_core.retrievers import BaseRetriever
-from app.chat.CustomAzureSearchVectorStoreRetriever import CustomAzureSearchVectorStoreRetriever
+from chat.CustomAzureSearchVectorStoreRetriever import CustomAzureSearchVectorStoreRetriever
 from langchain_community.vectorstores.azuresearch import AzureSearch
-from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
-from azure.data.tables import TableServiceClient
-from azure.core.credentials import AzureNamedKeyCredential
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from api.service_pool import service_pool
+from chat.backends import create_async_search_client, create_azure_search, create_chat_model, create_search_client, create_table_client, get_backend, get_embedding_deployment
+from chat.cached_embeddings import CachedEmbeddings, get_cached_embeddings
+from chat.local_vector_store import LocalVectorStore, get_local_vector_store
 
 
-def init_vector_store(index_name: str) -> AzureSearch:
-    embeddings = AzureOpenAIEmbeddings(
-        azure_deployment="orisai-text-embedding-3-large-development",
-    )
+EMBEDDING_DEPLOYMENT = get_embedding_deployment()
 
-    return AzureSearch(
-        azure_search_endpoint=str(os.getenv("AZURE_SEARCH_BASE_URL")),
-        azure_search_key=str(os.getenv("AZURE_SEARCH_KEY")),
-        index_name=index_name,
-        embedding_function=embeddings.embed_query
-    )
+def init_embeddings(deployment: str = EMBEDDING_DEPLOYMENT) -> CachedEmbeddings:
+    return service_pool.get("embeddings", "", deployment, lambda: get_cached_embeddings(deployment))
+
+def init_vector_store(index_name: str, deployment: str = EMBEDDING_DEPLOYMENT) -> AzureSearch | LocalVectorStore:
+    local_vector_store = init_local_vector_store(index_name, deployment)
+    if local_vector_store is not None:
+        return local_vector_store
+
+    return service_pool.get("vector_store", index_name, deployment, lambda: create_azure_search(index_name, init_embeddings(deployment).embed_query))
+
+def init_local_vector_store(index_name: str, deployment: str = EMBEDDING_DEPLOYMENT) -> LocalVectorStore | None:
+    """The local copy of the index when LOCAL_VECTOR_INDEX_DIR holds one, searches in it don't leave the process.
+    With the local search backend, it is the only copy of the index."""
+    return get_local_vector_store(index_name, deployment, create_if_missing=get_backend("search") == "local")
 
 def init_retriever(k) -> BaseRetriever:
     index_name=str(os.getenv("AZURE_SEARCH_INDEX_NAME"))
@@ -31,31 +38,41 @@ def init_retriever(k) -> BaseRetriever:
         content_key="content", index_name=index_name, service_name="orisai-search-development", api_key=AZURE_SEARCH_KEY, top_k=k
     )
 
-def init_llm() -> AzureChatOpenAI:    
-    return AzureChatOpenAI(
-        openai_api_version=str(os.getenv("AZURE_OPENAI_API_VERSION")),
-        azure_deployment=str(os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME")),
-    )
+def init_llm() -> BaseChatModel:
+    return create_chat_model()
 
 def init_custom_retriever(k: int, filters: str | None, score_threshold: float, search_type: str = "similarity_score_threshold") -> BaseRetriever:
-    vector_store = init_vector_store()
+    index_name = str(os.getenv("AZURE_SEARCH_INDEX_NAME"))
+    vector_store = init_vector_store(index_name)
     return CustomAzureSearchVectorStoreRetriever(
         vectorstore=vector_store, 
         k=k, 
         filters=filters, 
         tags=vector_store._get_retriever_tags(),
         search_type=search_type,
-        score_threshold=score_threshold
+        score_threshold=score_threshold,
+        async_client=init_async_search_client(index_name) if isinstance(vector_store, AzureSearch) else None,
+        embeddings=init_embeddings(),
+        metadata={"index_name": index_name}
     )
 
-def init_search_client(index_name:str):
-    service_endpoint = str(os.getenv("AZURE_SEARCH_BASE_URL"))
-    key = str(os.getenv("AZURE_SEARCH_KEY"))
-    return SearchClient(service_endpoint, index_name, AzureKeyCredential(key))
+def init_search_client(index_name:str) -> SearchClient:
+    return service_pool.get("search_client", index_name, "", lambda: create_search_client(index_name, EMBEDDING_DEPLOYMENT))
+
+def init_async_search_client(index_name: str) -> AsyncSearchClient:
+    return service_pool.get("async_search_client", index_name, "", lambda: create_async_search_client(index_name, EMBEDDING_DEPLOYMENT))
+
+def warm_up_services():
+    """Create the pooled clients for all search indexes, so the first requests don't pay for it"""
+    for index_name in [str(os.getenv("AZURE_SEARCH_INDEX_NAME")), str(os.getenv("AZURE_SEARCH_MODELDOCS_INDEX_NAME"))]:
+        init_search_client(index_name)
+        init_async_search_client(index_name)
+        init_vector_store(index_name)
+
+async def close_async_services():
+    """Close the connections of the pooled async clients, they are bound to the event loop of the app"""
+    for client in service_pool.entries("async_search_client"):
+        await client.close()
 
 def init_table_client(): 
-    credential = AzureNamedKeyCredential(str(os.getenv("AZURE_STORAGE_NAME")), str(os.getenv("AZURE_TABLES_KEY")))
-    table_service_client = TableServiceClient(
-        endpoint=str(os.getenv("AZURE_TABLES_URL")), credential=credential
-    )
-    return table_service_client.get_table_client(table_name=str(os.getenv("AZURE_TABLES_CHAT_LOGGING_NAME")))
\ No newline at end of file
+    return create_table_client(str(os.getenv("AZURE_TABLES_CHAT_LOGGING_NAME")))
\ No newline at end of file
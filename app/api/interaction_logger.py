@@ -0,0 +1,160 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from itertools import groupby
+from typing import Callable, Iterator, List
+from azure.data.tables import TableClient
+
+logger = logging.getLogger(__name__)
+
+# Azure Table Storage accepts at most 100 operations and 4 MiB of payload per transaction
+MAX_TRANSACTION_SIZE = 100
+MAX_TRANSACTION_BYTES = 4 * 1024 * 1024
+# The headers of every operation in the multipart body of the transaction, on top of the json of the entity
+OPERATION_OVERHEAD_BYTES = 1024
+
+class InteractionLogWriter:
+    """Writes log entries to Table Storage from a background thread, so logging never blocks a request.
+
+    Entries are queued in a bounded queue and flushed in batched transactions per PartitionKey.
+    When the queue is full or a transaction fails, entries are appended to the spill file if one is configured and dropped otherwise.
+    """
+
+    def __init__(self, get_table_client: Callable[[], TableClient], max_queue_size: int = 1000, flush_interval_seconds: float = 2.0, spill_path: str | None = None):
+        self.get_table_client = get_table_client
+        self.flush_interval_seconds = flush_interval_seconds
+        self.spill_path = spill_path
+        self.written = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue: queue.Queue[dict] = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._table_client: TableClient | None = None
+
+    def submit(self, entry: dict):
+        """Queue the entry without blocking"""
+        self.start()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self._spill_or_drop(entry)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="interaction-log-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Stop the background thread after it has flushed all queued entries"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._stopping.set()
+            thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def _run(self):
+        while not self._stopping.is_set():
+            entries = self._take_batch(block=True)
+            if entries:
+                self._write(entries)
+        # Flush whatever is still queued on shutdown
+        while True:
+            entries = self._take_batch(block=False)
+            if not entries:
+                return
+            self._write(entries)
+
+    def _take_batch(self, block: bool) -> List[dict]:
+        entries = []
+        try:
+            if block:
+                entries.append(self._queue.get(timeout=self.flush_interval_seconds))
+            while len(entries) < self._queue.maxsize:
+                entries.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return entries
+
+    def _write(self, entries: List[dict]):
+        entries = sorted(entries, key=lambda entry: entry["PartitionKey"])
+        for _, partition_entries in groupby(entries, key=lambda entry: entry["PartitionKey"]):
+            for batch in _transaction_batches(list(partition_entries)):
+                try:
+                    if self._table_client is None:
+                        self._table_client = self.get_table_client()
+                    self._table_client.submit_transaction([("create", entry) for entry in batch])
+                    self.written += len(batch)
+                except Exception:
+                    logger.exception("Writing %d interaction log entries failed", len(batch))
+                    self.failed += len(batch)
+                    #The entries of the failed transaction are kept in the spill file, when there is one
+                    for entry in batch:
+                        self._spill_or_drop(entry)
+
+    def _spill_or_drop(self, entry: dict):
+        with self._lock:
+            if self.spill_path is None:
+                self.dropped += 1
+                return
+            with open(self.spill_path, "a", encoding="utf-8") as spill_file:
+                spill_file.write(json.dumps(entry) + "\n")
+            self.spilled += 1
+
+
+def _transaction_batches(entries: List[dict]) -> Iterator[List[dict]]:
+    """Split the entries of one partition in batches that fit in a transaction, both in number of operations and in size"""
+    batch = []
+    batch_bytes = 0
+    for entry in entries:
+        entry_bytes = len(json.dumps(entry).encode("utf-8")) + OPERATION_OVERHEAD_BYTES
+        if batch and (len(batch) == MAX_TRANSACTION_SIZE or batch_bytes + entry_bytes > MAX_TRANSACTION_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(entry)
+        batch_bytes += entry_bytes
+    if batch:
+        yield batch
+
+
+_writer: InteractionLogWriter | None = None
+_writer_lock = threading.Lock()
+
+def get_interaction_log_writer(get_table_client: Callable[[], TableClient]) -> InteractionLogWriter:
+    """Return the process-wide writer, it is stopped (and flushed) when the process exits"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = InteractionLogWriter(
+                get_table_client,
+                max_queue_size=int(os.getenv("CHAT_LOG_QUEUE_SIZE", "1000")),
+                flush_interval_seconds=float(os.getenv("CHAT_LOG_FLUSH_INTERVAL_SECONDS", "2")),
+                spill_path=os.getenv("CHAT_LOG_SPILL_PATH") or None,
+            )
+            atexit.register(_writer.stop)
+        return _writer
+
+def stop_interaction_log_writer():
+    if _writer is not None:
+        _writer.stop()
+
+def get_interaction_log_stats() -> dict:
+    return _writer.stats() if _writer is not None else {}
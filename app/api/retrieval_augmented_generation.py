@@ -1,7 +1,15 @@
-from app.api.init_services import init_custom_retriever, init_llm
+import copy
+from typing import List
+from api.init_services import EMBEDDING_DEPLOYMENT, init_custom_retriever, init_embeddings, init_llm
+from api.answer_cache import SemanticAnswerCache, prompt_version
+from chat.context_compressor import ExtractiveCompressor, create_compressor
+from chat.context_packer import ContextPacker, create_context_packer
+from chat.metrics import MetricsHandler
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable, RunnableLambda, RunnablePassthrough
 
 
 def get_filter_for_context(context):
@@ -10,8 +18,19 @@ def get_filter_for_context(context):
     else:
         return "is_public eq 'True'"
 
-def retrieval_augmented_generation(question: str, top_k: int, score_threshold: float, system_prompt: str, context: str, include_page_content: bool):
+async def retrieval_augmented_generation(question: str, top_k: int, score_threshold: float, system_prompt: str, context: str, include_page_content: bool, answer_cache: SemanticAnswerCache | None = None):
     filters = get_filter_for_context(context)
+
+    #Only answers generated for the same access filter, prompt and retrieval settings are reused
+    scope = ("retrieval_augmented_generation", filters, prompt_version(system_prompt), top_k, score_threshold, EMBEDDING_DEPLOYMENT)
+    embedding = None
+    if answer_cache is not None and answer_cache.enabled:
+        #The retriever embeds the same question, so it gets this embedding from the embedding cache
+        embedding = await init_embeddings().aembed_query(question)
+        cached_answer = answer_cache.get(scope, embedding)
+        if cached_answer is not None:
+            return prepare_result({"input": question, **copy.deepcopy(cached_answer)}, include_page_content)
+
     retriever = init_custom_retriever(top_k, filters, score_threshold)
     llm = init_llm()
 
@@ -25,12 +44,29 @@ def retrieval_augmented_generation(question: str, top_k: int, score_threshold: f
             ("human", "{input}"),
         ]
     )
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
+    #The prompt gets the compressed and packed documents, the response the documents as they were retrieved
+    question_answer_chain = with_prompt_documents(create_compressor(init_embeddings()), create_context_packer()) | create_stuff_documents_chain(llm, qa_prompt)
 
     rag_chain = create_retrieval_chain(retriever, question_answer_chain)
 
-    result = rag_chain.invoke({"input": question})
+    result = await rag_chain.ainvoke({"input": question}, config={"callbacks": [MetricsHandler("retrieval_augmented_generation")]})
+
+    if embedding is not None:
+        answer_cache.set(scope, embedding, copy.deepcopy({"answer": result["answer"], "context": result["context"]}))
+
+    return prepare_result(result, include_page_content)
+
+def with_prompt_documents(compressor: ExtractiveCompressor | None, packer: ContextPacker | None) -> Runnable:
+    """Replace the context with the documents as they are put in the prompt: the long documents compressed to their best sentences and all of them packed in the token budget"""
+    async def prompt_documents(inputs: dict) -> List[Document]:
+        documents = inputs["context"]
+        if compressor is not None:
+            documents = await compressor.acompress_documents(documents, inputs["input"])
+        return packer.pack(list(documents)) if packer is not None else list(documents)
+
+    return RunnablePassthrough.assign(context=RunnableLambda(prompt_documents).with_config(run_name="prompt_documents", metadata={"stage": "compress"}))
 
+def prepare_result(result: dict, include_page_content: bool) -> dict:
     if not include_page_content:
         for d in result["context"]:
             d.page_content = ""
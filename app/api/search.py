@@ -1,13 +1,17 @@
+from __future__ import annotations
+import heapq
 import os
-from typing import Dict, List, Literal, Tuple
-from app.api.filters import SearchFilters, SortOrder, SortField
-from app.api.init_services import init_search_client, init_vector_store
+from typing import Any, Callable, Dict, List, Literal, Tuple
+from api.filters import SearchFilters, SortOrder, SortField
+from api.init_services import init_async_search_client, init_embeddings, init_local_vector_store
 from langchain_core.documents import Document
 from langchain_core.utils import get_from_env
 import json
 from azure.search.documents import SearchItemPaged
-from azure.search.documents import SearchClient
-from multiprocessing import Process
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from azure.search.documents.models import VectorizedQuery
+from api.fan_out import fan_out
+from chat.local_vector_store import LocalVectorStore
 
 class SearchResultItem():
     document: Document
@@ -22,80 +26,82 @@ class SearchResultItem():
 class SearchResult():
     results: List[SearchResultItem]
     count: int
+    count_is_approximate: bool
 
-    def __init__(self, results: List[SearchResultItem], count: int):
+    def __init__(self, results: List[SearchResultItem], count: int, count_is_approximate: bool = False):
         self.results = results
         self.count = count
+        self.count_is_approximate = count_is_approximate
 
 
-def search(
+async def search(
         search_query: str, 
         addVectors: bool, 
         type: Literal['hybrid_search','similarity_search', 'vector_search', 'simple_text'], 
         order_by_date: bool,
         filters: SearchFilters,
         top: int,
-        skip: int) -> SearchResult:
-    cib_client = init_search_client(str(os.getenv("AZURE_SEARCH_INDEX_NAME")))
-    model_docs_client = init_search_client(str(os.getenv("AZURE_SEARCH_MODELDOCS_INDEX_NAME")))
-
-    coman_vector_store = init_vector_store(str(os.getenv("AZURE_SEARCH_INDEX_NAME")))
-    modeldocs_vector_store = init_vector_store(str(os.getenv("AZURE_SEARCH_MODELDOCS_INDEX_NAME")))
+        skip: int,
+        fields: List[str] | None = None) -> SearchResult:
+    coman_index_name = str(os.getenv("AZURE_SEARCH_INDEX_NAME"))
+    modeldocs_index_name = str(os.getenv("AZURE_SEARCH_MODELDOCS_INDEX_NAME"))
 
     filter=get_filter(filters)
     searchResult = SearchResult(count=0, results=[])
 
-    if type == 'hybrid_search':
-        searchResult.documents = coman_vector_store.hybrid_search(search_query, top)
-        searchResult.documents.extend(modeldocs_vector_store.hybrid_search(search_query, top))
-    elif type == 'similarity_search':
-        searchResult.documents = coman_vector_store.similarity_search(search_query, top)
-        extra_docs = modeldocs_vector_store.similarity_search(search_query, top)
-        searchResult.documents.extend(extra_docs)
-    elif type == 'vector_search':
-        searchResult.documents = coman_vector_store.vector_search(search_query, top)
-    elif type == 'simple_text':
-        cib_results = SearchResult(results=[], count=0)
-        model_docs_results = SearchResult(results=[], count=0)
-        fns = []
+    #Every index is queried concurrently, results are merged in the order of the indexes
+    calls = {}
+    if type == 'simple_text':
+        sort_field, sort_order = get_sorting(filters, order_by_date)
+        order_by = f"{'search.score()' if sort_field == SortField.SCORE else 'date'} {sort_order.value}"
+        #Every index has to deliver at least skip+top results for the merged page to be correct
+        page_size = min(skip + top, MAX_PAGE_SIZE)
+        #The source is needed to deduplicate the merged results and the date to sort them
+        select = get_select(fields, addVectors, required_fields=['source', 'date'])
+        search_kwargs = dict(search_text=search_query, order_by=order_by, query_type="simple", highlight_fields="content", highlight_pre_tag='<b>', highlight_post_tag='</b>', select=select)
         if (filter is None or filter == '' or 'Modeldocumenten' in filter):
-            fns.append(simple_search(model_docs_results, model_docs_client, search_text=search_query, order_by='date' if order_by_date else None, filter=None, top=100, skip=0, query_type="simple", highlight_fields="content", highlight_pre_tag='<b>', highlight_post_tag='</b>', include_total_count=True))
+            calls[modeldocs_index_name] = IndexResultStream(init_async_search_client(modeldocs_index_name), page_size, filter=None, **search_kwargs).fetch_first_page()
         
         if (filter is None or filter == '' or (filter != '' and filter != 'type eq \'Modeldocumenten\'')):
-            fns.append(simple_search(cib_results, cib_client, search_text=search_query, order_by='date' if order_by_date else None, filter=filter, top=100, skip=0, query_type="simple", highlight_fields="content", highlight_pre_tag='<b>', highlight_post_tag='</b>', include_total_count=True))
+            calls[coman_index_name] = IndexResultStream(init_async_search_client(coman_index_name), page_size, filter=filter, **search_kwargs).fetch_first_page()
+    else:
+        select = get_select(fields, addVectors)
+        #The query is embedded once, for the searches in all indexes
+        embedding = await init_embeddings().aembed_query(search_query)
+        #Every index has to deliver skip+top results for the merged page to be correct
+        page_size = min(skip + top, MAX_PAGE_SIZE)
+        calls[coman_index_name] = index_vector_search(coman_index_name, type, search_query, embedding, page_size, select)
+        calls[modeldocs_index_name] = index_vector_search(modeldocs_index_name, type, search_query, embedding, page_size, select)
 
-        runInParallel(*fns)
-        cib_results.results.extend(model_docs_results.results)
+    results_per_index = await fan_out(calls)
 
-        single_results = []
-        
-        for result in cib_results.results:
-            if (any(res.document.metadata['source'] == result.document.metadata['source'] for res in single_results)):
-                continue
-            single_results.append(result)
-        searchResult.count = len(single_results)
-        searchResult.results = sorted(single_results, key=lambda x: x.score if (filters.sortingFilter.field.value == SortField.SCORE.value) else x.document.metadata['date'], reverse=(filters.sortingFilter.order.value == SortOrder.DESC.value))
-        searchResult.results = searchResult.results[skip:top+skip]
-        
-    if not addVectors and type != 'simple_text':
-        for d in searchResult.documents:
-            d.metadata['content_vector']=[]
-    return searchResult
+    if type == 'simple_text':
+        streams = [results_per_index[index_name] for index_name in [coman_index_name, modeldocs_index_name] if index_name in results_per_index]
+        searchResult = await merge_results(
+            streams,
+            key=lambda x: x.score if sort_field == SortField.SCORE else x.document.metadata.get('date') or '',
+            reverse=sort_order == SortOrder.DESC,
+            skip=skip,
+            top=top
+        )
+    else:
+        #The scores of the same search type are comparable over the indexes, ties keep the order of the indexes
+        results = [result for index_name in [coman_index_name, modeldocs_index_name] for result in results_per_index[index_name].results]
+        searchResult.results = sorted(results, key=lambda x: x.score, reverse=True)[skip:skip + top]
+        searchResult.count = len(searchResult.results)
 
-def runInParallel(*fns):
-  proc = []
-  for fn in fns:
-    p = Process(target=fn)
-    p.start()
-    proc.append(p)
-  for p in proc:
-    p.join()
+    if fields is not None:
+        #The fields needed to merge the results are selected too, but only the requested fields are returned
+        returned_fields = set(fields) | ({FIELDS_CONTENT_VECTOR} if addVectors else set())
+        for result in searchResult.results:
+            result.document.metadata = {key: value for key, value in result.document.metadata.items() if key in returned_fields}
+    return searchResult
 
 
-def simple_search(result: SearchResult, client: SearchClient, search_text, order_by, filter, top, skip, query_type, highlight_fields, highlight_pre_tag, highlight_post_tag, include_total_count):
-    results = client.search(search_text=search_text, order_by=order_by, filter=filter, top=top, skip=skip, query_type=query_type, highlight_fields=highlight_fields, highlight_pre_tag=highlight_pre_tag, highlight_post_tag=highlight_post_tag, include_total_count=include_total_count)
-    result.count = results.get_count()
-    for r in results:
+async def simple_search(client: AsyncSearchClient, search_text, order_by, filter, top, skip, query_type, highlight_fields, highlight_pre_tag, highlight_post_tag, include_total_count, select=None) -> SearchResult:
+    results = await client.search(search_text=search_text, order_by=order_by, filter=filter, top=top, skip=skip, query_type=query_type, highlight_fields=highlight_fields, highlight_pre_tag=highlight_pre_tag, highlight_post_tag=highlight_post_tag, include_total_count=include_total_count, select=select)
+    result = SearchResult(count=await results.get_count(), results=[])
+    async for r in results:
         result.results.append(
             SearchResultItem(
                 document=_result_to_document(r), 
@@ -103,6 +109,151 @@ def simple_search(result: SearchResult, client: SearchClient, search_text, order
                 score=r['@search.score']
             )
         )
+    return result
+
+#Azure AI Search returns at most 1000 results per request
+MAX_PAGE_SIZE = 1000
+
+class IndexResultStream():
+    """The sorted results of one index, fetched lazily page by page with order_by, skip and top pushed down to the index"""
+    def __init__(self, client: AsyncSearchClient, page_size: int, **search_kwargs):
+        self.client = client
+        self.page_size = page_size
+        self.search_kwargs = search_kwargs
+        self.count = 0
+        self._page: List[SearchResultItem] = []
+        self._position = 0
+        self._skip = 0
+        self._exhausted = False
+
+    async def fetch_first_page(self) -> IndexResultStream:
+        await self._fetch_page(include_total_count=True)
+        return self
+
+    async def _fetch_page(self, include_total_count: bool = False):
+        page = await simple_search(self.client, top=self.page_size, skip=self._skip, include_total_count=include_total_count, **self.search_kwargs)
+        if include_total_count:
+            self.count = page.count or 0
+        self._page = page.results
+        self._position = 0
+        self._skip += len(page.results)
+        self._exhausted = len(page.results) < self.page_size
+
+    async def next(self) -> SearchResultItem | None:
+        """Return the next result of the index, or None when all results were read"""
+        if self._position >= len(self._page):
+            if self._exhausted:
+                return None
+            await self._fetch_page()
+            if not self._page:
+                return None
+        result = self._page[self._position]
+        self._position += 1
+        return result
+
+class _MergeEntry():
+    """Heap entry of the k-way merge, ordering on the sort key and then on the stream it came from"""
+    __slots__ = ("key", "stream_index", "result", "reverse")
+
+    def __init__(self, key: Any, stream_index: int, result: SearchResultItem, reverse: bool):
+        self.key = key
+        self.stream_index = stream_index
+        self.result = result
+        self.reverse = reverse
+
+    def __lt__(self, other: _MergeEntry) -> bool:
+        if self.key == other.key:
+            return self.stream_index < other.stream_index
+        return self.key > other.key if self.reverse else self.key < other.key
+
+async def merge_results(streams: List[IndexResultStream], key: Callable[[SearchResultItem], Any], reverse: bool, skip: int, top: int) -> SearchResult:
+    """K-way merge of the sorted streams, only keeping the first result per source.
+    The streams are only read as far as needed to fill the requested page.
+
+    The count is the number of sources, like the results. It is exact when all results were read,
+    otherwise the hit count of the indexes is scaled with the share of unique sources in the results read so far."""
+    heap = []
+    for stream_index, stream in enumerate(streams):
+        result = await stream.next()
+        if result is not None:
+            heap.append(_MergeEntry(key(result), stream_index, result, reverse))
+    heapq.heapify(heap)
+
+    sources = set()
+    results = []
+    read = 0
+    while heap and len(results) < skip + top:
+        entry = heapq.heappop(heap)
+        read += 1
+        next_result = await streams[entry.stream_index].next()
+        if next_result is not None:
+            heapq.heappush(heap, _MergeEntry(key(next_result), entry.stream_index, next_result, reverse))
+
+        source = entry.result.document.metadata['source']
+        if source in sources:
+            continue
+        sources.add(source)
+        results.append(entry.result)
+
+    if not heap:
+        return SearchResult(results=results[skip:], count=len(sources))
+    hits = sum(stream.count for stream in streams)
+    #The heap still holds results, so there is at least one more source than were read
+    return SearchResult(results=results[skip:], count=max(round(hits * len(sources) / read) if read else hits, len(sources) + 1), count_is_approximate=True)
+
+def get_sorting(filters: SearchFilters | None, order_by_date: bool) -> Tuple[SortField, SortOrder]:
+    if filters is not None and filters.sortingFilter is not None:
+        #The filters can come from api.filters (like in main.py) or app.api.filters, their enums are different classes
+        return SortField(filters.sortingFilter.field.value), SortOrder(filters.sortingFilter.order.value)
+    return (SortField.DATE if order_by_date else SortField.SCORE), SortOrder.DESC
+
+def get_select(fields: List[str] | None, addVectors: bool, required_fields: List[str] = []) -> List[str]:
+    """The index fields to return, so vectors and unrequested metadata are never sent over the wire.
+    Without fields, the metadata is read from the metadata field, which holds all of it as json."""
+    if fields is None:
+        select = [FIELDS_CONTENT, FIELDS_METADATA]
+    else:
+        select = list(dict.fromkeys([FIELDS_CONTENT] + required_fields + fields))
+    if addVectors:
+        select.append(FIELDS_CONTENT_VECTOR)
+    return select
+
+async def index_vector_search(index_name: str, type: Literal['hybrid_search','similarity_search', 'vector_search'], search_query: str, embedding: List[float], top: int, select: List[str]) -> SearchResult:
+    """Search the local copy of the index when there is one, otherwise the index in Azure Search"""
+    local_vector_store = init_local_vector_store(index_name)
+    if local_vector_store is not None:
+        return await local_vector_store_search(local_vector_store, type, search_query, embedding, top, select)
+    return await vector_store_search(init_async_search_client(index_name), type, search_query, embedding, top, select)
+
+async def local_vector_store_search(vector_store: LocalVectorStore, type: Literal['hybrid_search','similarity_search', 'vector_search'], search_query: str, embedding: List[float], top: int, select: List[str]) -> SearchResult:
+    """The in-memory equivalent of vector_store_search, the metadata is limited to the selected fields.
+    The local copy holds no exact vectors, so they are never returned."""
+    if type == 'vector_search':
+        results = vector_store.vector_search_with_score_by_vector(embedding, top)
+    else:
+        results = vector_store.hybrid_search_with_score_by_vector(search_query, embedding, top)
+    searchResult = SearchResult(count=0, results=[])
+    for document, score in results:
+        if FIELDS_METADATA not in select:
+            document.metadata = {key: value for key, value in document.metadata.items() if key in select}
+        searchResult.results.append(SearchResultItem(document=document, highlights=dict(), score=score))
+    searchResult.count = len(searchResult.results)
+    return searchResult
+
+async def vector_store_search(client: AsyncSearchClient, type: Literal['hybrid_search','similarity_search', 'vector_search'], search_query: str, embedding: List[float], top: int, select: List[str] | None = None) -> SearchResult:
+    """Vector or hybrid search in one index with the embedding of the search query, the async equivalent of AzureSearch.vector_search_with_score and AzureSearch.hybrid_search_with_score.
+    AzureSearch.similarity_search performs a hybrid search with the default search_type of the vector store."""
+    results = await client.search(
+        search_text="" if type == 'vector_search' else search_query,
+        vector_queries=[VectorizedQuery(vector=embedding, k_nearest_neighbors=top, fields=FIELDS_CONTENT_VECTOR)],
+        top=top,
+        select=select,
+    )
+    searchResult = SearchResult(count=0, results=[])
+    async for r in results:
+        searchResult.results.append(SearchResultItem(document=_result_to_document(r), highlights=dict(), score=float(r['@search.score'])))
+    searchResult.count = len(searchResult.results)
+    return searchResult
 
 #Gekopieerd uit AzureSearch.py package (via bvb hybrid_search naartoe gegaan)
 
@@ -131,7 +282,7 @@ def _results_to_documents(
     return docs
 
 def _result_to_document(result: Dict) -> Document:
-    return Document(
+    document = Document(
         page_content=result.pop(FIELDS_CONTENT),
         metadata=json.loads(result[FIELDS_METADATA])
         if FIELDS_METADATA in result
@@ -139,6 +290,10 @@ def _result_to_document(result: Dict) -> Document:
             key: value for key, value in result.items() if key != FIELDS_CONTENT_VECTOR
         },
     )
+    #The vector is only returned when it was selected
+    if result.get(FIELDS_CONTENT_VECTOR) is not None:
+        document.metadata[FIELDS_CONTENT_VECTOR] = result[FIELDS_CONTENT_VECTOR]
+    return document
 
 
 def get_filter(filters: SearchFilters) -> str:
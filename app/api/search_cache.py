@@ -0,0 +1,46 @@
+import json
+import re
+import threading
+from typing import Any, List, Tuple
+from pydantic import BaseModel
+from api.index_generation import get_index_generation
+from api.ttl_cache import TTLCache
+
+class SearchResponseCache:
+    """LRU/TTL cache of /api/search responses, keyed on the normalized search request.
+
+    The cache is cleared as soon as an ingestion run has written to one of the indexes.
+    """
+
+    def __init__(self, index_names: List[str], max_size: int, ttl_seconds: float):
+        self.index_names = index_names
+        self._entries = TTLCache(max_size, ttl_seconds)
+        self._lock = threading.Lock()
+        self._generation = get_index_generation(index_names)
+
+    def get(self, request: BaseModel) -> Any:
+        self._clear_if_stale()
+        return self._entries.get(self._key(request))
+
+    def set(self, request: BaseModel, response: Any):
+        self._entries.set(self._key(request), response)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return self._entries.stats()
+
+    def _clear_if_stale(self):
+        generation = get_index_generation(self.index_names)
+        with self._lock:
+            if generation == self._generation:
+                return
+            self._generation = generation
+        self.clear()
+
+    def _key(self, request: BaseModel) -> Tuple[str, str]:
+        fields = request.model_dump(mode="json")
+        question = re.sub(r"\s+", " ", fields.pop("question")).strip()
+        return (question, json.dumps(fields, sort_keys=True))
+
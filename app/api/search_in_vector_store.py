@@ -1,13 +1,21 @@
+import os
 from typing import List
 
-from app.api.init_services import init_retriever
+from api.init_services import init_search_client
+from api.search import FIELDS_CONTENT, FIELDS_CONTENT_VECTOR, get_select
 from langchain_core.documents import Document
 
 
-def search_in_vector_store(question: str, addVectors: bool) -> List[Document]:
-    retriever = init_retriever(k=3)
-    documents = retriever.invoke(question)
-    if not addVectors:
-        for d in documents:
-            d.metadata['content_vector']=[]
-    return documents
\ No newline at end of file
+def search_in_vector_store(question: str, addVectors: bool, fields: List[str] | None = None) -> List[Document]:
+    """The 3 best documents of the index, with the metadata AzureAISearchRetriever returns: every field of the index except the content, and the search score.
+    Without fields, all fields are fetched like before. With fields, only those are fetched and returned."""
+    client = init_search_client(str(os.getenv("AZURE_SEARCH_INDEX_NAME")))
+    results = client.search(search_text=question, top=3, select=None if fields is None else get_select(fields, addVectors))
+    documents = []
+    for r in results:
+        #The search client adds the @search fields that weren't returned as None, the REST api of AzureAISearchRetriever leaves them out
+        metadata = {key: value for key, value in r.items() if key != FIELDS_CONTENT and not (key.startswith('@search.') and value is None)}
+        if not addVectors:
+            metadata[FIELDS_CONTENT_VECTOR] = []
+        documents.append(Document(page_content=r[FIELDS_CONTENT], metadata=metadata))
+    return documents
@@ -0,0 +1,58 @@
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+class ServicePool:
+    """Process-wide registry of Azure clients (search clients, vector stores, embeddings).
+
+    Every entry is keyed by kind, index name and deployment and is constructed only once,
+    so the clients and their keep-alive HTTP connections are reused across requests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str, str], Any] = {}
+        self._key_locks: Dict[Tuple[str, str, str], threading.Lock] = {}
+        self._created = 0
+        self._reused = 0
+
+    def get(self, kind: str, index_name: str, deployment: str, factory: Callable[[], Any]) -> Any:
+        """Return the pooled entry for the key, constructing it with factory on first use"""
+        key = (kind, index_name, deployment)
+        with self._lock:
+            if key in self._entries:
+                self._reused += 1
+                return self._entries[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        #Only requests for the same key wait on each other while the entry is constructed
+        with key_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._reused += 1
+                    return self._entries[key]
+            entry = factory()
+            with self._lock:
+                self._entries[key] = entry
+                self._created += 1
+            return entry
+
+    def entries(self, kind: str) -> List[Any]:
+        with self._lock:
+            return [entry for (entry_kind, _, _), entry in self._entries.items() if entry_kind == kind]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "created": self._created,
+                "reused": self._reused,
+                "entries": [{"kind": kind, "index_name": index_name, "deployment": deployment} for kind, index_name, deployment in self._entries],
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._key_locks.clear()
+
+
+service_pool = ServicePool()
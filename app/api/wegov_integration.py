@@ -1,31 +1,82 @@
+import asyncio
+import os
 import re
-import requests
+from typing import Dict
+import httpx
 import xml.etree.ElementTree as ET
+from api.ttl_cache import TTLCache
+from chat.backends import get_backend, local_partner_keys
 
-def validate_partner_key(partnerKey: str):
-    if "apikey" in partnerKey:   
+# Valid keys are cached longer than invalid ones, so a key that was just activated is picked up quickly
+VALID_KEY_TTL_SECONDS = float(os.getenv("PARTNER_KEY_VALID_TTL_SECONDS", "300"))
+INVALID_KEY_TTL_SECONDS = float(os.getenv("PARTNER_KEY_INVALID_TTL_SECONDS", "30"))
+
+_validation_cache = TTLCache(max_size=int(os.getenv("PARTNER_KEY_CACHE_SIZE", "1024")), ttl_seconds=VALID_KEY_TTL_SECONDS)
+# Concurrent requests with the same key share a single validation call
+_validations_in_flight: Dict[str, asyncio.Task] = {}
+_client: httpx.AsyncClient | None = None
+
+def get_client() -> httpx.AsyncClient:
+    """Return the pooled HTTP client, its keep-alive connections are reused by all validations"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=10)
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def validate_partner_key(partnerKey: str):
+    if "apikey" in partnerKey:
         apikeyRemover = re.compile(r'apikey\w*')
         partnerKey = apikeyRemover.sub('', partnerKey)
+
+    isValid = _validation_cache.get(partnerKey)
+    if isValid is not None:
+        return isValid
+
+    if partnerKey not in _validations_in_flight:
+        _validations_in_flight[partnerKey] = asyncio.create_task(_validate_and_cache(partnerKey))
+    # Shielded, so a cancelled request doesn't cancel the validation other requests are waiting for
+    return await asyncio.shield(_validations_in_flight[partnerKey])
+
+def get_validation_cache_stats() -> dict:
+    return {**_validation_cache.stats(), "in_flight": len(_validations_in_flight)}
+
+async def _validate_and_cache(partnerKey: str) -> bool:
     isValid = False
     try:
-        url="https://dev-service.immo-connect.be/soap12"
-        #headers = {'content-type': 'application/soap+xml'}
-        headers = {'content-type': 'text/xml'}
-        body = """<soap12:Envelope xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:soap12="http://www.w3.org/2003/05/soap-envelope">
-            <soap12:Body>
-                <ValidateApiKeys xmlns:i="http://www.w3.org/2001/XMLSchema-instance" xmlns="http://schemas.servicestack.net/types">
-                    <PartnerApiKey>"""+ partnerKey +"""</PartnerApiKey>
-                    <Session>00000000-0000-0000-0000-000000000000</Session>
-                    <CustomerApiKey>00000000-0000-0000-0000-000000000000</CustomerApiKey>
-                </ValidateApiKeys>
-            </soap12:Body>
-        </soap12:Envelope>"""
-
-        response = requests.post(url,data=body,headers=headers)
-
-        responseXml = ET.fromstring(response.text)
-
-        isValid = responseXml.find('{http://www.w3.org/2003/05/soap-envelope}Body').find('{http://schemas.servicestack.net/types}ValidateApiKeysResponse').find('{http://schemas.servicestack.net/types}IsValid').text == 'true'
+        isValid = await _request_validation(partnerKey)
+        # Failed calls are not cached, only the answers of the service
+        _validation_cache.set(partnerKey, isValid, ttl_seconds=VALID_KEY_TTL_SECONDS if isValid else INVALID_KEY_TTL_SECONDS)
     except Exception as e:
         print(e)
+    finally:
+        del _validations_in_flight[partnerKey]
     return isValid
+
+async def _request_validation(partnerKey: str) -> bool:
+    if get_backend("partner_keys") == "local":
+        return partnerKey in local_partner_keys()
+
+    url="https://dev-service.immo-connect.be/soap12"
+    #headers = {'content-type': 'application/soap+xml'}
+    headers = {'content-type': 'text/xml'}
+    body = """<soap12:Envelope xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:soap12="http://www.w3.org/2003/05/soap-envelope">
+        <soap12:Body>
+            <ValidateApiKeys xmlns:i="http://www.w3.org/2001/XMLSchema-instance" xmlns="http://schemas.servicestack.net/types">
+                <PartnerApiKey>"""+ partnerKey +"""</PartnerApiKey>
+                <Session>00000000-0000-0000-0000-000000000000</Session>
+                <CustomerApiKey>00000000-0000-0000-0000-000000000000</CustomerApiKey>
+            </ValidateApiKeys>
+        </soap12:Body>
+    </soap12:Envelope>"""
+
+    response = await get_client().post(url,content=body,headers=headers)
+
+    responseXml = ET.fromstring(response.text)
+
+    return responseXml.find('{http://www.w3.org/2003/05/soap-envelope}Body').find('{http://schemas.servicestack.net/types}ValidateApiKeysResponse').find('{http://schemas.servicestack.net/types}IsValid').text == 'true'
@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import csv
+import glob
+import json
+import os
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, List
+from uuid import UUID
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.messages import AIMessage, HumanMessage
+
+# Benchmark of the conversational rag chain: the time (and allocations) per stage, over the questions of the evaluation data.
+# Record the responses of the backends once, then replay them with their recorded latencies to compare runs:
+#   python benchmark.py --mode record --recording benchmark-recording.json
+#   python benchmark.py --mode replay --recording benchmark-recording.json --output before.json
+#   python benchmark.py --mode replay --recording benchmark-recording.json --compare before.json
+
+parser = argparse.ArgumentParser(description="Benchmark the conversational rag chain")
+parser.add_argument("--mode", choices=["record", "replay", "live"], default="replay", help="record the backend responses, replay them, or only call the backends")
+parser.add_argument("--recording", default="benchmark-recording.json", help="the file with the recorded backend responses")
+parser.add_argument("--questions", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "evaluation", "*.csv"), help="the csv files with the questions, the question is the first column")
+parser.add_argument("--limit", type=int, default=None, help="only use the first questions")
+parser.add_argument("--repeat", type=int, default=3, help="the number of times every question is asked")
+parser.add_argument("--warmup", type=int, default=1, help="the number of questions asked before measuring")
+parser.add_argument("--history", action="store_true", help="ask every question as a follow-up of the previous question, so it is rewritten first")
+parser.add_argument("--no-allocations", action="store_true", help="skip the pass that traces the allocations")
+parser.add_argument("--keep-caches", action="store_true", help="keep the embedding cache, repeated questions are then not embedded again")
+parser.add_argument("--output", help="write the results to this json file")
+parser.add_argument("--compare", help="compare the results with those of an earlier run (a json file written with --output)")
+args = parser.parse_args()
+
+load_dotenv()
+#Set before the chain is imported, the backends and caches read them when they are created
+if args.mode != "live":
+    os.environ["BACKEND_RECORDING_PATH"] = args.recording
+    os.environ["BACKEND_RECORDING_MODE"] = args.mode
+if not args.keep_caches:
+    os.environ["EMBEDDING_CACHE_SIZE"] = "0"
+
+from chat.backends import get_backend_recorder
+from chat.conversational_rag_chain import create_conversational_rag_chain
+
+class StageTimer(BaseCallbackHandler):
+    """Measures the time and the allocations of the stages of the chain: the runs of the retrievers and the chat model"""
+
+    run_inline = True
+
+    def __init__(self, trace_allocations: bool):
+        self.trace_allocations = trace_allocations
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.allocations: Dict[str, List[float]] = defaultdict(list)
+        self._names: Dict[UUID, str] = {}
+        self._parents: Dict[UUID, UUID | None] = {}
+        self._started: Dict[UUID, tuple] = {}
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Any, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any):
+        self._names[run_id] = kwargs.get("name") or ""
+        self._parents[run_id] = parent_run_id
+
+    def on_retriever_start(self, serialized: Dict[str, Any], query: str, *, run_id: UUID, parent_run_id: UUID | None = None, metadata: Dict[str, Any] | None = None, **kwargs: Any):
+        stage = (metadata or {}).get("stage", "retrieve")
+        index_name = (metadata or {}).get("index_name")
+        self._start(run_id, parent_run_id, f"{stage}:{index_name}" if index_name else stage)
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any):
+        self._parents[run_id] = parent_run_id
+        self._start(run_id, parent_run_id, "rewrite" if self._has_ancestor(run_id, "retrieve_documents") else "answer")
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        started = self._started.get(run_id)
+        if started is not None and not started[3]:
+            self._started[run_id] = (*started[:3], True)
+            self.samples[f"{started[0]}:first_token"].append(time.perf_counter() - started[1])
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def add(self, stage: str, seconds: float, allocated: float | None = None):
+        self.samples[stage].append(seconds)
+        if allocated is not None:
+            self.allocations[stage].append(allocated)
+
+    def _start(self, run_id: UUID, parent_run_id: UUID | None, stage: str):
+        self._parents[run_id] = parent_run_id
+        allocated = tracemalloc.get_traced_memory()[0] if self.trace_allocations else None
+        self._started[run_id] = (stage, time.perf_counter(), allocated, False)
+
+    def _end(self, run_id: UUID):
+        started = self._started.pop(run_id, None)
+        if started is None:
+            return
+        stage, start, allocated, _ = started
+        self.add(stage, time.perf_counter() - start, tracemalloc.get_traced_memory()[0] - allocated if allocated is not None else None)
+
+    def _has_ancestor(self, run_id: UUID, name: str) -> bool:
+        parent = self._parents.get(run_id)
+        while parent is not None:
+            if self._names.get(parent) == name:
+                return True
+            parent = self._parents.get(parent)
+        return False
+
+def load_questions(pattern: str) -> List[str]:
+    questions = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "rb") as file:
+            content = file.read()
+        #evaluate.py writes its results with the default encoding of Windows
+        try:
+            lines = content.decode("utf-8").splitlines()
+        except UnicodeDecodeError:
+            lines = content.decode("cp1252").splitlines()
+        delimiter = "|" if any("|" in line for line in lines[:5]) else ","
+        for row in csv.reader(lines, delimiter=delimiter):
+            if row and row[0].strip() and row[0].strip().lower() != "question" and row[0].strip() not in questions:
+                questions.append(row[0].strip())
+    return questions
+
+#The chain looks up the history of a question by its session id
+_histories: Dict[str, InMemoryChatMessageHistory] = {}
+
+async def ask(chain, question: str, history: InMemoryChatMessageHistory, timer: StageTimer) -> str:
+    session_id = str(uuid.uuid4())
+    _histories[session_id] = history
+    answer = ""
+    async for chunk in chain.astream(
+        {"input": question},
+        config={"configurable": {"session_id": session_id}, "callbacks": [timer]},
+    ):
+        answer += chunk.get("answer", "")
+    return answer
+
+async def run(chain, questions: List[str], repeat: int, timer: StageTimer | None) -> None:
+    """Ask the questions, measured with the timer when there is one"""
+    recorder = get_backend_recorder()
+    for _ in range(repeat):
+        #Every pass asks the same conversation, so it can be replayed
+        previous = None
+        for question in questions:
+            history = InMemoryChatMessageHistory()
+            if args.history and previous is not None:
+                history.add_messages([HumanMessage(previous[0]), AIMessage(previous[1])])
+            if recorder is not None:
+                recorder.take_calls()
+            if timer is not None and timer.trace_allocations:
+                tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0] if timer is not None and timer.trace_allocations else None
+            start = time.perf_counter()
+            answer = await ask(chain, question, history, timer or StageTimer(False))
+            if timer is not None:
+                timer.add("total", time.perf_counter() - start)
+                if allocated is not None:
+                    timer.allocations["total"].append(tracemalloc.get_traced_memory()[0] - allocated)
+                    timer.allocations["total:peak"].append(tracemalloc.get_traced_memory()[1] - allocated)
+                for service, seconds in recorder.take_calls() if recorder is not None else []:
+                    timer.add(f"backend:{service}", seconds)
+            previous = (question, answer)
+
+def summarize(timer: StageTimer, allocation_timer: StageTimer | None) -> Dict[str, dict]:
+    stages = {}
+    for stage, samples in sorted(timer.samples.items()):
+        milliseconds = np.array(samples) * 1000
+        stages[stage] = {
+            "count": len(samples),
+            "mean_ms": float(milliseconds.mean()),
+            "p50_ms": float(np.percentile(milliseconds, 50)),
+            "p95_ms": float(np.percentile(milliseconds, 95)),
+            "p99_ms": float(np.percentile(milliseconds, 99)),
+            "max_ms": float(milliseconds.max()),
+        }
+    if allocation_timer is not None:
+        for stage, allocations in sorted(allocation_timer.allocations.items()):
+            kilobytes = np.array(allocations) / 1024
+            stages.setdefault(stage, {}).update({"alloc_p50_kb": float(np.percentile(kilobytes, 50)), "alloc_max_kb": float(kilobytes.max())})
+    return stages
+
+def print_stages(stages: Dict[str, dict], baseline: Dict[str, dict] | None):
+    print(f"{'stage':<40}{'n':>6}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}{'alloc p50':>12}{'alloc max':>12}")
+    for stage, stats in stages.items():
+        timings = "".join(f"{stats[key]:>10.1f}" if key in stats else f"{'':>10}" for key in ["mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+        allocations = "".join(f"{stats[key]:>10.0f}kB" if key in stats else f"{'':>12}" for key in ["alloc_p50_kb", "alloc_max_kb"])
+        print(f"{stage:<40}{stats.get('count', ''):>6}{timings}{allocations}")
+        if baseline is not None and stage in baseline and "p50_ms" in stats and "p50_ms" in baseline[stage]:
+            deltas = "".join(f"{stats[key] - baseline[stage][key]:>+10.1f}" for key in ["mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+            print(f"{'  vs baseline':<40}{'':>6}{deltas}")
+
+async def main():
+    questions = load_questions(args.questions)[:args.limit]
+    print(f"{len(questions)} questions, {args.mode} mode")
+    chain = create_conversational_rag_chain(get_session_history=lambda session_id: _histories.pop(session_id))
+
+    await run(chain, questions[:args.warmup], 1, None)
+    timer = StageTimer(trace_allocations=False)
+    await run(chain, questions, args.repeat, timer)
+    #Tracing allocations slows the code down, so they are measured in a separate pass
+    allocation_timer = None
+    if not args.no_allocations:
+        allocation_timer = StageTimer(trace_allocations=True)
+        tracemalloc.start()
+        await run(chain, questions, 1, allocation_timer)
+        tracemalloc.stop()
+
+    recorder = get_backend_recorder()
+    if recorder is not None:
+        recorder.save()
+
+    stages = summarize(timer, allocation_timer)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)["stages"]
+    print_stages(stages, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"mode": args.mode, "questions": len(questions), "repeat": args.repeat, "history": args.history, "stages": stages}, file, indent=2)
+
+asyncio.run(main())
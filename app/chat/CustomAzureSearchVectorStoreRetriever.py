@@ -4,25 +4,55 @@ from typing import (
     ClassVar,
     Collection,
     Dict,
+    Iterator,
     List,
+    Tuple,
 )
+import numpy as np
 from langchain_core.callbacks import (
     AsyncCallbackManagerForRetrieverRun,
     CallbackManagerForRetrieverRun,
 )
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.pydantic_v1 import root_validator
 from langchain_core.retrievers import BaseRetriever
-from langchain_community.vectorstores.azuresearch import AzureSearch
+from langchain_core.vectorstores import VectorStore
+from langchain_core.runnables.config import run_in_executor
+from langchain_community.vectorstores.azuresearch import (
+    FIELDS_CONTENT,
+    FIELDS_ID,
+    FIELDS_METADATA,
+)
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 
 from chat.coman_schemes import ComanScheme
 from chat.chat_state import ChatState
+from chat.async_azure_search import (
+    avector_search_with_score,
+    ahybrid_search_with_score,
+    asemantic_hybrid_search_with_score_and_rerank,
+)
+
+def increased_scores(results: List[Tuple[Document, float]], score_increase_per_type: Dict[str, float]) -> np.ndarray:
+    """The scores of the results, increased with the score increase of their type"""
+    scores = np.array([score for _, score in results], dtype=np.float64)
+    if score_increase_per_type:
+        types = np.array([doc.metadata.get('type') or '' for doc, _ in results])
+        for type, increase in score_increase_per_type.items():
+            scores[types == type] += increase
+    return scores
+
+#Lower bound of the first fetch, so small values of k still get some docs to sort on date and score increase
+MIN_FETCH_K = 10
+#Growth of the fetch when all fetched docs are above the threshold, a large factor keeps the number of round trips low
+FETCH_GROWTH_FACTOR = 4
 
 class CustomAzureSearchVectorStoreRetriever(BaseRetriever):
     """Retriever that uses `Azure Cognitive Search`."""
 
-    vectorstore: AzureSearch
-    """Azure Search instance used to find similar documents."""
+    vectorstore: VectorStore
+    """Azure Search instance used to find similar documents, or a LocalVectorStore with a copy of the index."""
     search_type: str = "hybrid"
     """Type of search to perform. Options are "similarity", "hybrid",
     "semantic_hybrid", "similarity_score_threshold", "hybrid_score_threshold", 
@@ -44,6 +74,18 @@ class CustomAzureSearchVectorStoreRetriever(BaseRetriever):
 
     score_threshold: float | None = None
 
+    async_client: AsyncSearchClient | None = None
+    """Async client for the index of the vectorstore, without it async searches run the sync search in an executor."""
+    embeddings: Embeddings | None = None
+    """Embeddings of the vectorstore, used to embed the query asynchronously."""
+
+    select: List[str] = [FIELDS_ID, FIELDS_CONTENT, FIELDS_METADATA]
+    """Fields returned by the search, the documents are built from the content and the metadata, so the content vector is not fetched by default."""
+    over_fetch_factor: int = 4
+    """The first search fetches k * over_fetch_factor docs, the date sorting and score increases are applied to all fetched docs before keeping k."""
+    max_fetch_k: int = 99
+    """Threshold searches fetch more docs (up to max_fetch_k) while the fetched docs are all above the threshold."""
+
     class Config:
         """Configuration for this pydantic object."""
 
@@ -67,51 +109,109 @@ class CustomAzureSearchVectorStoreRetriever(BaseRetriever):
         run_manager: CallbackManagerForRetrieverRun,
         **kwargs: Any,
     ) -> List[Document]:
-        kwargs['filters'] = self.filters
-        kwargs['score_threshold'] = self.score_threshold
-        #We use a high k to get (almost) all of the docs that are above the threshold
-        #Later we will sort them on date and return the top k
-        high_k = 99
-        if self.search_type == "similarity":
-            docs = self.vectorstore.vector_search(query, k=high_k,**kwargs)
-        elif self.search_type == "similarity_score_threshold":
-            results = self.vectorstore.similarity_search_with_relevance_scores(query, k=high_k, **kwargs)
-            results.sort(key=lambda x: x[1] + self.score_increase_per_type[x[0].metadata['type']] if x[0].metadata['type'] in self.score_increase_per_type else x[1], reverse=True)
-            docs = [doc for doc, _ in results]
-        elif self.search_type == "hybrid":
-            docs = self.vectorstore.hybrid_search(query, k=high_k, **kwargs)
-        elif self.search_type == "hybrid_score_threshold":
-            results = self.vectorstore.hybrid_search_with_relevance_scores(query, k=high_k, **kwargs)
-            results.sort(key=lambda x: x[1] + self.score_increase_per_type[x[0].metadata['type']] if x[0].metadata['type'] in self.score_increase_per_type else x[1], reverse=True)
-            docs = [doc for doc, _ in results]
-        elif self.search_type == "semantic_hybrid":
-            docs = self.vectorstore.semantic_hybrid_search(query, k=high_k, **kwargs)
-        elif self.search_type == "semantic_hybrid_score_threshold":
-            results = self.vectorstore.semantic_hybrid_search_with_score(query, k=high_k, **kwargs)
-            results.sort(key=lambda x: x[1] + self.score_increase_per_type[x[0].metadata['type']] if x[0].metadata['type'] in self.score_increase_per_type else x[1], reverse=True)
-            docs = [doc for doc, _ in results]
+        return self.select_documents(self.rank(self.scored_candidates(query)))
+
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+    ) -> List[Document]:
+        return self.select_documents(self.rank(await self.ascored_candidates(query)))
+
+    def scored_candidates(self, query: str) -> List[Tuple[Document, float]]:
+        """The fetched docs with their score, above the score threshold, before they are ranked and cut to k"""
+        for fetch_k in self.fetch_sizes():
+            results = self.search_with_score(query, fetch_k)
+            if self.fetched_all_relevant(results, fetch_k):
+                break
+        return self.filter_on_score_threshold(results) if self.search_type.endswith("_score_threshold") else results
+
+    async def ascored_candidates(self, query: str, embedding: List[float] | None = None) -> List[Tuple[Document, float]]:
+        """The async scored_candidates, with the embedding of the query when it is already known"""
+        if self.async_client is None:
+            #Without an async client the sync search runs in the default executor
+            return await run_in_executor(None, self.scored_candidates, query)
+
+        if embedding is None:
+            embedding = await self.aembed_query(query)
+        for fetch_k in self.fetch_sizes():
+            results = await self.asearch_with_score(query, embedding, fetch_k)
+            if self.fetched_all_relevant(results, fetch_k):
+                break
+        return self.filter_on_score_threshold(results) if self.search_type.endswith("_score_threshold") else results
+
+    def search_with_score(self, query: str, fetch_k: int) -> List[Tuple[Document, float]]:
+        if self.search_type.startswith("similarity"):
+            return self.vectorstore.vector_search_with_score(query, k=fetch_k, filters=self.filters, select=self.select)
+        elif self.search_type.startswith("hybrid"):
+            return self.vectorstore.hybrid_search_with_score(query, k=fetch_k, filters=self.filters, select=self.select)
+        elif self.search_type.startswith("semantic_hybrid"):
+            results = self.vectorstore.semantic_hybrid_search_with_score_and_rerank(query, k=fetch_k, filters=self.filters, select=self.select)
+            return [(doc, score) for doc, score, _ in results]
+        else:
+            raise ValueError(f"search_type of {self.search_type} not allowed.")
+
+    async def asearch_with_score(self, query: str, embedding: List[float], fetch_k: int) -> List[Tuple[Document, float]]:
+        if self.search_type.startswith("similarity"):
+            return await avector_search_with_score(self.async_client, embedding, k=fetch_k, filters=self.filters, select=self.select)
+        elif self.search_type.startswith("hybrid"):
+            return await ahybrid_search_with_score(self.async_client, embedding, query, k=fetch_k, filters=self.filters, select=self.select)
+        elif self.search_type.startswith("semantic_hybrid"):
+            results = await asemantic_hybrid_search_with_score_and_rerank(self.async_client, embedding, query, self.vectorstore.semantic_configuration_name, k=fetch_k, filters=self.filters, select=self.select)
+            return [(doc, score) for doc, score, _ in results]
         else:
             raise ValueError(f"search_type of {self.search_type} not allowed.")
 
+    async def aembed_query(self, query: str) -> List[float]:
+        if self.embeddings is not None:
+            return await self.embeddings.aembed_query(query)
+        return await run_in_executor(None, self.vectorstore.embed_query, query)
+
+    def fetch_sizes(self) -> Iterator[int]:
+        """The number of docs to fetch per search, starting at k * over_fetch_factor and growing up to max_fetch_k"""
+        fetch_k = min(max(self.k * self.over_fetch_factor, MIN_FETCH_K), self.max_fetch_k)
+        while fetch_k < self.max_fetch_k:
+            yield fetch_k
+            fetch_k *= FETCH_GROWTH_FACTOR
+        yield self.max_fetch_k
+
+    def fetched_all_relevant(self, results: List[Tuple[Document, float]], fetch_k: int) -> bool:
+        """Whether all docs that can end up in the result were fetched, i.e. a bigger fetch would not add docs above the score threshold"""
+        if len(results) < fetch_k or not self.search_type.endswith("_score_threshold") or self.score_threshold is None:
+            return True
+        #Semantic results are ordered on their reranker score, so a low last score says nothing about the docs after it
+        return not self.search_type.startswith("semantic_hybrid") and results[-1][1] < self.score_threshold
+
+    def rank(self, results: List[Tuple[Document, float]]) -> List[Document]:
+        if self.search_type.endswith("_score_threshold"):
+            return self.sort_with_score_increase(results)
+        return [doc for doc, _ in results]
+
+    def filter_on_score_threshold(self, results: List[Tuple[Document, float]]) -> List[Tuple[Document, float]]:
+        """Keep the results with a score above the threshold, like the *_with_relevance_scores methods of AzureSearch"""
+        if self.score_threshold is None:
+            return results
+        return [result for result in results if result[1] >= self.score_threshold]
+
+    def sort_with_score_increase(self, results: List[Tuple[Document, float]]) -> List[Document]:
+        """Sort the results on their score, increased with the score increase of their type"""
+        if not results:
+            return []
+        scores = increased_scores(results, self.score_increase_per_type)
+        return [results[i][0] for i in np.argsort(-scores, kind="stable")]
+
+    def select_documents(self, docs: List[Document], k: int | None = None) -> List[Document]:
+        """Sort the docs on date relevancy, keep the k (by default the k of the retriever) most relevant ones and add their date info"""
         #sorts the docs with the specified types by date while preserving the position of the other docs
         docs = self.sort_with_date_relevancy(docs, [ComanScheme.ACTUA.value, ComanScheme.JURISDICTION.value, ComanScheme.MEDIA.value])
         #return the k most relevant docs
-        docs = docs[:self.k]
+        docs = docs[:k or self.k]
 
         docs = self.add_date_info_to_page_content(docs)
-                
-        ChatState.documents = docs
-        return docs
 
-    async def _aget_relevant_documents(
-        self,
-        query: str,
-        *,
-        run_manager: AsyncCallbackManagerForRetrieverRun,
-    ) -> List[Document]:
-        raise NotImplementedError(
-            "AzureSearchVectorStoreRetriever does not support async"
-        )
+        ChatState.current().documents = docs
+        return docs
         
     def sort_with_date_relevancy(self, docs: List[Document], sorted_types: List[str]):
         """Sort objects with the given types by their date property while retaining the original order of the other objects"""
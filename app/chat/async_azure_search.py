@@ -0,0 +1,90 @@
+from typing import Any, List, Tuple
+import json
+import numpy as np
+from azure.search.documents.aio import AsyncSearchItemPaged, SearchClient as AsyncSearchClient
+from azure.search.documents.models import VectorizedQuery
+from langchain_core.documents import Document
+from langchain_community.vectorstores.azuresearch import (
+    FIELDS_CONTENT,
+    FIELDS_CONTENT_VECTOR,
+    FIELDS_ID,
+    FIELDS_METADATA,
+    _result_to_document,
+)
+
+# Async versions of the AzureSearch search methods, langchain_community only implements them with the sync client.
+# The queries and the returned documents are the same as those of AzureSearch.
+
+async def asimple_search(client: AsyncSearchClient, embedding: List[float], text_query: str, k: int, *, filters: str | None = None, **kwargs: Any) -> AsyncSearchItemPaged:
+    return await client.search(
+        search_text=text_query,
+        vector_queries=[
+            VectorizedQuery(
+                vector=np.array(embedding, dtype=np.float32).tolist(),
+                k_nearest_neighbors=k,
+                fields=FIELDS_CONTENT_VECTOR,
+            )
+        ],
+        filter=filters,
+        top=k,
+        **kwargs,
+    )
+
+async def avector_search_with_score(client: AsyncSearchClient, embedding: List[float], k: int = 4, filters: str | None = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+    results = await asimple_search(client, embedding, "", k, filters=filters, **kwargs)
+    return [(_result_to_document(result), float(result["@search.score"])) async for result in results]
+
+async def ahybrid_search_with_score(client: AsyncSearchClient, embedding: List[float], query: str, k: int = 4, filters: str | None = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+    results = await asimple_search(client, embedding, query, k, filters=filters, **kwargs)
+    return [(_result_to_document(result), float(result["@search.score"])) async for result in results]
+
+async def asemantic_hybrid_search_with_score_and_rerank(client: AsyncSearchClient, embedding: List[float], query: str, semantic_configuration_name: str | None, k: int = 4, filters: str | None = None, **kwargs: Any) -> List[Tuple[Document, float, float]]:
+    results = await client.search(
+        search_text=query,
+        vector_queries=[
+            VectorizedQuery(
+                vector=np.array(embedding, dtype=np.float32).tolist(),
+                k_nearest_neighbors=k,
+                fields=FIELDS_CONTENT_VECTOR,
+            )
+        ],
+        filter=filters,
+        query_type="semantic",
+        semantic_configuration_name=semantic_configuration_name,
+        query_caption="extractive",
+        query_answer="extractive",
+        top=k,
+        **kwargs,
+    )
+    # Get Semantic Answers
+    semantic_answers = await results.get_answers() or []
+    semantic_answers_dict = {}
+    for semantic_answer in semantic_answers:
+        semantic_answers_dict[semantic_answer.key] = {
+            "text": semantic_answer.text,
+            "highlights": semantic_answer.highlights,
+        }
+    # Convert results to Document objects
+    docs = []
+    async for result in results:
+        captions = result.get("@search.captions")
+        docs.append((
+            Document(
+                page_content=result.pop(FIELDS_CONTENT),
+                metadata={
+                    **(
+                        json.loads(result[FIELDS_METADATA])
+                        if FIELDS_METADATA in result
+                        else {key: value for key, value in result.items() if key != FIELDS_CONTENT_VECTOR}
+                    ),
+                    "captions": {
+                        "text": captions[0].text,
+                        "highlights": captions[0].highlights,
+                    } if captions else {},
+                    "answers": semantic_answers_dict.get(result.get(FIELDS_ID, ""), ""),
+                },
+            ),
+            float(result["@search.score"]),
+            float(result["@search.reranker_score"]),
+        ))
+    return docs
@@ -0,0 +1,299 @@
+from __future__ import annotations
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Literal, Tuple
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_community.vectorstores.azuresearch import AzureSearch
+from chat.local_backends import AsyncInMemorySearchResults, InMemorySearchResults
+
+# Records the responses of the backends (embeddings, chat model, search) with their latencies, and replays them.
+# Replays are deterministic and need no network, so runs of the benchmark (benchmark.py) can be compared.
+# Enabled with BACKEND_RECORDING_PATH and BACKEND_RECORDING_MODE (record or replay), see backends.py.
+
+RecordingMode = Literal["record", "replay"]
+
+#The system prompts contain the date of today, it is left out of the keys so recordings can be replayed on another day
+_TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d+)?")
+
+class BackendRecorder:
+    """The recorded responses, by request. Requests that were recorded more than once are replayed in the recorded order."""
+
+    def __init__(self, path: str, mode: RecordingMode):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown recording mode {mode!r}, use record or replay")
+        self.path = path
+        self.mode = mode
+        self.calls: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[dict]] = {}
+        self._replayed: Dict[str, int] = {}
+        if mode == "replay":
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No recording at {path}, record it first with BACKEND_RECORDING_MODE=record")
+            with open(path, encoding="utf-8") as file:
+                self._entries = json.load(file)
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def call(self, service: str, request: Any, send: Callable[[], Any]) -> Any:
+        """Send the request and record its response, or replay the recorded response after the recorded latency"""
+        start = time.perf_counter()
+        if self.replaying:
+            entry = self.replay_entry(service, request)
+            time.sleep(entry["latency"])
+            response = entry["response"]
+        else:
+            response = send()
+            self.record_entry(service, request, response, time.perf_counter() - start)
+        self.observe(service, time.perf_counter() - start)
+        return response
+
+    async def acall(self, service: str, request: Any, send: Callable[[], Awaitable[Any]]) -> Any:
+        start = time.perf_counter()
+        if self.replaying:
+            entry = self.replay_entry(service, request)
+            await asyncio.sleep(entry["latency"])
+            response = entry["response"]
+        else:
+            response = await send()
+            self.record_entry(service, request, response, time.perf_counter() - start)
+        self.observe(service, time.perf_counter() - start)
+        return response
+
+    def take_calls(self) -> List[Tuple[str, float]]:
+        """The (service, seconds) of the calls since the last time they were taken"""
+        with self._lock:
+            calls, self.calls = self.calls, []
+        return calls
+
+    def save(self):
+        if self.replaying:
+            return
+        with self._lock:
+            with open(self.path, "w", encoding="utf-8") as file:
+                json.dump(self._entries, file)
+
+    def replay_entry(self, service: str, request: Any) -> dict:
+        """The next recorded response and latency of the request, a copy because callers may change the response"""
+        key = _key(service, request)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise KeyError(f"No recorded {service} response for this request, record it first with BACKEND_RECORDING_MODE=record")
+            index = self._replayed.get(key, 0)
+            self._replayed[key] = index + 1
+            return copy.deepcopy(entries[index % len(entries)])
+
+    def record_entry(self, service: str, request: Any, response: Any, latency: float):
+        key = _key(service, request)
+        with self._lock:
+            self._entries.setdefault(key, []).append({"response": copy.deepcopy(response), "latency": latency})
+
+    def observe(self, service: str, seconds: float):
+        with self._lock:
+            self.calls.append((service, seconds))
+
+class RecordedEmbeddings(Embeddings):
+    """Embeddings that are recorded, or replayed when embeddings is None"""
+
+    def __init__(self, embeddings: Embeddings | None, deployment: str, recorder: BackendRecorder):
+        self.embeddings = embeddings
+        self.deployment = deployment
+        self.recorder = recorder
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.recorder.call("embeddings", [self.deployment, texts], lambda: self.embeddings.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.recorder.call("embeddings", [self.deployment, text], lambda: self.embeddings.embed_query(text))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.recorder.acall("embeddings", [self.deployment, texts], lambda: self.embeddings.aembed_documents(texts))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.recorder.acall("embeddings", [self.deployment, text], lambda: self.embeddings.aembed_query(text))
+
+class RecordedChatModel(BaseChatModel):
+    """Chat model that is recorded, or replayed when model is None.
+    Streamed responses are replayed with the recorded delay of every chunk."""
+
+    model: BaseChatModel | None = None
+    recorder: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "recorded-chat"
+
+    def _generate(self, messages: List[BaseMessage], stop: List[str] | None = None, run_manager: CallbackManagerForLLMRun | None = None, **kwargs: Any) -> ChatResult:
+        def send() -> dict:
+            result = self.model._generate(messages, stop=stop, **kwargs)
+            return {"chunks": [result.generations[0].message.content], "offsets": [0.0], "llm_output": result.llm_output}
+        return _chat_result(self.recorder.call("chat", [messages, stop], send))
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: List[str] | None = None, run_manager: AsyncCallbackManagerForLLMRun | None = None, **kwargs: Any) -> ChatResult:
+        async def send() -> dict:
+            result = await self.model._agenerate(messages, stop=stop, **kwargs)
+            return {"chunks": [result.generations[0].message.content], "offsets": [0.0], "llm_output": result.llm_output}
+        return _chat_result(await self.recorder.acall("chat", [messages, stop], send))
+
+    def _stream(self, messages: List[BaseMessage], stop: List[str] | None = None, run_manager: CallbackManagerForLLMRun | None = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        #Chunks are yielded as they arrive, so the stream is recorded around the model instead of with recorder.call
+        request = [messages, stop]
+        start = time.perf_counter()
+        if self.recorder.replaying:
+            entry = self.recorder.replay_entry("chat", request)
+            for chunk, offset in zip(entry["response"]["chunks"], entry["response"]["offsets"]):
+                time.sleep(max(0.0, offset - (time.perf_counter() - start)))
+                yield _new_token(chunk, run_manager)
+            time.sleep(max(0.0, entry["latency"] - (time.perf_counter() - start)))
+        else:
+            chunks, offsets = [], []
+            for generation_chunk in self.model._stream(messages, stop=stop, **kwargs):
+                chunks.append(generation_chunk.message.content)
+                offsets.append(time.perf_counter() - start)
+                yield _new_token(generation_chunk.message.content, run_manager)
+            self.recorder.record_entry("chat", request, {"chunks": chunks, "offsets": offsets, "llm_output": None}, time.perf_counter() - start)
+        self.recorder.observe("chat", time.perf_counter() - start)
+
+    async def _astream(self, messages: List[BaseMessage], stop: List[str] | None = None, run_manager: AsyncCallbackManagerForLLMRun | None = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        request = [messages, stop]
+        start = time.perf_counter()
+        if self.recorder.replaying:
+            entry = self.recorder.replay_entry("chat", request)
+            for chunk, offset in zip(entry["response"]["chunks"], entry["response"]["offsets"]):
+                await asyncio.sleep(max(0.0, offset - (time.perf_counter() - start)))
+                yield await _anew_token(chunk, run_manager)
+            await asyncio.sleep(max(0.0, entry["latency"] - (time.perf_counter() - start)))
+        else:
+            chunks, offsets = [], []
+            async for generation_chunk in self.model._astream(messages, stop=stop, **kwargs):
+                chunks.append(generation_chunk.message.content)
+                offsets.append(time.perf_counter() - start)
+                yield await _anew_token(generation_chunk.message.content, run_manager)
+            self.recorder.record_entry("chat", request, {"chunks": chunks, "offsets": offsets, "llm_output": None}, time.perf_counter() - start)
+        self.recorder.observe("chat", time.perf_counter() - start)
+
+class RecordedSearchClient:
+    """SearchClient that is recorded, or replayed when client is None. The results are fetched completely before they are returned."""
+
+    def __init__(self, client: Any | None, index_name: str, recorder: BackendRecorder):
+        self.client = client
+        self.index_name = index_name
+        self.recorder = recorder
+
+    def search(self, search_text: str | None = None, **kwargs: Any) -> InMemorySearchResults:
+        def send() -> dict:
+            results = self.client.search(search_text=search_text, **kwargs)
+            documents = [_recordable_result(result) for result in results]
+            return {
+                "results": documents,
+                "count": results.get_count() if kwargs.get("include_total_count") else None,
+                "answers": [_recordable_answer(answer) for answer in results.get_answers() or []] if kwargs.get("query_answer") else None,
+            }
+        return InMemorySearchResults(*_replayable_results(self.recorder.call("search", [self.index_name, search_text, kwargs], send)))
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+class AsyncRecordedSearchClient(RecordedSearchClient):
+    """Async SearchClient that is recorded, or replayed when client is None"""
+
+    async def search(self, search_text: str | None = None, **kwargs: Any) -> AsyncInMemorySearchResults:
+        async def send() -> dict:
+            results = await self.client.search(search_text=search_text, **kwargs)
+            documents = [_recordable_result(result) async for result in results]
+            return {
+                "results": documents,
+                "count": await results.get_count() if kwargs.get("include_total_count") else None,
+                "answers": [_recordable_answer(answer) for answer in await results.get_answers() or []] if kwargs.get("query_answer") else None,
+            }
+        return AsyncInMemorySearchResults(*_replayable_results(await self.recorder.acall("search", [self.index_name, search_text, kwargs], send)))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+
+class ReplayedAzureSearch(AzureSearch):
+    """AzureSearch on a replayed client. The constructor of AzureSearch looks up the index and embeds a text, so it is not called."""
+
+    def __init__(self, client: RecordedSearchClient, embedding_function: Callable[[str], List[float]] | Embeddings):
+        self.client = client
+        self.embedding_function = embedding_function
+        self.embed_query = embedding_function.embed_query if isinstance(embedding_function, Embeddings) else embedding_function
+        self.search_type = "hybrid"
+        self.semantic_configuration_name = None
+        self.fields = []
+
+def _key(service: str, request: Any) -> str:
+    text = json.dumps([service, _canonical(request)], sort_keys=True, default=str)
+    return hashlib.sha256(_TIMESTAMP.sub("<timestamp>", text).encode("utf-8")).hexdigest()
+
+def _canonical(value: Any) -> Any:
+    if isinstance(value, BaseMessage):
+        return {"type": value.type, "content": value.content}
+    if hasattr(value, "as_dict"):
+        return value.as_dict()
+    if isinstance(value, dict):
+        return {key: _canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    return value
+
+def _chat_result(response: dict) -> ChatResult:
+    return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(response["chunks"])))], llm_output=response["llm_output"])
+
+def _new_token(token: str, run_manager: CallbackManagerForLLMRun | None) -> ChatGenerationChunk:
+    chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+    if run_manager:
+        run_manager.on_llm_new_token(token, chunk=chunk)
+    return chunk
+
+async def _anew_token(token: str, run_manager: AsyncCallbackManagerForLLMRun | None) -> ChatGenerationChunk:
+    chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+    if run_manager:
+        await run_manager.on_llm_new_token(token, chunk=chunk)
+    return chunk
+
+def _recordable_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    captions = result.get("@search.captions")
+    return {**result, "@search.captions": [{"text": caption.text, "highlights": caption.highlights} for caption in captions] if captions else captions}
+
+def _recordable_answer(answer: Any) -> dict:
+    return {"key": answer.key, "text": answer.text, "highlights": answer.highlights, "score": answer.score}
+
+def _replayable_results(response: dict) -> tuple:
+    #Captions and answers are objects in the search results, they are recorded as dicts
+    results = [
+        {**result, "@search.captions": [SimpleNamespace(**caption) for caption in result["@search.captions"]] if result.get("@search.captions") else result.get("@search.captions")}
+        for result in response["results"]
+    ]
+    answers = [SimpleNamespace(**answer) for answer in response["answers"]] if response["answers"] is not None else None
+    return results, response["count"], answers
+
+_recorder: BackendRecorder | None = None
+_recorder_lock = threading.Lock()
+
+def get_recorder() -> BackendRecorder | None:
+    """The recorder of the process, None when BACKEND_RECORDING_PATH is not set"""
+    global _recorder
+    path = os.getenv("BACKEND_RECORDING_PATH")
+    if not path:
+        return None
+    with _recorder_lock:
+        if _recorder is None or _recorder.path != path:
+            _recorder = BackendRecorder(path, os.getenv("BACKEND_RECORDING_MODE", "replay"))
+        return _recorder
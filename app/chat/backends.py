@@ -0,0 +1,149 @@
+import os
+from typing import Callable, List, Literal
+from azure.core.credentials import AzureKeyCredential, AzureNamedKeyCredential
+from azure.data.tables import TableServiceClient
+from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.vectorstores import VectorStore
+from langchain_community.vectorstores.azuresearch import AzureSearch
+from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+
+# Every external service is created here, with the Azure backend or with its local stand-in (see local_backends.py).
+# The backend is set per service with LLM_BACKEND, EMBEDDINGS_BACKEND, SEARCH_BACKEND, TABLES_BACKEND and PARTNER_KEYS_BACKEND,
+# or for all services at once with BACKEND. The default is azure.
+# When BACKEND_RECORDING_PATH is set, the responses of the chat model, embeddings and search are recorded or replayed (see backend_recording.py).
+
+Service = Literal["llm", "embeddings", "search", "tables", "partner_keys"]
+Backend = Literal["azure", "local"]
+
+def get_backend_recorder():
+    """The recorder of the backend responses, None when BACKEND_RECORDING_PATH is not set"""
+    if not os.getenv("BACKEND_RECORDING_PATH"):
+        return None
+    from chat.backend_recording import get_recorder
+    return get_recorder()
+
+def get_backend(service: Service) -> Backend:
+    backend = (os.getenv(f"{service.upper()}_BACKEND") or os.getenv("BACKEND") or "azure").lower()
+    if backend not in ("azure", "local"):
+        raise ValueError(f"Unknown backend {backend!r} for {service}, use azure or local")
+    return backend
+
+def create_chat_model(**kwargs) -> BaseChatModel:
+    recorder = get_backend_recorder()
+    if recorder is not None:
+        from chat.backend_recording import RecordedChatModel
+        return RecordedChatModel(model=None if recorder.replaying else _create_chat_model(**kwargs), recorder=recorder)
+    return _create_chat_model(**kwargs)
+
+def _create_chat_model(**kwargs) -> BaseChatModel:
+    if get_backend("llm") == "local":
+        from chat.local_backends import LocalChatModel
+        return LocalChatModel(
+            response=os.getenv("LOCAL_CHAT_RESPONSE") or None,
+            latency_seconds=float(os.getenv("LOCAL_CHAT_LATENCY_SECONDS", "0")),
+            seconds_per_token=float(os.getenv("LOCAL_CHAT_SECONDS_PER_TOKEN", "0")),
+        )
+    return AzureChatOpenAI(
+        openai_api_version=str(os.getenv("AZURE_OPENAI_API_VERSION")),
+        azure_deployment=str(os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME")),
+        **kwargs
+    )
+
+def get_embedding_deployment() -> str:
+    """The embedding deployment the indexes were built with, the questions have to be embedded with the same one"""
+    return os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME") or "orisai-text-embedding-3-large-development"
+
+def create_embeddings(deployment: str) -> Embeddings:
+    recorder = get_backend_recorder()
+    if recorder is not None:
+        from chat.backend_recording import RecordedEmbeddings
+        return RecordedEmbeddings(None if recorder.replaying else _create_embeddings(deployment), deployment, recorder)
+    return _create_embeddings(deployment)
+
+def _create_embeddings(deployment: str) -> Embeddings:
+    if get_backend("embeddings") == "local":
+        from chat.local_backends import HashEmbeddings
+        return HashEmbeddings(
+            dimensions=int(os.getenv("LOCAL_EMBEDDING_DIMENSIONS", "3072")),
+            latency_seconds=float(os.getenv("LOCAL_EMBEDDING_LATENCY_SECONDS", "0")),
+        )
+    return AzureOpenAIEmbeddings(azure_deployment=deployment)
+
+def create_vector_store(index_name: str, deployment: str, fields: list | None = None) -> VectorStore:
+    """The vector store the ingestion scripts write the documents of the index to.
+    The local search backend keeps the index in memory and saves it to LOCAL_VECTOR_INDEX_DIR when the script exits."""
+    if get_backend("search") == "local":
+        from chat.local_vector_store import get_local_vector_store
+        return get_local_vector_store(index_name, deployment, create_if_missing=True)
+    return AzureSearch(
+        azure_search_endpoint=str(os.getenv("AZURE_SEARCH_BASE_URL")),
+        azure_search_key=str(os.getenv("AZURE_SEARCH_KEY")),
+        index_name=index_name,
+        embedding_function=create_embeddings(deployment).embed_query,
+        fields=fields,
+    )
+
+def create_azure_search(index_name: str, embedding_function: Callable[[str], List[float]]) -> AzureSearch:
+    """The AzureSearch vector store the retrievers search in"""
+    recorder = get_backend_recorder()
+    if recorder is not None and recorder.replaying:
+        from chat.backend_recording import RecordedSearchClient, ReplayedAzureSearch
+        return ReplayedAzureSearch(RecordedSearchClient(None, index_name, recorder), embedding_function)
+    vector_store = AzureSearch(
+        azure_search_endpoint=str(os.getenv("AZURE_SEARCH_BASE_URL")),
+        azure_search_key=str(os.getenv("AZURE_SEARCH_KEY")),
+        index_name=index_name,
+        embedding_function=embedding_function,
+    )
+    if recorder is not None:
+        from chat.backend_recording import RecordedSearchClient
+        vector_store.client = RecordedSearchClient(vector_store.client, index_name, recorder)
+    return vector_store
+
+def create_search_client(index_name: str, deployment: str) -> SearchClient:
+    recorder = get_backend_recorder()
+    if recorder is not None:
+        from chat.backend_recording import RecordedSearchClient
+        return RecordedSearchClient(None if recorder.replaying else _create_search_client(index_name, deployment), index_name, recorder)
+    return _create_search_client(index_name, deployment)
+
+def _create_search_client(index_name: str, deployment: str) -> SearchClient:
+    if get_backend("search") == "local":
+        from chat.local_backends import InMemorySearchClient
+        from chat.local_vector_store import get_local_vector_store
+        return InMemorySearchClient(get_local_vector_store(index_name, deployment, create_if_missing=True))
+    return SearchClient(str(os.getenv("AZURE_SEARCH_BASE_URL")), index_name, AzureKeyCredential(str(os.getenv("AZURE_SEARCH_KEY"))))
+
+def create_async_search_client(index_name: str, deployment: str) -> AsyncSearchClient:
+    recorder = get_backend_recorder()
+    if recorder is not None:
+        from chat.backend_recording import AsyncRecordedSearchClient
+        return AsyncRecordedSearchClient(None if recorder.replaying else _create_async_search_client(index_name, deployment), index_name, recorder)
+    return _create_async_search_client(index_name, deployment)
+
+def _create_async_search_client(index_name: str, deployment: str) -> AsyncSearchClient:
+    if get_backend("search") == "local":
+        from chat.local_backends import AsyncInMemorySearchClient
+        from chat.local_vector_store import get_local_vector_store
+        return AsyncInMemorySearchClient(get_local_vector_store(index_name, deployment, create_if_missing=True))
+    return AsyncSearchClient(str(os.getenv("AZURE_SEARCH_BASE_URL")), index_name, AzureKeyCredential(str(os.getenv("AZURE_SEARCH_KEY"))))
+
+_local_table_clients: dict = {}
+
+def create_table_client(table_name: str):
+    if get_backend("tables") == "local":
+        from chat.local_backends import InMemoryTableClient
+        #One table per process, like the table in Azure that all clients write to
+        return _local_table_clients.setdefault(table_name, InMemoryTableClient(table_name))
+    credential = AzureNamedKeyCredential(str(os.getenv("AZURE_STORAGE_NAME")), str(os.getenv("AZURE_TABLES_KEY")))
+    table_service_client = TableServiceClient(
+        endpoint=str(os.getenv("AZURE_TABLES_URL")), credential=credential
+    )
+    return table_service_client.get_table_client(table_name=table_name)
+
+def local_partner_keys() -> set:
+    """The partner keys that are valid with the local partner_keys backend, instead of validating them with WeGov"""
+    return {key.strip() for key in os.getenv("LOCAL_PARTNER_KEYS", "local").split(",") if key.strip()}
@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from concurrent.futures import Future
+from typing import Dict, List
+from langchain_core.embeddings import Embeddings
+from chat.backends import create_embeddings, get_backend
+from api.ttl_cache import TTLCache
+from chat.metrics import metrics
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that cache query embeddings in an in-memory LRU and, optionally, in an on-disk sqlite store.
+
+    Entries are keyed on the normalized query text and the deployment name and expire after ttl_seconds.
+    Document embeddings (used while loading the indexes) are never cached.
+    Concurrent requests for a query that is not cached yet share one call to the embeddings.
+    """
+
+    def __init__(self, embeddings: Embeddings, deployment: str, max_size: int = 1024, ttl_seconds: float = 86400, disk_path: str | None = None):
+        self.embeddings = embeddings
+        self.deployment = deployment
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+        self._entries = TTLCache(max_size, ttl_seconds)
+        #Concurrent requests for the same query (like the retrievers of both indexes) share a single embedding call
+        self._in_flight: Dict[str, Future] = {}
+        self._async_in_flight: Dict[str, asyncio.Task] = {}
+        self._disk = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, expires_at REAL, vector BLOB)")
+            self._disk.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is not None:
+            return vector
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                future = self._in_flight[key] = Future()
+        if in_flight is not None:
+            return in_flight.result()
+        try:
+            vector = self._embed_query(text, key)
+            future.set_result(vector)
+            return vector
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is not None:
+            return vector
+        in_flight = self._async_in_flight.get(key)
+        if in_flight is None or in_flight.get_loop() is not asyncio.get_running_loop():
+            in_flight = asyncio.create_task(self._aembed_query(text, key))
+            self._async_in_flight[key] = in_flight
+        #Shielded, so a cancelled request doesn't cancel the embedding other requests are waiting for
+        return await asyncio.shield(in_flight)
+
+    def _embed_query(self, text: str, key: str) -> List[float]:
+        start = time.perf_counter()
+        vector = self.embeddings.embed_query(text)
+        metrics.observe("rag_embedding_duration_seconds", {"deployment": self.deployment}, time.perf_counter() - start)
+        self._set(key, vector)
+        return vector
+
+    async def _aembed_query(self, text: str, key: str) -> List[float]:
+        try:
+            start = time.perf_counter()
+            vector = await self.embeddings.aembed_query(text)
+            metrics.observe("rag_embedding_duration_seconds", {"deployment": self.deployment}, time.perf_counter() - start)
+            self._set(key, vector)
+            return vector
+        finally:
+            if self._async_in_flight.get(key) is asyncio.current_task():
+                del self._async_in_flight[key]
+
+    def stats(self) -> dict:
+        memory_stats = self._entries.stats()
+        return {
+            "deployment": self.deployment,
+            "size": memory_stats["size"],
+            "hits": memory_stats["hits"],
+            "disk_hits": self.disk_hits,
+            "misses": memory_stats["misses"] - self.disk_hits,
+        }
+
+    def _key(self, text: str) -> str:
+        normalized_text = re.sub(r"\s+", " ", text).strip()
+        return hashlib.sha256(f"{self.deployment}\n{normalized_text}".encode("utf-8")).hexdigest()
+
+    def _get(self, key: str) -> List[float] | None:
+        vector = self._entries.get(key)
+        if vector is not None or self._disk is None:
+            return vector
+
+        now = time.time()
+        with self._lock:
+            row = self._disk.execute("SELECT expires_at, vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] <= now:
+            return None
+        vector = array("f", row[1]).tolist()
+        self._entries.set(key, vector, ttl_seconds=row[0] - now)
+        with self._lock:
+            self.disk_hits += 1
+        return vector
+
+    def _set(self, key: str, vector: List[float]):
+        self._entries.set(key, vector)
+        if self._disk is not None:
+            with self._lock:
+                self._disk.execute("INSERT OR REPLACE INTO embeddings (key, expires_at, vector) VALUES (?, ?, ?)", (key, time.time() + self.ttl_seconds, array("f", vector).tobytes()))
+                self._disk.commit()
+
+
+_cached_embeddings: Dict[str, CachedEmbeddings] = {}
+_cached_embeddings_lock = threading.Lock()
+
+def get_cached_embeddings(deployment: str) -> CachedEmbeddings:
+    """Return the process-wide cached embeddings for the deployment"""
+    with _cached_embeddings_lock:
+        if deployment not in _cached_embeddings:
+            _cached_embeddings[deployment] = CachedEmbeddings(
+                create_embeddings(deployment),
+                deployment,
+                max_size=int(os.getenv("EMBEDDING_CACHE_SIZE", "1024")),
+                ttl_seconds=float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "86400")),
+                #Local embeddings are not stored on disk, they must never be served for the real deployment
+                disk_path=(os.getenv("EMBEDDING_CACHE_PATH") or None) if get_backend("embeddings") == "azure" else None,
+            )
+        return _cached_embeddings[deployment]
+
+def get_embedding_cache_stats() -> List[dict]:
+    with _cached_embeddings_lock:
+        return [cached_embeddings.stats() for cached_embeddings in _cached_embeddings.values()]
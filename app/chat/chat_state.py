@@ -1,9 +1,43 @@
-from typing import List
+from __future__ import annotations
+from contextvars import Context, ContextVar, copy_context
+from typing import List, Tuple
 from langchain_core.documents import Document
 
 class ChatState:
-    chain_id: str = ""
-    question: str = ""
-    answer: str = ""
-    prompt: str = ""
-    documents: List[Document] = []
\ No newline at end of file
+    """State of one chat request.
+
+    The current state is kept in a context variable, so every request and every async task sees its own state.
+    Threads started with a copy of the context (like the executors of langchain) share the state of their request.
+    """
+
+    def __init__(self, question: str = "", chain_id: str = ""):
+        self.chain_id = chain_id
+        self.question = question
+        self.answer = ""
+        self.prompt = ""
+        self.documents: List[Document] = []
+
+    @classmethod
+    def start(cls, question: str, chain_id: str) -> ChatState:
+        """Start a new state for the chat request running in the current context"""
+        state = cls(question, chain_id)
+        _current_chat_state.set(state)
+        return state
+
+    @classmethod
+    def fork(cls) -> Tuple[Context, ChatState]:
+        """A copy of the current context with a new state for the same request, for work whose results may be discarded"""
+        current = cls.current()
+        context = copy_context()
+        return context, context.run(cls.start, current.question, current.chain_id)
+
+    @classmethod
+    def current(cls) -> ChatState:
+        state = _current_chat_state.get(None)
+        if state is None:
+            state = cls()
+            _current_chat_state.set(state)
+        return state
+
+
+_current_chat_state: ContextVar[ChatState] = ContextVar("chat_state")
@@ -0,0 +1,118 @@
+import hashlib
+import os
+from typing import Dict, List, Sequence, Tuple
+import numpy as np
+from langchain.retrievers import ContextualCompressionRetriever
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import BaseDocumentCompressor, Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from api.ttl_cache import TTLCache
+from chat.context_packer import SENTENCE_END, split_source_tags
+
+#The embeddings of the sentences of the retrieved documents, the same documents are retrieved for many questions
+_sentence_embeddings = TTLCache(int(os.getenv("COMPRESSION_SENTENCE_CACHE_SIZE", "5000")), float(os.getenv("COMPRESSION_SENTENCE_CACHE_TTL_SECONDS", "86400")))
+
+class ExtractiveCompressor(BaseDocumentCompressor):
+    """Keeps the sentences of the long documents that are most similar to the query, without calling the LLM.
+
+    The sentences are scored on the cosine similarity of their embedding with the embedding of the query.
+    The max_sentences best sentences are kept in their original order, with the <bronN> source tags and date of the document.
+    """
+
+    embeddings: Embeddings
+    """The embeddings of the retriever, the query embedding is then served from its cache"""
+    max_sentences: int = 5
+    """Number of sentences to keep per document"""
+    min_characters: int = 1500
+    """Documents shorter than this are kept as they are"""
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def compress_documents(self, documents: Sequence[Document], query: str, callbacks: Callbacks | None = None) -> Sequence[Document]:
+        sentences = self._sentences(documents)
+        if not any(sentences):
+            return documents
+        embeddings, missing = self._cached_embeddings(sentences)
+        if missing:
+            embeddings.update(self._cache_embeddings(missing, self.embeddings.embed_documents(missing)))
+        return self._compress(documents, sentences, self.embeddings.embed_query(query), embeddings)
+
+    async def acompress_documents(self, documents: Sequence[Document], query: str, callbacks: Callbacks | None = None) -> Sequence[Document]:
+        sentences = self._sentences(documents)
+        if not any(sentences):
+            return documents
+        embeddings, missing = self._cached_embeddings(sentences)
+        if missing:
+            embeddings.update(self._cache_embeddings(missing, await self.embeddings.aembed_documents(missing)))
+        return self._compress(documents, sentences, await self.embeddings.aembed_query(query), embeddings)
+
+    def _sentences(self, documents: Sequence[Document]) -> List[List[str]]:
+        """The sentences of the documents to compress, an empty list for the documents that are kept as they are"""
+        sentences = []
+        for document in documents:
+            _, text, _ = split_source_tags(document.page_content)
+            document_sentences = [sentence.strip() for sentence in SENTENCE_END.split(text) if sentence.strip()]
+            sentences.append(document_sentences if len(text) >= self.min_characters and len(document_sentences) > self.max_sentences else [])
+        return sentences
+
+    def _cached_embeddings(self, sentences: List[List[str]]) -> Tuple[Dict[str, np.ndarray], List[str]]:
+        """The cached embeddings of the sentences and the sentences that still have to be embedded"""
+        embeddings = {}
+        for sentence in {sentence for document_sentences in sentences for sentence in document_sentences}:
+            embedding = _sentence_embeddings.get(self._key(sentence))
+            if embedding is not None:
+                embeddings[sentence] = embedding
+        missing = sorted({sentence for document_sentences in sentences for sentence in document_sentences} - embeddings.keys())
+        return embeddings, missing
+
+    def _cache_embeddings(self, sentences: List[str], embeddings: List[List[float]]) -> Dict[str, np.ndarray]:
+        vectors = {sentence: np.asarray(embedding, dtype=np.float32) for sentence, embedding in zip(sentences, embeddings)}
+        for sentence, vector in vectors.items():
+            _sentence_embeddings.set(self._key(sentence), vector)
+        return vectors
+
+    def _key(self, sentence: str) -> str:
+        deployment = getattr(self.embeddings, "deployment", "")
+        return hashlib.sha256(f"{deployment}\n{sentence}".encode("utf-8")).hexdigest()
+
+    def _compress(self, documents: Sequence[Document], sentences: List[List[str]], query_embedding: List[float], embeddings: Dict[str, np.ndarray]) -> List[Document]:
+        #The cosine similarities of all sentences with the query, in one matrix product
+        sentence_embeddings = np.stack([embeddings[sentence] for document_sentences in sentences for sentence in document_sentences])
+        sentence_embeddings /= np.maximum(np.linalg.norm(sentence_embeddings, axis=1, keepdims=True), 1e-12)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        scores = sentence_embeddings @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        compressed = []
+        offset = 0
+        for document, document_sentences in zip(documents, sentences):
+            if not document_sentences:
+                compressed.append(document)
+                continue
+            document_scores = scores[offset:offset + len(document_sentences)]
+            offset += len(document_sentences)
+            #The best sentences, in the order of the document
+            kept = np.sort(np.argpartition(-document_scores, self.max_sentences - 1)[:self.max_sentences])
+            header, _, footer = split_source_tags(document.page_content)
+            text = "\n".join(document_sentences[i] for i in kept)
+            compressed.append(Document(page_content=header + text + footer, metadata=document.metadata))
+        return compressed
+
+def create_compressor(embeddings: Embeddings) -> ExtractiveCompressor | None:
+    """A compressor that keeps the COMPRESSION_MAX_SENTENCES best sentences of the long documents, None when it is 0"""
+    max_sentences = int(os.getenv("COMPRESSION_MAX_SENTENCES", "5"))
+    if max_sentences <= 0:
+        return None
+    return ExtractiveCompressor(
+        embeddings=embeddings,
+        max_sentences=max_sentences,
+        min_characters=int(os.getenv("COMPRESSION_MIN_CHARACTERS", "1500")),
+    )
+
+def with_compression(retriever: BaseRetriever, embeddings: Embeddings) -> BaseRetriever:
+    """The retriever with the long documents compressed to their COMPRESSION_MAX_SENTENCES best sentences, the retriever itself when it is 0"""
+    compressor = create_compressor(embeddings)
+    if compressor is None:
+        return retriever
+    #The stage is passed to the callbacks, it tells the compression apart from the retrievers it wraps
+    return ContextualCompressionRetriever(base_compressor=compressor, base_retriever=retriever, metadata={"stage": "compress"})
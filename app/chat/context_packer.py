@@ -0,0 +1,106 @@
+import os
+import re
+from functools import lru_cache
+from typing import Callable, List, Tuple
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableLambda
+from chat.metrics import TOKEN_BUCKETS, metrics
+
+#The page content of a retrieved document: the source tag and date added by the retriever around the text of the chunk
+_SOURCE_WRAPPER = re.compile(r"^(<bron\d+>\n[^\n]*\n)(.*)(</bron\d+>\n?)$", re.DOTALL)
+#The end of a sentence or a line
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+#Without the tokenizer files (they are downloaded on first use), tokens are estimated from the number of characters
+CHARACTERS_PER_TOKEN = 4
+
+def split_source_tags(page_content: str) -> Tuple[str, str, str]:
+    """The source tag and date header, the text and the closing source tag of the page content of a retrieved document"""
+    match = _SOURCE_WRAPPER.match(page_content)
+    return match.groups() if match else ("", page_content, "")
+
+@lru_cache(maxsize=8)
+def get_token_counter(encoding_name: str) -> Callable[[str], int]:
+    """Count the tokens of a text with the tiktoken encoding of the chat deployment"""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding(encoding_name)
+    except Exception:
+        return lambda text: (len(text) + CHARACTERS_PER_TOKEN - 1) // CHARACTERS_PER_TOKEN
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+class ContextPacker:
+    """Packs the retrieved documents in a token budget for the prompt.
+
+    The documents are taken in the order of the retriever (the most relevant first) until the budget is full.
+    Documents that are longer than max_tokens_per_document, or than what is left of the budget, are cut at a sentence boundary.
+    Documents that don't get min_tokens_per_document are left out.
+    """
+
+    def __init__(self, max_tokens: int, max_tokens_per_document: int | None = None, min_tokens_per_document: int = 50, encoding_name: str = "o200k_base"):
+        self.max_tokens = max_tokens
+        self.max_tokens_per_document = max_tokens_per_document
+        self.min_tokens_per_document = min_tokens_per_document
+        self.count_tokens = get_token_counter(encoding_name)
+
+    def pack(self, documents: List[Document]) -> List[Document]:
+        packed = []
+        remaining = self.max_tokens
+        total_tokens = 0
+        for document in documents:
+            tokens = self.count_tokens(document.page_content)
+            total_tokens += tokens
+            budget = min(remaining, self.max_tokens_per_document or remaining)
+            if tokens <= budget:
+                packed.append(document)
+                remaining -= tokens
+                continue
+            if budget < self.min_tokens_per_document:
+                continue
+            trimmed = self.trim(document.page_content, budget)
+            if trimmed is not None:
+                packed.append(Document(page_content=trimmed, metadata=document.metadata))
+                remaining -= self.count_tokens(trimmed)
+        packed_tokens = self.max_tokens - remaining
+        metrics.observe("rag_context_tokens", {"type": "packed"}, packed_tokens, buckets=TOKEN_BUCKETS)
+        metrics.observe("rag_context_tokens", {"type": "saved"}, total_tokens - packed_tokens, buckets=TOKEN_BUCKETS)
+        return packed
+
+    def trim(self, page_content: str, max_tokens: int) -> str | None:
+        """The sentences at the start of the page content that fit in max_tokens, None when not even the first sentence fits"""
+        header, text, footer = split_source_tags(page_content)
+        budget = max_tokens - self.count_tokens(header + footer)
+        ends = [m.start() for m in SENTENCE_END.finditer(text)] + [len(text)]
+        #Binary search for the last sentence end that fits, the token count grows with the length of the text
+        low, high, best = 0, len(ends) - 1, None
+        while low <= high:
+            middle = (low + high) // 2
+            if self.count_tokens(text[:ends[middle]]) <= budget:
+                best = ends[middle]
+                low = middle + 1
+            else:
+                high = middle - 1
+        if not best:
+            return None
+        return header + text[:best] + footer
+
+def create_context_packer() -> ContextPacker | None:
+    """A context packer with a budget of CONTEXT_TOKEN_BUDGET tokens, None when the budget is 0"""
+    max_tokens = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+    if max_tokens <= 0:
+        return None
+    return ContextPacker(
+        max_tokens,
+        max_tokens_per_document=int(os.getenv("CONTEXT_MAX_TOKENS_PER_DOCUMENT", "1500")) or None,
+        encoding_name=os.getenv("CONTEXT_TOKEN_ENCODING", "o200k_base"),
+    )
+
+def with_context_packing(retriever: Runnable) -> Runnable:
+    """The retriever followed by a context packer with a budget of CONTEXT_TOKEN_BUDGET tokens, the retriever itself when the budget is 0"""
+    packer = create_context_packer()
+    if packer is None:
+        return retriever
+    if isinstance(retriever, BaseRetriever):
+        #create_retrieval_chain only passes the input to a retriever, but the whole dict to other runnables
+        retriever = RunnableLambda(lambda x: x["input"]) | retriever
+    return retriever | RunnableLambda(packer.pack).with_config(run_name="pack_context")
@@ -1,20 +1,24 @@
 import os
-from langchain_openai import AzureChatOpenAI
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_community.vectorstores.azuresearch import AzureSearch
-from langchain_openai import AzureOpenAIEmbeddings
+from api.init_services import init_async_search_client, init_local_vector_store, init_vector_store
+from chat.backends import create_chat_model, get_embedding_deployment
+from chat.cached_embeddings import get_cached_embeddings
+from chat.context_compressor import with_compression
+from chat.context_packer import with_context_packing
 from chat.CustomAzureSearchVectorStoreRetriever import CustomAzureSearchVectorStoreRetriever
+from chat.multi_index_retriever import MultiIndexRetriever
+from chat.question_rewriter import create_cached_history_aware_retriever
 from langchain.tools.render import render_text_description
 from datetime import datetime
-from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.chat_history import BaseChatMessageHistory, InMemoryChatMessageHistory
+from langchain_core.runnables import ConfigurableFieldSpec, Runnable
+from functools import lru_cache
 from chat.write_email import generate_email
-from langchain.retrievers import EnsembleRetriever
         
-def create_conversational_rag_chain(
-        system_prompt="""You are an assistant for question-answering tasks. 
+DEFAULT_SYSTEM_PROMPT = """You are an assistant for question-answering tasks. 
                                         
     You can only use the following pieces of retrieved context to answer the question.
                                         
@@ -26,24 +30,61 @@ def create_conversational_rag_chain(
                                         
     You MUST answer in dutch.
                                         
-    The date of today is: """ + str(datetime.now()), 
+    The date of today is: """ + str(datetime.now())
+
+DEFAULT_SCORE_INCREASES_PER_TYPE = {"Syllabi": 0.02, "Rechtspraak": 0.02}
+
+#The chat history of a cached chain is passed per invocation, in config["configurable"]["session_history"]
+SESSION_HISTORY_CONFIG = [
+    ConfigurableFieldSpec(
+        id="session_history",
+        annotation=BaseChatMessageHistory,
+        name="Session history",
+        description="The chat history of this invocation.",
+        default=None,
+        is_shared=True,
+    )
+]
+
+def get_cached_conversational_rag_chain(
+        system_prompt=DEFAULT_SYSTEM_PROMPT,
+        context="CIB-lid",
+        nr_of_docs_to_retrieve=3,
+        score_threshold=0.7,
+        score_increases_per_type=DEFAULT_SCORE_INCREASES_PER_TYPE
+    ) -> RunnableWithMessageHistory:
+    """Return the conversational rag chain for this configuration, it is only built once per configuration.
+    Pass the chat history when invoking it: config={"configurable": {"session_history": history}}"""
+    return _build_cached_conversational_rag_chain(system_prompt, context, nr_of_docs_to_retrieve, score_threshold, tuple(sorted(score_increases_per_type.items())))
+
+#The search clients of the chains are pooled (see create_retriever), an evicted chain leaves no connections open
+@lru_cache(maxsize=32)
+def _build_cached_conversational_rag_chain(system_prompt, context, nr_of_docs_to_retrieve, score_threshold, score_increases_per_type):
+    return create_conversational_rag_chain(
+        system_prompt=system_prompt,
+        context=context,
+        nr_of_docs_to_retrieve=nr_of_docs_to_retrieve,
+        score_threshold=score_threshold,
+        get_session_history=lambda session_history: session_history,
+        score_increases_per_type=dict(score_increases_per_type),
+        history_factory_config=SESSION_HISTORY_CONFIG
+    )
+
+def create_conversational_rag_chain(
+        system_prompt=DEFAULT_SYSTEM_PROMPT, 
         context="CIB-lid", 
         nr_of_docs_to_retrieve=3, 
         score_threshold=0.7, 
         get_session_history=lambda session_id: InMemoryChatMessageHistory(),
-        score_increases_per_type={"Syllabi": 0.02, "Rechtspraak": 0.02}
+        score_increases_per_type=DEFAULT_SCORE_INCREASES_PER_TYPE,
+        history_factory_config=None
     ):   
     # https://python.langchain.com/v0.1/docs/use_cases/question_answering/chat_history/
 
     coman_index_name=str(os.getenv("AZURE_SEARCH_INDEX_NAME"))
     modeldocs_index_name=str(os.getenv("AZURE_SEARCH_MODELDOCS_INDEX_NAME"))
 
-    llm = AzureChatOpenAI(
-        openai_api_version=str(os.getenv("AZURE_OPENAI_API_VERSION")),
-        azure_deployment=str(os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME")),
-    )
-
-    AZURE_SEARCH_KEY = str(os.getenv("AZURE_SEARCH_KEY"))
+    llm = create_chat_model()
 
     def get_filter_for_context(context):
         if context =="CIB-lid":
@@ -67,39 +108,43 @@ def create_conversational_rag_chain(
         ]
     ).with_config()
    
-    embeddings = AzureOpenAIEmbeddings(
-        azure_deployment=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME"),
-    )
-
-    coman_vector_store: AzureSearch = AzureSearch(
-        azure_search_endpoint=str(os.getenv("AZURE_SEARCH_BASE_URL")),
-        azure_search_key=AZURE_SEARCH_KEY,
-        index_name=coman_index_name,
-        embedding_function=embeddings.embed_query
-    )
-
-    modeldocs_vector_store: AzureSearch = AzureSearch(
-        azure_search_endpoint=str(os.getenv("AZURE_SEARCH_BASE_URL")),
-        azure_search_key=AZURE_SEARCH_KEY,
-        index_name=modeldocs_index_name,
-        embedding_function=embeddings.embed_query
-    )
-
-    retriever = CustomAzureSearchVectorStoreRetriever(
-        vectorstore=coman_vector_store,
-        k=nr_of_docs_to_retrieve, 
+    embedding_deployment = get_embedding_deployment()
+    embeddings = get_cached_embeddings(embedding_deployment)
+
+    def create_retriever(index_name, **kwargs):
+        #The index name is passed to the callbacks, to tell the retrievers apart
+        kwargs["metadata"] = {"index_name": index_name}
+        #A local copy of the index is searched in memory, without a round trip to Azure Search
+        local_vector_store = init_local_vector_store(index_name, embedding_deployment)
+        if local_vector_store is not None:
+            return CustomAzureSearchVectorStoreRetriever(vectorstore=local_vector_store, embeddings=embeddings, tags=local_vector_store._get_retriever_tags(), **kwargs)
+
+        #The clients are pooled, they are shared by all chains and closed when the app shuts down
+        vector_store = init_vector_store(index_name, embedding_deployment)
+        return CustomAzureSearchVectorStoreRetriever(
+            vectorstore=vector_store,
+            tags=vector_store._get_retriever_tags(),
+            async_client=init_async_search_client(index_name),
+            embeddings=embeddings,
+            **kwargs
+        )
+
+    #Up to nr_of_docs_to_retrieve docs per index, the best ones of both indexes are kept
+    fused_k = nr_of_docs_to_retrieve * 2
+
+    retriever = create_retriever(
+        coman_index_name,
+        k=fused_k, 
         filters=get_filter_for_context(context), 
-        tags=coman_vector_store._get_retriever_tags(),
         search_type="similarity_score_threshold",
         score_threshold=score_threshold,
         score_increase_per_type=score_increases_per_type
     )
 
-    modeldocs_retriever = CustomAzureSearchVectorStoreRetriever(
-        vectorstore=modeldocs_vector_store, 
-        k=nr_of_docs_to_retrieve, 
+    modeldocs_retriever = create_retriever(
+        modeldocs_index_name,
+        k=fused_k, 
         filters=get_filter_for_context(context), 
-        tags=coman_vector_store._get_retriever_tags(),
         search_type="similarity_score_threshold",
         score_threshold=score_threshold
     )
@@ -115,10 +160,12 @@ def create_conversational_rag_chain(
 # When a tool is available for a specific task, DO NOT ANSWER THE QUESTION YOURSELF BUT USE THE TOOL INSTEAD AND RETURN ITS RESULT!
 #     """ + system_prompt
 
-    ensemble_retriever = EnsembleRetriever(retrievers=[retriever, modeldocs_retriever], weights=[0.5, 0.5])
+    #When invoked asynchronously, both indexes are queried concurrently and their candidates are fused on their normalized score
+    multi_index_retriever = MultiIndexRetriever(retrievers=[retriever, modeldocs_retriever], weights=[0.5, 0.5], k=fused_k)
 
-    history_aware_retriever = create_history_aware_retriever(
-        llm, ensemble_retriever, contextualize_q_prompt
+    #Only questions that refer to the chat history are rewritten, most turns then make a single LLM call
+    history_aware_retriever = create_cached_history_aware_retriever(
+        llm, with_compression(multi_index_retriever, embeddings), contextualize_q_prompt
     )
 
 
@@ -138,14 +185,20 @@ def create_conversational_rag_chain(
     )
     question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
 
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+    #The documents are packed in a token budget, long pdf pages would otherwise make the prompt unbounded
+    rag_chain = create_retrieval_chain(with_context_packing(history_aware_retriever), question_answer_chain)
 
-    conversational_rag_chain = RunnableWithMessageHistory(
+    conversational_rag_chain = with_session_history(rag_chain, get_session_history, history_factory_config)
+    
+    return conversational_rag_chain
+
+def with_session_history(rag_chain: Runnable, get_session_history, history_factory_config=None) -> RunnableWithMessageHistory:
+    """The rag chain with the question and the answer added to the chat history, the way the conversational rag chain does it"""
+    return RunnableWithMessageHistory(
         rag_chain,
         get_session_history,
         input_messages_key="input",
         history_messages_key="chat_history",
         output_messages_key="answer",
+        **({"history_factory_config": history_factory_config} if history_factory_config else {})
     )
-    
-    return conversational_rag_chain
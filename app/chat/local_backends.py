@@ -0,0 +1,296 @@
+from __future__ import annotations
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Tuple
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_community.vectorstores.azuresearch import FIELDS_CONTENT, FIELDS_CONTENT_VECTOR, FIELDS_ID, FIELDS_METADATA
+from chat.local_vector_store import LocalVectorStore, _relevance_score
+
+# Stand-ins for Azure OpenAI, Azure AI Search and Azure Table Storage that run in process without network,
+# so the api and the ingestion scripts can be run and profiled on a laptop. Select them with the *_BACKEND variables (see backends.py).
+
+class HashEmbeddings(Embeddings):
+    """Deterministic embeddings without a model: every word is hashed to a dimension and a sign.
+    Texts that share words get similar vectors, so searches still return plausible documents."""
+
+    def __init__(self, dimensions: int = 3072, latency_seconds: float = 0.0):
+        self.dimensions = dimensions
+        self.latency_seconds = latency_seconds
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            vector[(digest >> 1) % self.dimensions] += 1.0 if digest & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm > 0 else vector).tolist()
+
+class LocalChatModel(BaseChatModel):
+    """Chat model that answers with a canned response, or echoes the last question when there is none.
+    The latency before the first token and between tokens can be set to mimic a real deployment."""
+
+    response: str | None = None
+    latency_seconds: float = 0.0
+    seconds_per_token: float = 0.0
+    model_name: str = "local"
+
+    @property
+    def _llm_type(self) -> str:
+        return "local-chat"
+
+    def _generate(self, messages: List[BaseMessage], stop: List[str] | None = None, run_manager: CallbackManagerForLLMRun | None = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency_seconds + self.seconds_per_token * len(self._tokens(messages)))
+        return self._chat_result(messages)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: List[str] | None = None, run_manager: AsyncCallbackManagerForLLMRun | None = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency_seconds + self.seconds_per_token * len(self._tokens(messages)))
+        return self._chat_result(messages)
+
+    def _stream(self, messages: List[BaseMessage], stop: List[str] | None = None, run_manager: CallbackManagerForLLMRun | None = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency_seconds)
+        for token in self._tokens(messages):
+            time.sleep(self.seconds_per_token)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: List[str] | None = None, run_manager: AsyncCallbackManagerForLLMRun | None = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency_seconds)
+        for token in self._tokens(messages):
+            await asyncio.sleep(self.seconds_per_token)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    def _answer(self, messages: List[BaseMessage]) -> str:
+        if self.response is not None:
+            return self.response
+        questions = [message.content for message in messages if isinstance(message, HumanMessage)]
+        return str(questions[-1]) if questions else ""
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        return re.findall(r"\s*\S+", self._answer(messages))
+
+    def _chat_result(self, messages: List[BaseMessage]) -> ChatResult:
+        answer = self._answer(messages)
+        prompt_tokens = sum(len(str(message.content).split()) for message in messages)
+        completion_tokens = len(answer.split())
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=answer))],
+            llm_output={
+                "token_usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+                "model_name": self.model_name,
+            },
+        )
+
+class InMemorySearchResults:
+    """Search results with the interface of SearchItemPaged"""
+
+    def __init__(self, results: List[Dict[str, Any]], count: int | None, answers: List[Any] | None = None):
+        self._results = results
+        self._count = count
+        self._answers = answers
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self._results)
+
+    def get_count(self) -> int | None:
+        return self._count
+
+    def get_answers(self) -> List[Any] | None:
+        return self._answers
+
+class AsyncInMemorySearchResults:
+    """Search results with the interface of AsyncSearchItemPaged"""
+
+    def __init__(self, results: List[Dict[str, Any]], count: int | None, answers: List[Any] | None = None):
+        self._results = results
+        self._count = count
+        self._answers = answers
+
+    async def __aiter__(self) -> AsyncIterator[Dict[str, Any]]:
+        for result in self._results:
+            yield result
+
+    async def get_count(self) -> int | None:
+        return self._count
+
+    async def get_answers(self) -> List[Any] | None:
+        return self._answers
+
+class InMemorySearchClient:
+    """Stand-in for the SearchClient of azure-search-documents that searches a LocalVectorStore.
+    Supports the parts of search we use: full text (BM25) and vector queries (fused like hybrid search), filters,
+    order_by, top, skip, select, counts and highlights. The semantic ranker is not available, results have no reranker score."""
+
+    def __init__(self, vector_store: LocalVectorStore):
+        self.vector_store = vector_store
+
+    def search(self, search_text: str | None = None, **kwargs: Any) -> InMemorySearchResults:
+        return InMemorySearchResults(*self._search(search_text, **kwargs))
+
+    def close(self):
+        pass
+
+    def _search(
+            self,
+            search_text: str | None = None,
+            *,
+            filter: str | None = None,
+            order_by: str | List[str] | None = None,
+            top: int | None = None,
+            skip: int | None = None,
+            select: List[str] | None = None,
+            vector_queries: List[Any] | None = None,
+            highlight_fields: str | None = None,
+            highlight_pre_tag: str = "<em>",
+            highlight_post_tag: str = "</em>",
+            **kwargs: Any,
+        ) -> Tuple[List[Dict[str, Any]], int]:
+        store = self.vector_store
+        text = search_text if search_text not in (None, "", "*") else None
+        vector_query = vector_queries[0] if vector_queries else None
+        if vector_query is not None and text is not None:
+            ranking = store._hybrid_ranking(text, vector_query.vector, vector_query.k_nearest_neighbors or 50, filter)
+        elif vector_query is not None:
+            ranking = [(_relevance_score(similarity), row) for similarity, row in store._vector_ranking(vector_query.vector, vector_query.k_nearest_neighbors or 50, filter)]
+        elif text is not None:
+            ranking = store._text_ranking(text, None, filter)
+        else:
+            mask = store._mask(filter)
+            rows = range(len(store)) if mask is None else np.flatnonzero(mask).tolist()
+            ranking = [(1.0, row) for row in rows]
+        ranking = self._order(ranking, order_by)
+        count = len(ranking)
+        skip = skip or 0
+        ranking = ranking[skip:skip + (top if top is not None else 50)]
+        highlight_terms = set(re.findall(r"\w+", text.lower())) if highlight_fields and text else set()
+        results = []
+        for score, row in ranking:
+            result = self._result(row, score, select)
+            if highlight_terms:
+                result["@search.highlights"] = {FIELDS_CONTENT: _highlights(store.contents[row], highlight_terms, highlight_pre_tag, highlight_post_tag)}
+            results.append(result)
+        return results, count
+
+    def _order(self, ranking: List[Tuple[float, int]], order_by: str | List[str] | None) -> List[Tuple[float, int]]:
+        """Sort on the first order_by clause, documents without the field come last"""
+        if not order_by:
+            return ranking
+        clause = order_by.split(",")[0] if isinstance(order_by, str) else order_by[0]
+        field, _, direction = clause.strip().partition(" ")
+        direction = direction.strip().lower()
+        if field == "search.score()":
+            return ranking[::-1] if direction == "asc" else ranking
+        metadatas = self.vector_store.metadatas
+        missing = [item for item in ranking if metadatas[item[1]].get(field) is None]
+        present = [item for item in ranking if metadatas[item[1]].get(field) is not None]
+        present.sort(key=lambda item: metadatas[item[1]][field], reverse=direction == "desc")
+        return present + missing
+
+    def _result(self, row: int, score: float, select: List[str] | None) -> Dict[str, Any]:
+        store = self.vector_store
+        metadata = store.metadatas[row]
+        #Like the documents in the Azure indexes: the metadata as json and also as separate fields
+        document = {**metadata, FIELDS_ID: store.ids[row], FIELDS_CONTENT: store.contents[row], FIELDS_METADATA: json.dumps(metadata)}
+        if select is None:
+            fields = dict(document)
+        else:
+            fields = {key: document.get(key) for key in select if key != FIELDS_CONTENT_VECTOR}
+            if FIELDS_CONTENT_VECTOR in select:
+                fields[FIELDS_CONTENT_VECTOR] = store.storage.vectors(np.array([row]))[0].tolist()
+        return {**fields, "@search.score": score, "@search.reranker_score": None, "@search.highlights": None, "@search.captions": None}
+
+class AsyncInMemorySearchClient(InMemorySearchClient):
+    """Stand-in for the async SearchClient of azure-search-documents"""
+
+    async def search(self, search_text: str | None = None, **kwargs: Any) -> AsyncInMemorySearchResults:
+        return AsyncInMemorySearchResults(*self._search(search_text, **kwargs))
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self) -> AsyncInMemorySearchClient:
+        return self
+
+    async def __aexit__(self, *exc_info: Any):
+        pass
+
+def _highlights(content: str, terms: set, pre_tag: str, post_tag: str, fragment_size: int = 200) -> List[str]:
+    """The fragments of the content that contain a search term, with the terms between the tags"""
+    fragments = []
+    for start in range(0, len(content), fragment_size):
+        fragment = content[start:start + fragment_size]
+        if any(word.lower() in terms for word in re.findall(r"\w+", fragment)):
+            fragments.append(re.sub(r"\w+", lambda match: f"{pre_tag}{match.group()}{post_tag}" if match.group().lower() in terms else match.group(), fragment))
+        if len(fragments) == 5:
+            break
+    return fragments
+
+class InMemoryTableClient:
+    """Stand-in for the TableClient of azure-data-tables, entities are kept in memory by partition and row key"""
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self._entities: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def create_entity(self, entity: Dict[str, Any]) -> Dict[str, Any]:
+        key = (entity["PartitionKey"], entity["RowKey"])
+        with self._lock:
+            if key in self._entities:
+                raise ValueError(f"The entity {key} already exists in table {self.table_name}")
+            self._entities[key] = dict(entity)
+        return {}
+
+    def upsert_entity(self, entity: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
+        with self._lock:
+            self._entities[(entity["PartitionKey"], entity["RowKey"])] = dict(entity)
+        return {}
+
+    def submit_transaction(self, operations: List[Tuple[str, Dict[str, Any]]], **kwargs: Any) -> List[Dict[str, Any]]:
+        for operation, entity in operations:
+            if operation == "create":
+                self.create_entity(entity)
+            elif operation == "upsert":
+                self.upsert_entity(entity)
+            elif operation == "delete":
+                with self._lock:
+                    self._entities.pop((entity["PartitionKey"], entity["RowKey"]), None)
+            else:
+                raise ValueError(f"Unsupported transaction operation {operation!r}")
+        return [{} for _ in operations]
+
+    def list_entities(self, **kwargs: Any) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(entity) for entity in self._entities.values()]
+
+    def close(self):
+        pass
@@ -0,0 +1,521 @@
+from __future__ import annotations
+import atexit
+import heapq
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import uuid
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Literal, Tuple
+import numpy as np
+from azure.search.documents import SearchClient
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from langchain_community.vectorstores.azuresearch import (
+    FIELDS_CONTENT,
+    FIELDS_CONTENT_VECTOR,
+    FIELDS_ID,
+    FIELDS_METADATA,
+)
+from chat.odata_filter import compile_filter
+from chat.cached_embeddings import get_cached_embeddings
+
+StorageType = Literal["float32", "float16", "int8"]
+IndexType = Literal["exact", "graph"]
+
+#Rows are compared with the query in chunks, so int8 and float16 vectors are never converted all at once
+SIMILARITY_CHUNK_SIZE = 4096
+#Azure AI Search fuses the text and vector rankings of a hybrid query with reciprocal rank fusion, with this constant
+RRF_K = 60
+#Number of results per ranking that take part in the fusion of a hybrid query
+HYBRID_CANDIDATES = 50
+#Azure AI Search returns at most 1000 documents per request
+SYNC_PAGE_SIZE = 1000
+#Every nth vector is an entry point of the graph, a search starts from the entry points most similar to the query
+GRAPH_ENTRY_POINT_STRIDE = 64
+
+class VectorStorage:
+    """Normalized vectors stored as float32, float16 or int8 (with a scale per vector).
+
+    Similarities are cosine similarities: the dot product of the normalized vectors."""
+
+    def __init__(self, storage_type: StorageType = "float32"):
+        self.storage_type = storage_type
+        self.size = 0
+        self._data: np.ndarray | None = None
+        self._scales = np.empty(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms > 0, norms, 1)
+        if self.storage_type == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            data = np.round(vectors / scales[:, None]).astype(np.int8)
+        else:
+            scales = np.ones(len(vectors), dtype=np.float32)
+            data = vectors.astype(self.storage_type)
+        self._reserve(self.size + len(vectors), vectors.shape[1])
+        self._data[self.size:self.size + len(vectors)] = data
+        self._scales[self.size:self.size + len(vectors)] = scales
+        self.size += len(vectors)
+
+    def similarities(self, query: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """Cosine similarities of the normalized query with all rows, or with the given rows"""
+        if rows is not None:
+            return (self._data[rows].astype(np.float32) @ query) * self._scales[rows]
+        similarities = np.empty(self.size, dtype=np.float32)
+        for start in range(0, self.size, SIMILARITY_CHUNK_SIZE):
+            end = min(start + SIMILARITY_CHUNK_SIZE, self.size)
+            similarities[start:end] = (self._data[start:end].astype(np.float32) @ query) * self._scales[start:end]
+        return similarities
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        return self._data[rows].astype(np.float32) * self._scales[rows, None]
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {"vectors": self._data[:self.size], "scales": self._scales[:self.size]}
+
+    @classmethod
+    def from_arrays(cls, storage_type: StorageType, vectors: np.ndarray, scales: np.ndarray) -> VectorStorage:
+        storage = cls(storage_type)
+        storage._data = vectors
+        storage._scales = scales
+        storage.size = len(vectors)
+        return storage
+
+    def _reserve(self, size: int, dimensions: int):
+        #The capacity doubles, so adding documents in batches doesn't copy all vectors on every batch
+        if self._data is not None and size <= len(self._data):
+            return
+        capacity = max(size, 2 * (len(self._data) if self._data is not None else 0), 1024)
+        data = np.empty((capacity, dimensions), dtype=self.storage_type)
+        scales = np.empty(capacity, dtype=np.float32)
+        if self._data is not None:
+            data[:self.size] = self._data[:self.size]
+            scales[:self.size] = self._scales[:self.size]
+        self._data = data
+        self._scales = scales
+
+class GraphIndex:
+    """Navigable small world graph for approximate nearest neighbour search.
+
+    Every vector is linked to at most max_neighbors similar vectors. A search walks the graph greedily
+    from the entry points most similar to the query, keeping the ef most similar vectors it has seen.
+    The entry points are spread over the whole graph, so a search doesn't get stuck in one cluster of vectors."""
+
+    def __init__(self, storage: VectorStorage, max_neighbors: int = 32, ef_construction: int = 64):
+        self.storage = storage
+        self.max_neighbors = max_neighbors
+        self.ef_construction = ef_construction
+        self.neighbors = np.full((0, max_neighbors), -1, dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self.neighbors)
+
+    def add_pending(self):
+        """Link the vectors that were added to the storage since the last call"""
+        start = len(self.neighbors)
+        self.neighbors = np.vstack([self.neighbors, np.full((len(self.storage) - start, self.max_neighbors), -1, dtype=np.int32)])
+        for node in range(start, len(self.storage)):
+            self._link(node)
+
+    def search(self, query: np.ndarray, ef: int) -> List[Tuple[float, int]]:
+        """The ef most similar vectors found, as (similarity, row) with the most similar first"""
+        if len(self.neighbors) == 0:
+            return []
+        return self._search(query, ef, len(self.neighbors))
+
+    def _search(self, query: np.ndarray, ef: int, limit: int) -> List[Tuple[float, int]]:
+        entry_points = np.arange(0, limit, GRAPH_ENTRY_POINT_STRIDE)
+        entry_similarities = self.storage.similarities(query, entry_points)
+        seeds = np.argsort(-entry_similarities)[:ef]
+        visited = set(entry_points.tolist())
+        candidates = [(-float(entry_similarities[seed]), int(entry_points[seed])) for seed in seeds]
+        heapq.heapify(candidates)
+        best = [(-negative_similarity, node) for negative_similarity, node in candidates]
+        heapq.heapify(best)
+        while candidates:
+            negative_similarity, node = heapq.heappop(candidates)
+            if len(best) >= ef and -negative_similarity < best[0][0]:
+                break
+            neighbors = [neighbor for neighbor in self.neighbors[node] if 0 <= neighbor < limit and neighbor not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for similarity, neighbor in zip(self.storage.similarities(query, np.array(neighbors)).tolist(), neighbors):
+                if len(best) < ef or similarity > best[0][0]:
+                    heapq.heappush(candidates, (-similarity, neighbor))
+                    heapq.heappush(best, (similarity, neighbor))
+                    if len(best) > ef:
+                        heapq.heappop(best)
+        return sorted(best, reverse=True)
+
+    def _link(self, node: int):
+        if node == 0:
+            return
+        vector = self.storage.vectors(np.array([node]))[0]
+        nearest = self._select_neighbors(vector, [neighbor for _, neighbor in self._search(vector, self.ef_construction, node)])
+        self.neighbors[node, :len(nearest)] = nearest
+        for neighbor in nearest:
+            links = self.neighbors[neighbor]
+            free = np.flatnonzero(links < 0)
+            if len(free):
+                links[free[0]] = node
+                continue
+            selected = self._select_neighbors(self.storage.vectors(np.array([neighbor]))[0], links.tolist() + [node])
+            links[:] = -1
+            links[:len(selected)] = selected
+
+    def _select_neighbors(self, vector: np.ndarray, candidates: List[int]) -> List[int]:
+        """Select the links of a vector like HNSW does: a candidate is preferred when it is more similar to the vector
+        than to the candidates selected before it. This keeps links to other clusters, the remaining slots are filled
+        with the most similar of the other candidates."""
+        candidate_vectors = self.storage.vectors(np.array(candidates))
+        similarities = candidate_vectors @ vector
+        selected: List[int] = []
+        skipped: List[int] = []
+        for i in np.argsort(-similarities).tolist():
+            if selected and (candidate_vectors[selected] @ candidate_vectors[i]).max() > similarities[i]:
+                skipped.append(i)
+            else:
+                selected.append(i)
+                if len(selected) == self.max_neighbors:
+                    break
+        return [candidates[i] for i in (selected + skipped)[:self.max_neighbors]]
+
+class LocalVectorStore(VectorStore):
+    """In-process copy of an Azure AI Search index, with the same search methods and filters as AzureSearch.
+
+    Vectors are searched exactly with NumPy or approximately with a graph index, and can be stored as int8 or float16
+    to save memory. Hybrid searches fuse a BM25 text ranking with the vector ranking, like Azure AI Search.
+    Scores are on the scale of Azure AI Search, so the same score thresholds can be used.
+    The store is filled with sync_from_search_client and can be saved to and loaded from a file."""
+
+    def __init__(
+            self,
+            embedding_function: Callable[[str], List[float]] | Embeddings,
+            storage_type: StorageType = "float32",
+            index_type: IndexType = "exact",
+            ef_search: int = 64,
+        ):
+        if isinstance(embedding_function, Embeddings):
+            self.embedding_function = embedding_function
+            self.embed_query = embedding_function.embed_query
+        else:
+            self.embedding_function = embedding_function
+            self.embed_query = embedding_function
+        self.semantic_configuration_name = None
+        self.index_type = index_type
+        self.ef_search = ef_search
+        self.storage = VectorStorage(storage_type)
+        self.graph = GraphIndex(self.storage) if index_type == "graph" else None
+        self.ids: List[str] = []
+        self.contents: List[str] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._masks: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._text_index: _TextIndex | None = None
+        self.modified = False
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def embeddings(self) -> Embeddings | None:
+        return self.embedding_function if isinstance(self.embedding_function, Embeddings) else None
+
+    def add_texts(self, texts: Iterable[str], metadatas: List[dict] | None = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if isinstance(self.embedding_function, Embeddings):
+            vectors = self.embedding_function.embed_documents(texts)
+        else:
+            vectors = [self.embedding_function(text) for text in texts]
+        ids = kwargs.get("ids") or [str(uuid.uuid4()) for _ in texts]
+        self.add_vectors(ids, texts, vectors, metadatas or [{} for _ in texts])
+        return ids
+
+    def add_vectors(self, ids: List[str], contents: List[str], vectors: List[List[float]], metadatas: List[Dict[str, Any]]):
+        if not ids:
+            return
+        with self._lock:
+            self.storage.add(np.asarray(vectors, dtype=np.float32))
+            self.ids.extend(ids)
+            self.contents.extend(contents)
+            self.metadatas.extend(metadatas)
+            if self.graph is not None:
+                self.graph.add_pending()
+            self._masks.clear()
+            self._text_index = None
+            self.modified = True
+
+    def clear(self):
+        with self._lock:
+            self.storage = VectorStorage(self.storage.storage_type)
+            self.graph = GraphIndex(self.storage) if self.graph is not None else None
+            self.ids = []
+            self.contents = []
+            self.metadatas = []
+            self._masks.clear()
+            self._text_index = None
+            self.modified = True
+
+    def sync_from_search_client(self, client: SearchClient, filter: str | None = None) -> int:
+        """Replace the documents of the store with all documents (with their vectors) of the index of the client, returns the number of documents copied.
+        Run it again after an ingestion run to pick up the changes.
+
+        The documents are paged on their id, which has to be sortable: Azure AI Search doesn't keep the order of the results
+        between requests and doesn't skip more than 100000 results."""
+        self.clear()
+        synced = 0
+        last_id = None
+        while True:
+            page_filter = filter if last_id is None else _and_filters(filter, f"{FIELDS_ID} gt '{_quote(last_id)}'")
+            results = client.search(search_text="*", filter=page_filter, order_by=[f"{FIELDS_ID} asc"], select=[FIELDS_ID, FIELDS_CONTENT, FIELDS_CONTENT_VECTOR, FIELDS_METADATA], top=SYNC_PAGE_SIZE)
+            page = list(results)
+            self.add_vectors(
+                [result[FIELDS_ID] for result in page],
+                [result[FIELDS_CONTENT] for result in page],
+                [result[FIELDS_CONTENT_VECTOR] for result in page],
+                [json.loads(result[FIELDS_METADATA]) if result.get(FIELDS_METADATA) else {} for result in page],
+            )
+            synced += len(page)
+            if len(page) < SYNC_PAGE_SIZE:
+                return synced
+            last_id = page[-1][FIELDS_ID]
+
+    def save(self, path: str):
+        arrays = self.storage.arrays()
+        if self.graph is not None:
+            arrays["neighbors"] = self.graph.neighbors
+        documents = json.dumps({"ids": self.ids, "contents": self.contents, "metadatas": self.metadatas, "storage_type": self.storage.storage_type})
+        np.savez(path, documents=np.array(documents), **arrays)
+
+    @classmethod
+    def load(cls, path: str, embedding_function: Callable[[str], List[float]] | Embeddings, index_type: IndexType = "exact", ef_search: int = 64) -> LocalVectorStore:
+        with np.load(path) as arrays:
+            documents = json.loads(str(arrays["documents"]))
+            store = cls(embedding_function, documents["storage_type"], index_type, ef_search)
+            store.storage = VectorStorage.from_arrays(documents["storage_type"], arrays["vectors"], arrays["scales"])
+            store.ids = documents["ids"]
+            store.contents = documents["contents"]
+            store.metadatas = documents["metadatas"]
+            if index_type == "graph":
+                store.graph = GraphIndex(store.storage)
+                if "neighbors" in arrays:
+                    store.graph.neighbors = arrays["neighbors"]
+                store.graph.add_pending()
+        return store
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: List[dict] | None = None, **kwargs: Any) -> LocalVectorStore:
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.hybrid_search(query, k, **kwargs)
+
+    def vector_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.vector_search_with_score(query, k, filters=kwargs.get("filters"))]
+
+    def vector_search_with_score(self, query: str, k: int = 4, filters: str | None = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.vector_search_with_score_by_vector(self.embed_query(query), k, filters)
+
+    def vector_search_with_score_by_vector(self, embedding: List[float], k: int = 4, filters: str | None = None) -> List[Tuple[Document, float]]:
+        return [(self._document(row), _relevance_score(similarity)) for similarity, row in self._vector_ranking(embedding, k, filters)]
+
+    def similarity_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        score_threshold = kwargs.pop("score_threshold", None)
+        results = self.vector_search_with_score(query, k, **kwargs)
+        return results if score_threshold is None else [result for result in results if result[1] >= score_threshold]
+
+    def hybrid_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.hybrid_search_with_score(query, k, filters=kwargs.get("filters"))]
+
+    def hybrid_search_with_score(self, query: str, k: int = 4, filters: str | None = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.hybrid_search_with_score_by_vector(query, self.embed_query(query), k, filters)
+
+    def hybrid_search_with_score_by_vector(self, query: str, embedding: List[float], k: int = 4, filters: str | None = None) -> List[Tuple[Document, float]]:
+        return [(self._document(row), score) for score, row in self._hybrid_ranking(query, embedding, k, filters)]
+
+    def hybrid_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        score_threshold = kwargs.pop("score_threshold", None)
+        results = self.hybrid_search_with_score(query, k, **kwargs)
+        return results if score_threshold is None else [result for result in results if result[1] >= score_threshold]
+
+    def semantic_hybrid_search_with_score_and_rerank(self, query: str, k: int = 4, filters: str | None = None, **kwargs: Any) -> List[Tuple[Document, float, float]]:
+        """The semantic ranker of Azure AI Search is not available locally, this is the hybrid search without it.
+        The hybrid score is also the reranker score and the docs have no captions or answers, the metadata has the same keys as with AzureSearch."""
+        results = []
+        for doc, score in self.hybrid_search_with_score(query, k, filters):
+            doc.metadata.update({"captions": {}, "answers": ""})
+            results.append((doc, score, score))
+        return results
+
+    def _document(self, row: int) -> Document:
+        return Document(page_content=self.contents[row], metadata=dict(self.metadatas[row]))
+
+    def _mask(self, filters: str | None) -> np.ndarray | None:
+        """The documents that match the filter, the masks of the last used filters are kept"""
+        if filters is None or filters.strip() == "":
+            return None
+        with self._lock:
+            if filters in self._masks:
+                self._masks.move_to_end(filters)
+                return self._masks[filters]
+        matches = compile_filter(filters)
+        mask = np.fromiter((matches(metadata) for metadata in self.metadatas), dtype=bool, count=len(self.metadatas))
+        with self._lock:
+            self._masks[filters] = mask
+            while len(self._masks) > 64:
+                self._masks.popitem(last=False)
+        return mask
+
+    def _vector_ranking(self, embedding: List[float], k: int, filters: str | None) -> List[Tuple[float, int]]:
+        """The k most similar documents that match the filter, as (similarity, row) with the most similar first"""
+        if len(self) == 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        mask = self._mask(filters)
+        if self.graph is not None:
+            ranking = self._graph_ranking(query, k, mask)
+            if ranking is not None:
+                return ranking
+        rows = np.flatnonzero(mask) if mask is not None else None
+        similarities = self.storage.similarities(query, rows)
+        if rows is None:
+            rows = np.arange(len(similarities))
+        top = np.argpartition(-similarities, k - 1)[:k] if k < len(similarities) else np.arange(len(similarities))
+        top = top[np.argsort(-similarities[top])]
+        return [(float(similarities[i]), int(rows[i])) for i in top]
+
+    def _graph_ranking(self, query: np.ndarray, k: int, mask: np.ndarray | None) -> List[Tuple[float, int]] | None:
+        """Approximate ranking, None when a selective filter makes an exact search over the matching rows cheaper"""
+        selectivity = 1.0 if mask is None else mask.mean()
+        if selectivity < 0.5:
+            return None
+        ef = math.ceil(max(self.ef_search, k) / selectivity)
+        ranking = [(similarity, row) for similarity, row in self.graph.search(query, ef) if mask is None or mask[row]]
+        return ranking[:k] if len(ranking) >= min(k, int(selectivity * len(self))) else None
+
+    def _text_ranking(self, query: str, k: int | None, filters: str | None) -> List[Tuple[float, int]]:
+        """The k best BM25 matches (all matches when k is None) that match the filter, as (score, row) with the best first"""
+        with self._lock:
+            if self._text_index is None:
+                self._text_index = _TextIndex(self.contents)
+            text_index = self._text_index
+        scores = text_index.scores(query)
+        mask = self._mask(filters)
+        if mask is not None:
+            scores = np.where(mask, scores, 0)
+        matching = np.flatnonzero(scores > 0)
+        top = matching[np.argsort(-scores[matching], kind="stable")[:k]]
+        return [(float(scores[row]), int(row)) for row in top]
+
+    def _hybrid_ranking(self, query: str, embedding: List[float], k: int, filters: str | None) -> List[Tuple[float, int]]:
+        """Reciprocal rank fusion of the BM25 ranking of the query and the vector ranking of the embedding"""
+        candidates = max(k, HYBRID_CANDIDATES)
+        scores: Dict[int, float] = {}
+        for ranking in (self._text_ranking(query, candidates, filters), self._vector_ranking(embedding, candidates, filters)):
+            for rank, (_, row) in enumerate(ranking, start=1):
+                scores[row] = scores.get(row, 0.0) + 1 / (RRF_K + rank)
+        fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(score, row) for row, score in fused]
+
+class _TextIndex:
+    """Inverted index with BM25 scoring, the default similarity of Azure AI Search"""
+
+    def __init__(self, contents: List[str], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.size = len(contents)
+        self.lengths = np.zeros(self.size, dtype=np.float32)
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        for row, content in enumerate(contents):
+            terms = Counter(_tokenize(content))
+            self.lengths[row] = sum(terms.values())
+            for term, frequency in terms.items():
+                rows, frequencies = postings.setdefault(term, ([], []))
+                rows.append(row)
+                frequencies.append(frequency)
+        self.postings = {term: (np.array(rows, dtype=np.int32), np.array(frequencies, dtype=np.float32)) for term, (rows, frequencies) in postings.items()}
+        self.average_length = float(self.lengths.mean()) if self.size else 0.0
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(_tokenize(query)):
+            if term not in self.postings:
+                continue
+            rows, frequencies = self.postings[term]
+            idf = math.log(1 + (self.size - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[rows] / (self.average_length or 1))
+            scores[rows] += idf * frequencies * (self.k1 + 1) / (frequencies + norm)
+        return scores
+
+def _tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+def _quote(value: str) -> str:
+    return value.replace("'", "''")
+
+def _and_filters(*filters: str | None) -> str:
+    return " and ".join(f"({filter})" for filter in filters if filter)
+
+def _relevance_score(similarity: float) -> float:
+    """Azure AI Search scores cosine similarity as 1 / (1 + cosine distance)"""
+    #Quantized vectors can be slightly more than perfectly similar
+    return 1 / (2 - min(similarity, 1.0))
+
+
+_local_stores: Dict[Tuple[str, str], LocalVectorStore | None] = {}
+_local_store_paths: Dict[Tuple[str, str], str] = {}
+_local_stores_lock = threading.Lock()
+
+#Where the indexes of the local search backend are kept when LOCAL_VECTOR_INDEX_DIR is not set
+DEFAULT_LOCAL_VECTOR_INDEX_DIR = os.path.join(tempfile.gettempdir(), "modelgpt4o-local-vector-index")
+
+def local_vector_index_path(index_name: str) -> str | None:
+    directory = os.getenv("LOCAL_VECTOR_INDEX_DIR")
+    return os.path.join(directory, f"{index_name}.npz") if directory else None
+
+def get_local_vector_store(index_name: str, deployment: str, create_if_missing: bool = False) -> LocalVectorStore | None:
+    """Return the local copy of the index, loaded once per process.
+    None when LOCAL_VECTOR_INDEX_DIR is not set or the index was not synced to it (see sync-local-vector-index.py),
+    unless create_if_missing: then an empty store is created, that is saved when the process exits if documents were added to it."""
+    key = (index_name, deployment)
+    with _local_stores_lock:
+        if key not in _local_stores or (_local_stores[key] is None and create_if_missing):
+            path = local_vector_index_path(index_name)
+            if path is None and create_if_missing:
+                path = os.path.join(DEFAULT_LOCAL_VECTOR_INDEX_DIR, f"{index_name}.npz")
+            store = None
+            if path is not None and os.path.exists(path):
+                store = LocalVectorStore.load(path, get_cached_embeddings(deployment), index_type=os.getenv("LOCAL_VECTOR_INDEX_TYPE", "exact"))
+            elif create_if_missing:
+                store = LocalVectorStore(
+                    get_cached_embeddings(deployment),
+                    storage_type=os.getenv("LOCAL_VECTOR_INDEX_STORAGE_TYPE", "float32"),
+                    index_type=os.getenv("LOCAL_VECTOR_INDEX_TYPE", "exact"),
+                )
+            _local_stores[key] = store
+            if store is not None:
+                _local_store_paths[key] = path
+        return _local_stores[key]
+
+@atexit.register
+def _save_modified_local_stores():
+    with _local_stores_lock:
+        for key, store in _local_stores.items():
+            if store is not None and store.modified:
+                os.makedirs(os.path.dirname(_local_store_paths[key]), exist_ok=True)
+                store.save(_local_store_paths[key])
@@ -0,0 +1,239 @@
+import bisect
+import threading
+import time
+from typing import Any, Dict, List, Literal, Tuple
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+MetricType = Literal["counter", "gauge", "histogram"]
+
+#The default buckets of the Prometheus clients, extended for slow LLM calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (0, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+DESCRIPTIONS: Dict[str, Tuple[MetricType, str]] = {
+    "rag_request_duration_seconds": ("histogram", "Duration of a chain run, from the question to the full answer"),
+    "rag_stage_duration_seconds": ("histogram", "Duration of a stage of the chain: retrieve (per index, an empty index is the fusion of the indexes), compress (the compression of the documents, in the chat chain together with their retrieval), rewrite (the question with the chat history) or answer"),
+    "rag_first_token_seconds": ("histogram", "Time from the start of an LLM call to its first streamed token"),
+    "rag_stage_errors_total": ("counter", "Stages of the chain that raised an error"),
+    "rag_llm_tokens_total": ("counter", "Prompt and completion tokens of the LLM calls, streamed completions count one token per chunk"),
+    "rag_question_rewrites_total": ("counter", "Questions with chat history: rewritten by the LLM, served from the rewrite cache or skipped because they don't refer to the history"),
+    "rag_speculative_retrievals_total": ("counter", "Retrievals of the original question during its rewrite: used when the rewrite is similar, otherwise discarded"),
+    "rag_retrieved_documents_total": ("counter", "Documents returned by the retrievers: the candidates above the score threshold per index, an empty index is the fusion of the indexes"),
+    "rag_embedding_duration_seconds": ("histogram", "Duration of the query embedding calls that missed the embedding cache"),
+    "rag_context_tokens": ("histogram", "Tokens of the retrieved documents per request: packed in the prompt and saved by the context packer"),
+    "rag_cache_size": ("gauge", "Number of entries in a cache"),
+    "rag_cache_hits_total": ("counter", "Lookups that were served from a cache"),
+    "rag_cache_misses_total": ("counter", "Lookups that missed a cache"),
+}
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and histograms, rendered in the Prometheus text format"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+        self._histograms: Dict[str, Dict[Tuple[Tuple[str, str], ...], _Histogram]] = {}
+
+    def inc(self, name: str, labels: Dict[str, Any], value: float = 1.0):
+        key = _labels_key(labels)
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0.0) + value
+
+    def set(self, name: str, labels: Dict[str, Any], value: float):
+        """Set a value, for the counters and gauges that are kept elsewhere (like the hits of the caches)"""
+        with self._lock:
+            self._values.setdefault(name, {})[_labels_key(labels)] = value
+
+    def observe(self, name: str, labels: Dict[str, Any], value: float, buckets: Tuple[float, ...] | None = None):
+        key = _labels_key(labels)
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            if key not in histograms:
+                histograms[key] = _Histogram(buckets or self.buckets)
+            histograms[key].observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted(self._values.keys() | self._histograms.keys()):
+                metric_type, description = DESCRIPTIONS.get(name, ("histogram" if name in self._histograms else "gauge", ""))
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for key, value in sorted(self._values.get(name, {}).items()):
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+                for key, histogram in sorted(self._histograms.get(name, {}).items()):
+                    cumulative = 0
+                    for bucket, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', _format_value(bucket)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {_format_value(histogram.sum)}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+def _labels_key(labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, "" if value is None else str(value)) for name, value in labels.items()))
+
+def _format_labels(key: Tuple[Tuple[str, str], ...]) -> str:
+    if not key:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+#The metrics of the process, exported by the /api/metrics endpoint
+metrics = Metrics()
+
+def set_cache_metrics(cache: str, stats: dict, **labels: Any):
+    """Export the stats of one of the caches (a dict with size, hits and misses)"""
+    metrics.set("rag_cache_size", {"cache": cache, **labels}, stats.get("size", 0))
+    metrics.set("rag_cache_hits_total", {"cache": cache, **labels}, stats.get("hits", 0))
+    metrics.set("rag_cache_misses_total", {"cache": cache, **labels}, stats.get("misses", 0))
+
+class MetricsHandler(BaseCallbackHandler):
+    """Records the duration, tokens and documents of the stages of one chain run in the metrics.
+
+    An LLM call inside the retrieval step of the chain (named retrieve_documents by create_retrieval_chain) rewrites
+    the question with the chat history, the other LLM calls answer it.
+    The retrievers are told apart by the index_name in their metadata.
+    """
+
+    #Measured where they happen, not when an executor gets to them
+    run_inline = True
+
+    def __init__(self, endpoint: str, metrics: Metrics = metrics):
+        self.endpoint = endpoint
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._names: Dict[UUID, str] = {}
+        self._parents: Dict[UUID, UUID | None] = {}
+        self._started: Dict[UUID, dict] = {}
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Any, *, run_id: UUID, parent_run_id: UUID | None = None, metadata: Dict[str, Any] | None = None, **kwargs: Any):
+        with self._lock:
+            self._names[run_id] = kwargs.get("name") or ""
+            self._parents[run_id] = parent_run_id
+            if parent_run_id is None:
+                self._started[run_id] = {"stage": None, "start": time.perf_counter()}
+            elif (metadata or {}).get("stage"):
+                #A step of the chain that is a stage of its own, like the compression of the documents for the prompt
+                self._started[run_id] = {"stage": metadata["stage"], "start": time.perf_counter()}
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any):
+        started = self._started.get(run_id)
+        if started is not None and started["stage"] is not None:
+            self._end_stage(run_id)
+            return
+        started = self._end(run_id)
+        if started is not None:
+            self.metrics.observe("rag_request_duration_seconds", {"endpoint": self.endpoint}, time.perf_counter() - started["start"])
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        started = self._started.get(run_id)
+        if started is not None and started["stage"] is not None:
+            self._stage_error(run_id)
+            return
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized: Dict[str, Any], query: str, *, run_id: UUID, parent_run_id: UUID | None = None, metadata: Dict[str, Any] | None = None, **kwargs: Any):
+        metadata = metadata or {}
+        self._start(run_id, parent_run_id, metadata.get("stage", "retrieve"), index=metadata.get("index_name", ""))
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any):
+        started = self._end_stage(run_id)
+        if started is not None and started["stage"] == "retrieve":
+            self.metrics.inc("rag_retrieved_documents_total", {"endpoint": self.endpoint, "index": started["index"]}, len(documents))
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._stage_error(run_id)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any):
+        with self._lock:
+            self._parents[run_id] = parent_run_id
+            stage = "rewrite" if self._has_ancestor(run_id, "retrieve_documents") else "answer"
+        self._start(run_id, parent_run_id, stage, chunks=0)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, parent_run_id: UUID | None = None, **kwargs: Any):
+        self.on_chat_model_start(serialized, prompts, run_id=run_id, parent_run_id=parent_run_id, **kwargs)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        with self._lock:
+            started = self._started.get(run_id)
+            if started is None:
+                return
+            started["chunks"] += 1
+            first = started["chunks"] == 1
+        if first:
+            self.metrics.observe("rag_first_token_seconds", {"endpoint": self.endpoint, "stage": started["stage"]}, time.perf_counter() - started["start"])
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        started = self._end_stage(run_id)
+        if started is None:
+            return
+        labels = {"endpoint": self.endpoint, "stage": started["stage"]}
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        if token_usage:
+            self.metrics.inc("rag_llm_tokens_total", {**labels, "type": "prompt"}, token_usage.get("prompt_tokens", 0))
+            self.metrics.inc("rag_llm_tokens_total", {**labels, "type": "completion"}, token_usage.get("completion_tokens", 0))
+        elif started["chunks"]:
+            #Streamed responses don't report their usage, the service streams a chunk per token
+            self.metrics.inc("rag_llm_tokens_total", {**labels, "type": "completion"}, started["chunks"])
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._stage_error(run_id)
+
+    def _start(self, run_id: UUID, parent_run_id: UUID | None, stage: str, **values: Any):
+        with self._lock:
+            self._parents[run_id] = parent_run_id
+            self._started[run_id] = {"stage": stage, "start": time.perf_counter(), **values}
+
+    def _end(self, run_id: UUID) -> dict | None:
+        with self._lock:
+            self._names.pop(run_id, None)
+            self._parents.pop(run_id, None)
+            return self._started.pop(run_id, None)
+
+    def _end_stage(self, run_id: UUID) -> dict | None:
+        started = self._end(run_id)
+        if started is not None:
+            labels = {"endpoint": self.endpoint, "stage": started["stage"], "index": started.get("index", "")}
+            self.metrics.observe("rag_stage_duration_seconds", labels, time.perf_counter() - started["start"])
+        return started
+
+    def _stage_error(self, run_id: UUID):
+        started = self._end(run_id)
+        if started is not None:
+            self.metrics.inc("rag_stage_errors_total", {"endpoint": self.endpoint, "stage": started["stage"], "index": started.get("index", "")})
+
+    def _has_ancestor(self, run_id: UUID, name: str) -> bool:
+        parent = self._parents.get(run_id)
+        while parent is not None:
+            if self._names.get(parent) == name:
+                return True
+            parent = self._parents.get(parent)
+        return False
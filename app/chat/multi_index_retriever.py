@@ -0,0 +1,88 @@
+import asyncio
+from typing import List, Tuple
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManager,
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManager,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.load.dump import dumpd
+from langchain_core.retrievers import BaseRetriever
+from chat.CustomAzureSearchVectorStoreRetriever import CustomAzureSearchVectorStoreRetriever, increased_scores
+
+class MultiIndexRetriever(BaseRetriever):
+    """Retrieves the candidates of all indexes and fuses them on their normalized score, instead of ranking and cutting them per index.
+
+    The scores are increased with the score increase of the type of the docs and normalized to 0-1 (min-max) over the candidates of all indexes,
+    so a weak best hit of one index stays below the strong hits of another. The retrievers use the same search type, their scores are on the same scale.
+    The normalized scores are weighted per index, the docs are deduplicated on their source and chunk number and the k best docs over all indexes are kept.
+    """
+
+    retrievers: List[CustomAzureSearchVectorStoreRetriever]
+    """One retriever per index, their score threshold and score increases are applied to their candidates"""
+    weights: List[float] | None = None
+    """The weight of the normalized scores of every index, equal weights by default"""
+    k: int = 6
+    """Number of documents to return, over all indexes"""
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        candidates = []
+        for retriever in self.retrievers:
+            callback_manager = CallbackManager.configure(run_manager.get_child(), None, local_tags=retriever.tags, local_metadata=retriever.metadata)
+            index_run_manager = callback_manager.on_retriever_start(dumpd(retriever), query)
+            try:
+                index_candidates = retriever.scored_candidates(query)
+            except Exception as e:
+                index_run_manager.on_retriever_error(e)
+                raise
+            index_run_manager.on_retriever_end([doc for doc, _ in index_candidates])
+            candidates.append(index_candidates)
+        return self.select_documents(candidates)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        #The query is embedded once for all indexes
+        embedding = await self.retrievers[0].aembed_query(query) if all(retriever.async_client is not None for retriever in self.retrievers) else None
+        candidates = await asyncio.gather(*[self._aindex_candidates(retriever, query, embedding, run_manager) for retriever in self.retrievers])
+        return self.select_documents(list(candidates))
+
+    async def _aindex_candidates(self, retriever: CustomAzureSearchVectorStoreRetriever, query: str, embedding: List[float] | None, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Tuple[Document, float]]:
+        """The candidates of one index, in a retriever run of its own so the callbacks see the search per index"""
+        callback_manager = AsyncCallbackManager.configure(run_manager.get_child(), None, local_tags=retriever.tags, local_metadata=retriever.metadata)
+        index_run_manager = await callback_manager.on_retriever_start(dumpd(retriever), query)
+        try:
+            candidates = await retriever.ascored_candidates(query, embedding)
+        except Exception as e:
+            await index_run_manager.on_retriever_error(e)
+            raise
+        await index_run_manager.on_retriever_end([doc for doc, _ in candidates])
+        return candidates
+
+    def select_documents(self, candidates: List[List[Tuple[Document, float]]]) -> List[Document]:
+        """The k best docs of the fused candidates of all indexes, sorted on date relevancy and with their date info"""
+        fused = fuse(candidates, [retriever.score_increase_per_type for retriever in self.retrievers], self.weights or [1.0] * len(self.retrievers))
+        #The date sorting and date info are the same for all indexes
+        return self.retrievers[0].select_documents(fused, self.k)
+
+def fuse(candidates: List[List[Tuple[Document, float]]], score_increases: List[dict], weights: List[float]) -> List[Document]:
+    """The candidates of all indexes, sorted on their weighted normalized score and deduplicated on their source and chunk number"""
+    counts = np.array([len(index_candidates) for index_candidates in candidates])
+    results = [result for index_candidates in candidates for result in index_candidates]
+    if not results:
+        return []
+
+    scores = np.concatenate([increased_scores(index_candidates, increases) for index_candidates, increases in zip(candidates, score_increases) if index_candidates])
+    #Min-max normalization over the candidates of all indexes, with a single score (or only equal scores) they all get 1
+    spread = scores.max() - scores.min()
+    normalized = (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+    weighted = normalized * np.repeat(np.asarray(weights, dtype=np.float64), counts)
+
+    order = np.argsort(-weighted, kind="stable")
+    #The best scored result of every source and chunk, docs without a source are never merged
+    keys = np.array([
+        f"{doc.metadata['source']}\0{doc.metadata.get('chunk_number', '')}" if doc.metadata.get('source') else f"\0{i}"
+        for i, (doc, _) in enumerate(results)
+    ])[order]
+    _, first = np.unique(keys, return_index=True)
+    return [results[i][0] for i in order[np.sort(first)]]
@@ -0,0 +1,160 @@
+import re
+from typing import Any, Callable, Dict, List, Tuple
+
+# Evaluates the subset of the OData filter syntax of Azure AI Search that we use in memory:
+#   comparisons (eq, ne, gt, ge, lt, le) of a field with a literal, and, or, not, parentheses,
+#   search.in(field, 'a,b', ',') and collection lambdas like domains/any(domain: search.in(domain, 'a,b', ','))
+
+Predicate = Callable[[Dict[str, Any], Dict[str, Any]], bool]
+
+_TOKEN = re.compile(r"\s*(?:(?P<string>'(?:[^']|'')*')|(?P<number>-?\d+(?:\.\d+)?)|(?P<name>[A-Za-z_][\w.]*)|(?P<punct>[()/:,]))")
+
+_COMPARISONS: Dict[str, Callable[[Any, Any], bool]] = {
+    "eq": lambda a, b: _equals(a, b),
+    "ne": lambda a, b: not _equals(a, b),
+    "gt": lambda a, b: a is not None and a > b,
+    "ge": lambda a, b: a is not None and a >= b,
+    "lt": lambda a, b: a is not None and a < b,
+    "le": lambda a, b: a is not None and a <= b,
+}
+
+def compile_filter(filter: str | None) -> Callable[[Dict[str, Any]], bool]:
+    """Compile the filter to a function that tells whether the metadata of a document matches it"""
+    if filter is None or filter.strip() == "":
+        return lambda metadata: True
+    predicate = _Parser(_tokenize(filter)).parse()
+    return lambda metadata: predicate(metadata, {})
+
+def _equals(a: Any, b: Any) -> bool:
+    #Booleans are stored as strings in some indexes, e.g. is_public eq 'True'
+    if isinstance(a, bool) or isinstance(b, bool):
+        return str(a).lower() == str(b).lower()
+    return a == b
+
+def _tokenize(filter: str) -> List[Tuple[str, Any]]:
+    tokens = []
+    position = 0
+    filter = filter.rstrip()
+    while position < len(filter):
+        match = _TOKEN.match(filter, position)
+        if match is None:
+            raise ValueError(f"Invalid filter at position {position}: {filter}")
+        position = match.end()
+        if match.group("string") is not None:
+            tokens.append(("literal", match.group("string")[1:-1].replace("''", "'")))
+        elif match.group("number") is not None:
+            number = match.group("number")
+            tokens.append(("literal", float(number) if "." in number else int(number)))
+        elif match.group("name") is not None:
+            name = match.group("name")
+            if name in ("true", "false"):
+                tokens.append(("literal", name == "true"))
+            elif name == "null":
+                tokens.append(("literal", None))
+            else:
+                tokens.append(("name", name))
+        else:
+            tokens.append(("punct", match.group("punct")))
+    return tokens
+
+class _Parser:
+    def __init__(self, tokens: List[Tuple[str, Any]]):
+        self.tokens = tokens
+        self.position = 0
+
+    def parse(self) -> Predicate:
+        predicate = self._or()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected {self.tokens[self.position][1]!r} in filter")
+        return predicate
+
+    def _peek(self) -> Tuple[str, Any] | None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _take(self, kind: str, value: Any = None) -> Any:
+        token = self._peek()
+        if token is None or token[0] != kind or (value is not None and token[1] != value):
+            raise ValueError(f"Expected {value or kind} in filter, got {token[1] if token else 'end of filter'!r}")
+        self.position += 1
+        return token[1]
+
+    def _is_next(self, kind: str, value: Any) -> bool:
+        return self._peek() == (kind, value)
+
+    def _or(self) -> Predicate:
+        predicates = [self._and()]
+        while self._is_next("name", "or"):
+            self.position += 1
+            predicates.append(self._and())
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda metadata, variables: any(predicate(metadata, variables) for predicate in predicates)
+
+    def _and(self) -> Predicate:
+        predicates = [self._not()]
+        while self._is_next("name", "and"):
+            self.position += 1
+            predicates.append(self._not())
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda metadata, variables: all(predicate(metadata, variables) for predicate in predicates)
+
+    def _not(self) -> Predicate:
+        if self._is_next("name", "not"):
+            self.position += 1
+            predicate = self._not()
+            return lambda metadata, variables: not predicate(metadata, variables)
+        return self._primary()
+
+    def _primary(self) -> Predicate:
+        if self._is_next("punct", "("):
+            self.position += 1
+            predicate = self._or()
+            self._take("punct", ")")
+            return predicate
+        name = self._take("name")
+        if name == "search.in":
+            return self._search_in()
+        if self._is_next("punct", "/"):
+            return self._any(name)
+        operator = self._take("name")
+        if operator not in _COMPARISONS:
+            raise ValueError(f"Unsupported operator {operator!r} in filter")
+        literal = self._take("literal")
+        compare = _COMPARISONS[operator]
+        return lambda metadata, variables: compare(_value(name, metadata, variables), literal)
+
+    def _search_in(self) -> Predicate:
+        self._take("punct", "(")
+        name = self._take("name")
+        self._take("punct", ",")
+        values = self._take("literal")
+        separator = " ,"
+        if self._is_next("punct", ","):
+            self.position += 1
+            separator = self._take("literal")
+        self._take("punct", ")")
+        allowed = {value for value in re.split("|".join(map(re.escape, separator)), values) if value != ""}
+        return lambda metadata, variables: _value(name, metadata, variables) in allowed
+
+    def _any(self, name: str) -> Predicate:
+        self._take("punct", "/")
+        quantifier = self._take("name")
+        if quantifier not in ("any", "all"):
+            raise ValueError(f"Unsupported collection operator {quantifier!r} in filter")
+        self._take("punct", "(")
+        variable = self._take("name")
+        self._take("punct", ":")
+        predicate = self._or()
+        self._take("punct", ")")
+        combine = any if quantifier == "any" else all
+
+        def matches(metadata: Dict[str, Any], variables: Dict[str, Any]) -> bool:
+            values = _value(name, metadata, variables) or []
+            return combine(predicate(metadata, {**variables, variable: value}) for value in values)
+        return matches
+
+def _value(name: str, metadata: Dict[str, Any], variables: Dict[str, Any]) -> Any:
+    if name in variables:
+        return variables[name]
+    return metadata.get(name)
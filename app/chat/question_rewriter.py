@@ -0,0 +1,217 @@
+import asyncio
+import difflib
+import hashlib
+import os
+import re
+import weakref
+from typing import List, Tuple
+from langchain_core.callbacks import AsyncCallbackManager
+from langchain_core.documents import Document
+from langchain_core.load.dump import dumpd
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.messages import BaseMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from api.ttl_cache import TTLCache
+from chat.chat_state import ChatState
+from chat.metrics import metrics
+
+#Words that refer to an earlier turn of the conversation (Dutch and English).
+#"die", "dat" and "het" are left out, they are mostly relative pronouns, conjunctions and articles.
+REFERENCE_WORDS = {
+    "dit", "deze", "dergelijk", "dergelijke", "zo'n", "zulke", "hetzelfde", "dezelfde", "zelfde",
+    "hij", "zij", "ze", "hem", "haar", "hun", "hen", "ook", "nog", "vorige", "voorgaande", "bovenstaande", "vermelde", "eerder", "eerdere",
+    "it", "its", "this", "that", "these", "those", "they", "them", "their", "he", "she", "him", "her", "also", "too", "same", "previous", "above",
+}
+#Pronominal adverbs like ervan, daarover and hiermee
+PRONOMINAL_ADVERB = re.compile(r"^(er|daar|hier)(aan|achter|bij|door|in|langs|mee|na|naast|om|onder|op|over|tegen|toe|tussen|uit|van|voor)$")
+#Follow-up questions like "En voor huurders?" or "What about tenants?"
+CONTINUATION_START = re.compile(r"^(en|maar|of|ook|dus|wat met|hoe zit het met|and|but|or|so|what about|how about)\b")
+#Questions this short are usually elliptical, they only make sense with the previous turn
+MIN_STANDALONE_WORDS = 5
+
+_WORD = re.compile(r"[\w']+")
+
+def needs_rewrite(question: str, chat_history: List[BaseMessage]) -> bool:
+    """Whether the question may refer to the chat history, so it has to be rewritten to a standalone question"""
+    if not chat_history:
+        return False
+    normalized = question.strip().lower()
+    words = _WORD.findall(normalized)
+    if len(words) < MIN_STANDALONE_WORDS or CONTINUATION_START.match(normalized):
+        return True
+    return any(word in REFERENCE_WORDS or PRONOMINAL_ADVERB.match(word) for word in words)
+
+class QuestionRewriter:
+    """Rewrites the question with the chat history to a standalone question, like the first step of create_history_aware_retriever.
+
+    The LLM is only called for questions that may refer to the history (when use_heuristics is set),
+    and the rewrites are cached on the digest of the history and the question.
+    """
+
+    def __init__(self, llm: BaseLanguageModel, prompt: BasePromptTemplate, cache_size: int = 1000, cache_ttl_seconds: float = 3600, use_heuristics: bool = True):
+        self.rewrite_chain = prompt | llm | StrOutputParser()
+        self.use_heuristics = use_heuristics
+        self._cache = TTLCache(cache_size, cache_ttl_seconds) if cache_size > 0 else None
+
+    def rewrite(self, inputs: dict, config: RunnableConfig) -> str:
+        question, key = self.lookup(inputs)
+        if key is None:
+            return question
+        return self.rewrite_with_llm(inputs, key, config)
+
+    async def arewrite(self, inputs: dict, config: RunnableConfig) -> str:
+        question, key = self.lookup(inputs)
+        if key is None:
+            return question
+        return await self.arewrite_with_llm(inputs, key, config)
+
+    def rewrite_with_llm(self, inputs: dict, key: str, config: RunnableConfig) -> str:
+        """Rewrite the question with the LLM and cache the rewrite with the key of lookup"""
+        rewritten = self.rewrite_chain.invoke(inputs, config)
+        self._store(key, rewritten)
+        return rewritten
+
+    async def arewrite_with_llm(self, inputs: dict, key: str, config: RunnableConfig) -> str:
+        rewritten = await self.rewrite_chain.ainvoke(inputs, config)
+        self._store(key, rewritten)
+        return rewritten
+
+    def stats(self) -> dict:
+        return self._cache.stats() if self._cache is not None else {"size": 0, "hits": 0, "misses": 0}
+
+    def lookup(self, inputs: dict) -> Tuple[str, str | None]:
+        """The standalone question and None when it is known without calling the LLM, otherwise the key to cache the rewrite with"""
+        question = inputs["input"]
+        chat_history = inputs.get("chat_history") or []
+        if not chat_history:
+            return question, None
+        if self.use_heuristics and not needs_rewrite(question, chat_history):
+            metrics.inc("rag_question_rewrites_total", {"outcome": "skipped"})
+            return question, None
+        key = _digest(chat_history, question)
+        rewritten = self._cache.get(key) if self._cache is not None else None
+        if rewritten is not None:
+            metrics.inc("rag_question_rewrites_total", {"outcome": "cached"})
+            return rewritten, None
+        metrics.inc("rag_question_rewrites_total", {"outcome": "llm"})
+        return question, key
+
+    def _store(self, key: str, rewritten: str):
+        if self._cache is not None:
+            self._cache.set(key, rewritten)
+
+def _digest(chat_history: List[BaseMessage], question: str) -> str:
+    digest = hashlib.sha256()
+    for message in chat_history:
+        digest.update(f"{message.type}\n{message.content}\n\0".encode("utf-8"))
+    digest.update(re.sub(r"\s+", " ", question).strip().encode("utf-8"))
+    return digest.hexdigest()
+
+#The rewriters of the chains that are still in use, the rewriter of a chain that is no longer cached is dropped with the chain
+_question_rewriters: weakref.WeakSet[QuestionRewriter] = weakref.WeakSet()
+
+def create_question_rewriter(llm: BaseLanguageModel, prompt: BasePromptTemplate) -> QuestionRewriter:
+    """A question rewriter with the cache settings of the environment"""
+    rewriter = QuestionRewriter(
+        llm,
+        prompt,
+        cache_size=int(os.getenv("QUESTION_REWRITE_CACHE_SIZE", "1000")),
+        cache_ttl_seconds=float(os.getenv("QUESTION_REWRITE_CACHE_TTL_SECONDS", "3600")),
+        use_heuristics=os.getenv("QUESTION_REWRITE_HEURISTICS", "true").lower() == "true",
+    )
+    _question_rewriters.add(rewriter)
+    return rewriter
+
+def get_question_rewrite_cache_stats() -> dict:
+    stats = [rewriter.stats() for rewriter in list(_question_rewriters)]
+    return {key: sum(s[key] for s in stats) for key in ["size", "hits", "misses"]}
+
+def similar_questions(question: str, rewritten: str, threshold: float) -> bool:
+    """Whether the rewrite left the question (nearly) unchanged, ignoring case, punctuation and whitespace"""
+    normalize = lambda text: " ".join(_WORD.findall(text.lower()))
+    return difflib.SequenceMatcher(None, normalize(question), normalize(rewritten)).ratio() >= threshold
+
+def create_cached_history_aware_retriever(
+        llm: BaseLanguageModel,
+        retriever: BaseRetriever,
+        prompt: BasePromptTemplate,
+        speculative: bool | None = None,
+        speculative_similarity: float | None = None
+    ) -> Runnable:
+    """Like create_history_aware_retriever, but the question is only rewritten when it may refer to the history and the rewrites are cached.
+
+    In speculative mode (SPECULATIVE_RETRIEVAL), the documents of the original question are retrieved while the LLM rewrites it.
+    They are used when the rewrite is similar to the question, otherwise the documents of the rewrite are retrieved.
+    The speculative retrieval has a ChatState of its own and runs without the callbacks of the request, so discarded documents
+    never end up in the state or the metrics of the request. Only the async invocations speculate.
+    """
+    rewriter = create_question_rewriter(llm, prompt)
+    if speculative is None:
+        speculative = os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+    if speculative_similarity is None:
+        speculative_similarity = float(os.getenv("SPECULATIVE_RETRIEVAL_SIMILARITY", "0.9"))
+
+    def retrieve(inputs: dict, config: RunnableConfig) -> List[Document]:
+        return retriever.invoke(rewriter.rewrite(inputs, config), config)
+
+    async def aretrieve(inputs: dict, config: RunnableConfig) -> List[Document]:
+        if not speculative:
+            return await retriever.ainvoke(await rewriter.arewrite(inputs, config), config)
+
+        question, key = rewriter.lookup(inputs)
+        if key is None:
+            return await retriever.ainvoke(question, config)
+
+        speculative_context, speculative_state = ChatState.fork()
+        speculative_documents = asyncio.create_task(retriever.ainvoke(question, {**config, "callbacks": []}), context=speculative_context)
+        try:
+            rewritten = await rewriter.arewrite_with_llm(inputs, key, config)
+        except BaseException:
+            await _discard(speculative_documents)
+            raise
+        if similar_questions(question, rewritten, speculative_similarity):
+            metrics.inc("rag_speculative_retrievals_total", {"outcome": "used"})
+            documents = await _await_speculative(retriever, question, speculative_documents, config)
+            ChatState.current().documents = speculative_state.documents
+            return documents
+        metrics.inc("rag_speculative_retrievals_total", {"outcome": "discarded"})
+        await _discard(speculative_documents)
+        return await retriever.ainvoke(rewritten, config)
+
+    return RunnableLambda(retrieve, afunc=aretrieve).with_config(run_name="chat_retriever_chain")
+
+async def _await_speculative(retriever: BaseRetriever, question: str, task: asyncio.Task, config: RunnableConfig) -> List[Document]:
+    """The documents of the used speculative retrieval, in a retriever run of the request like a retrieval of the question.
+    The run lasts as long as the request waits for the documents, the part of the retrieval the rewrite didn't hide."""
+    callback_manager = AsyncCallbackManager.configure(
+        config.get("callbacks"),
+        None,
+        inheritable_tags=config.get("tags"),
+        local_tags=retriever.tags,
+        inheritable_metadata=config.get("metadata"),
+        local_metadata=retriever.metadata,
+    )
+    run_manager = await callback_manager.on_retriever_start(dumpd(retriever), question, name=config.get("run_name"))
+    try:
+        documents = await task
+    except Exception as e:
+        await run_manager.on_retriever_error(e)
+        raise
+    await run_manager.on_retriever_end(documents)
+    return documents
+
+async def _discard(task: asyncio.Task):
+    """Cancel the task and wait until it stopped, the result and the errors of the task are ignored.
+    Work the task already handed to an executor thread keeps running, but it only sees the context of the task."""
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        #Only the cancellation of the task is ignored, not the cancellation of the request
+        if asyncio.current_task().cancelling():
+            raise
+    except Exception:
+        pass
@@ -45,16 +45,16 @@ class CustomHandler(BaseCallbackHandler):
     def on_llm_start(
         self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
     ) -> Any:
-        ChatState.prompt = "\n".join(prompts)
+        ChatState.current().prompt = "\n".join(prompts)
     
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> Any:
-        ChatState.answer = response.generations[0][0].text
-        log_interaction(ChatState.question, ChatState.answer, ChatState.prompt, ChatState.documents, ChatState.chain_id)
+        state = ChatState.current()
+        state.answer = response.generations[0][0].text
+        log_interaction(state.question, state.answer, state.prompt, state.documents, state.chain_id)
 
 
 def document_data(conversational_rag_chain: RunnableWithMessageHistory, query):    
-    ChatState.question = query
-    ChatState.chain_id = str(uuid.uuid4())
+    ChatState.start(query, str(uuid.uuid4()))
     return conversational_rag_chain.invoke(
         {"input": query},
         config={"configurable": {"session_id": "abc123"},"callbacks": [CustomHandler()]},
@@ -147,7 +147,7 @@ Vervolgens wordt deze systeem prompt, samen met de inhoud van die documenten naa
 
             
     with st.sidebar:
-        last_generated_prompt_text_area = st.text_area("De prompt die naar de llm is gestuurd", height=275, value=ChatState.prompt)
+        last_generated_prompt_text_area = st.text_area("De prompt die naar de llm is gestuurd", height=275, value=ChatState.current().prompt)
 
     # Displaying the chat history
 
@@ -5,28 +5,68 @@ sys.path.append('.')
 from api.filters import SearchFilters
 from typing import List, Literal
 from fastapi import FastAPI, Depends, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import APIKeyHeader, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
+# Loaded before the api modules are imported, they read their settings at import time
+load_dotenv()
 from api.search import SearchResult, search
 from api.retrieval_augmented_generation import retrieval_augmented_generation
 from langchain_core.chat_history import InMemoryChatMessageHistory
 from pydantic import BaseModel
-from api.chat import chat    
+from api.chat import chat, stream_chat
 from langchain_core.messages import HumanMessage, SystemMessage
-from api.wegov_integration import validate_partner_key
+from api.wegov_integration import validate_partner_key, close_client as close_partner_key_client, get_validation_cache_stats
+from api.init_services import warm_up_services, close_async_services
+from api.service_pool import service_pool
+from chat.cached_embeddings import get_embedding_cache_stats
+from chat.metrics import metrics, set_cache_metrics
+from chat.question_rewriter import get_question_rewrite_cache_stats
+from api.search_cache import SearchResponseCache
+from api.answer_cache import SemanticAnswerCache
+from api.interaction_logger import stop_interaction_log_writer, get_interaction_log_stats
+from api.index_generation import index_generations_shared
+import logging
+import os
+from contextlib import asynccontextmanager
 
 header_scheme = APIKeyHeader(name="Authorization")
 
 # Dependency to validate the partner key
-def get_api_key(credentials: HTTPAuthorizationCredentials = Depends(header_scheme)):
-    if not validate_partner_key(credentials):
+async def get_api_key(credentials: HTTPAuthorizationCredentials = Depends(header_scheme)):
+    if not await validate_partner_key(credentials):
         raise HTTPException(status_code=403, detail="Invalid partner key")
     return credentials
 
 
-app = FastAPI(dependencies=[Depends(get_api_key)])
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The search clients and vector stores are created once and reused by all requests
+    warm_up_services()
+    yield
+    await close_async_services()
+    await close_partner_key_client()
+    stop_interaction_log_writer()
 
-load_dotenv()
+app = FastAPI(dependencies=[Depends(get_api_key)], lifespan=lifespan)
+
+# The search and answer caches are cleared by the ingestion runs through INDEX_GENERATION_DIR, without it they would serve stale results
+if not index_generations_shared():
+    logging.getLogger(__name__).warning("INDEX_GENERATION_DIR is not set, the search and answer caches are disabled")
+
+search_response_cache = SearchResponseCache(
+    [str(os.getenv("AZURE_SEARCH_INDEX_NAME")), str(os.getenv("AZURE_SEARCH_MODELDOCS_INDEX_NAME"))],
+    max_size=int(os.getenv("SEARCH_CACHE_SIZE", "512")) if index_generations_shared() else 0,
+    ttl_seconds=float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "300")),
+)
+
+answer_cache = SemanticAnswerCache(
+    [str(os.getenv("AZURE_SEARCH_INDEX_NAME")), str(os.getenv("AZURE_SEARCH_MODELDOCS_INDEX_NAME"))],
+    max_size_per_scope=int(os.getenv("ANSWER_CACHE_SIZE", "1000")) if index_generations_shared() else 0,
+    ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400")),
+    similarity_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95")),
+    max_scopes=int(os.getenv("ANSWER_CACHE_MAX_SCOPES", "16")),
+)
 
 class ChatMessage(BaseModel):
     role: Literal['system', 'human']
@@ -48,6 +88,8 @@ class SearchRequest(BaseModel):
     filters: SearchFilters = None
     top: int = 10
     skip: int = 0
+    fields: List[str] | None = None
+    """The metadata fields to return, all metadata when not set. Only the selected fields are fetched from the index."""
 
 class SearchDocument(BaseModel):
     page_content: str
@@ -58,6 +100,9 @@ class SearchDocument(BaseModel):
 class SearchResponse(BaseModel):
     results: List[SearchDocument]
     total: int
+    """The number of unique sources, like the results"""
+    total_is_approximate: bool = False
+    """Whether the total is estimated from the results read so far, it is exact once a page reaches the last result"""
 
 
 default_system_prompt = """You are an assistant for question-answering tasks. 
@@ -70,33 +115,84 @@ You will have a chat history, but you must only answer the last question.
                                      
 You MUST answer in Dutch."""
 
+default_top_k = 3
+default_score_threshold = 0.7
+
 @app.post("/api/search", response_model=SearchResponse)
-def post_search(request: SearchRequest ):
-    searchResult = search(request.question, request.addVectors, request.search_type, request.order_by_date, request.filters, request.top, request.skip)
-    response = SearchResponse(total=searchResult.count, results=[])
+async def post_search(request: SearchRequest ):
+    cached_response = search_response_cache.get(request)
+    if cached_response is not None:
+        return cached_response
+
+    searchResult = await search(request.question, request.addVectors, request.search_type, request.order_by_date, request.filters, request.top, request.skip, request.fields)
+    response = SearchResponse(total=searchResult.count, total_is_approximate=searchResult.count_is_approximate, results=[])
     for d in searchResult.results:
         response.results.append(SearchDocument(page_content=d.document.page_content, metadata=d.document.metadata or dict(), highlights=d.highlights or dict(), score=d.score))
+    search_response_cache.set(request, response)
     return response
 
 @app.get("/api/retrieval_augmented_generation")
-def get_retrieval_augmented_generation(
+async def get_retrieval_augmented_generation(
     question: str, 
-    top_k: int = 3, 
-    score_threshold: float = 0.7, 
+    top_k: int = default_top_k, 
+    score_threshold: float = default_score_threshold, 
     system_prompt: str = default_system_prompt, 
     context: str = "CIB_MEMBER",
     include_page_content: bool = False,
 ):
-    return retrieval_augmented_generation(question, top_k, score_threshold, system_prompt, context, include_page_content)
+    #Only the answers of the default prompt and retrieval settings are cached, custom settings would each fill a scope of their own
+    uses_defaults = system_prompt == default_system_prompt and top_k == default_top_k and score_threshold == default_score_threshold
+    return await retrieval_augmented_generation(question, top_k, score_threshold, system_prompt, context, include_page_content, answer_cache if uses_defaults else None)
 
 @app.post("/api/chat", response_model=ChatResponse)
-def post_chat(request: ChatRequest):
+async def post_chat(request: ChatRequest):
+    result = await chat(request.question, get_chat_history(request), answer_cache)
+    return ChatResponse(answer=result['answer'], context=[d.metadata for d in result['context']])
+
+@app.post("/api/chat/stream")
+async def post_chat_stream(request: ChatRequest):
+    return StreamingResponse(stream_chat(request.question, get_chat_history(request), answer_cache), media_type="text/event-stream")
+
+def get_chat_history(request: ChatRequest) -> InMemoryChatMessageHistory:
     history = InMemoryChatMessageHistory()
     for message in request.chat_history:
         if message.role == 'system':
             history.add_message(SystemMessage(message.content))
         else:
             history.add_message(HumanMessage(message.content))
-    
-    result = chat(request.question, history)
-    return ChatResponse(answer=result['answer'], context=[d.metadata for d in result['context']])
+    return history
+
+@app.get("/api/service_pool")
+async def get_service_pool():
+    return service_pool.stats()
+
+@app.get("/api/embedding_cache")
+async def get_embedding_cache():
+    return get_embedding_cache_stats()
+
+@app.get("/api/search_cache")
+async def get_search_cache():
+    return search_response_cache.stats()
+
+@app.get("/api/answer_cache")
+async def get_answer_cache():
+    return answer_cache.stats()
+
+@app.get("/api/partner_key_cache")
+async def get_partner_key_cache():
+    return get_validation_cache_stats()
+
+@app.get("/api/interaction_log")
+async def get_interaction_log():
+    return get_interaction_log_stats()
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """The metrics of the chains and the caches in the Prometheus text format"""
+    for stats in get_embedding_cache_stats():
+        set_cache_metrics("embedding", stats, deployment=stats["deployment"])
+    set_cache_metrics("search", search_response_cache.stats())
+    set_cache_metrics("answer", answer_cache.stats())
+    set_cache_metrics("question_rewrite", get_question_rewrite_cache_stats())
+    set_cache_metrics("partner_key", get_validation_cache_stats())
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
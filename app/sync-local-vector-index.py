@@ -0,0 +1,27 @@
+import os
+import time
+from dotenv import load_dotenv
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+from chat.local_vector_store import LocalVectorStore, local_vector_index_path
+
+load_dotenv()
+
+# Copies the coman and modeldocs indexes (with their vectors) to LOCAL_VECTOR_INDEX_DIR,
+# the API and the chat then search the copies in memory. Run it again after an ingestion run.
+if not os.getenv("LOCAL_VECTOR_INDEX_DIR"):
+    raise SystemExit("Set LOCAL_VECTOR_INDEX_DIR to the directory to sync the indexes to")
+os.makedirs(str(os.getenv("LOCAL_VECTOR_INDEX_DIR")), exist_ok=True)
+
+for index_name in [str(os.getenv("AZURE_SEARCH_INDEX_NAME")), str(os.getenv("AZURE_SEARCH_MODELDOCS_INDEX_NAME"))]:
+    start = time.time()
+    client = SearchClient(str(os.getenv("AZURE_SEARCH_BASE_URL")), index_name, AzureKeyCredential(str(os.getenv("AZURE_SEARCH_KEY"))))
+    # The embedding function is only needed to search, the synced documents already have their vectors
+    vector_store = LocalVectorStore(
+        embedding_function=lambda text: [],
+        storage_type=os.getenv("LOCAL_VECTOR_INDEX_STORAGE_TYPE", "float32"),
+        index_type=os.getenv("LOCAL_VECTOR_INDEX_TYPE", "exact"),
+    )
+    count = vector_store.sync_from_search_client(client)
+    vector_store.save(str(local_vector_index_path(index_name)))
+    print(f"Synced {count} documents of {index_name} in {time.time() - start:.1f}s")
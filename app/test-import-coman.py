@@ -4,8 +4,8 @@ from chat.coman_schemes import ComanScheme
 sys.path.insert(0, "app/loaders")
 import os
 from dotenv import load_dotenv
-from langchain_community.vectorstores.azuresearch import AzureSearch
-from langchain_openai import AzureOpenAIEmbeddings
+from api.index_generation import bump_index_generation
+from chat.backends import create_embeddings, create_vector_store, get_backend
 from langchain_community.document_transformers import Html2TextTransformer
 from langchain.schema import Document
 from loaders import ComanLoader, ComanCollaboratorLoader
@@ -106,10 +106,8 @@ comanImageSchemeFields = {
     ComanScheme.EVENTS.value: "Picture",
 }
 
-AZURE_SEARCH_KEY = str(os.getenv("AZURE_SEARCH_KEY"))
-embeddings = AzureOpenAIEmbeddings(
-    azure_deployment=str(os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME")),
-)
+embedding_deployment = str(os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME"))
+embeddings = create_embeddings(embedding_deployment)
 
 fields = [
     SimpleField(
@@ -117,6 +115,8 @@ fields = [
         type=SearchFieldDataType.String,
         key=True,
         filterable=True,
+        #The local copies of the index are synced in the order of the id
+        sortable=True,
     ),
     SearchableField(
         name="content",
@@ -241,13 +241,8 @@ fields = [
 ]
 
 index_name: str = str(os.getenv("AZURE_SEARCH_INDEX_NAME"))
-vector_store: AzureSearch = AzureSearch(
-    azure_search_endpoint=str(os.getenv("AZURE_SEARCH_BASE_URL")),
-    azure_search_key=AZURE_SEARCH_KEY,
-    index_name=index_name,
-    embedding_function=embeddings.embed_query,
-    fields=fields
-)
+#Azure AI Search, or the local index when SEARCH_BACKEND=local
+vector_store = create_vector_store(index_name, embedding_deployment, fields)
 
 html2text = Html2TextTransformer()
 
@@ -271,7 +266,9 @@ for scheme in comanDict:
         print("loading from " + str(start) + " to " + str(end))
         # Upload to azure search with batch size, because otherwise we get an error: Request is too large
         vector_store.add_documents(documents[start:end])
-        time.sleep(2)
+        bump_index_generation(index_name)
+        if get_backend("search") == "azure":
+            time.sleep(2)
 
     print(scheme + " done")
     print('done loading ' + scheme + ': ', datetime.datetime.now())
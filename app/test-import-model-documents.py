@@ -1,7 +1,7 @@
 import os
 from dotenv import load_dotenv
-from langchain_community.vectorstores.azuresearch import AzureSearch
-from langchain_openai import AzureOpenAIEmbeddings
+from api.index_generation import bump_index_generation
+from chat.backends import create_embeddings, create_vector_store, get_backend
 from langchain_community.document_transformers import Html2TextTransformer
 from loaders import ModelDocLoader
 from azure.search.documents.indexes.models import (
@@ -17,10 +17,8 @@ import time
 
 load_dotenv()
 
-AZURE_SEARCH_KEY = str(os.getenv("AZURE_SEARCH_KEY"))
-embeddings = AzureOpenAIEmbeddings(
-    azure_deployment=str(os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME")),
-)
+embedding_deployment = str(os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME"))
+embeddings = create_embeddings(embedding_deployment)
 
 fields = [
     SimpleField(
@@ -28,6 +26,8 @@ fields = [
         type=SearchFieldDataType.String,
         key=True,
         filterable=True,
+        #The local copies of the index are synced in the order of the id
+        sortable=True,
     ),
     SearchableField(
         name="content",
@@ -158,13 +158,8 @@ fields = [
 ]
 
 index_name: str = os.getenv("AZURE_SEARCH_MODELDOCS_INDEX_NAME")
-vector_store: AzureSearch = AzureSearch(
-    azure_search_endpoint=str(os.getenv("AZURE_SEARCH_BASE_URL")),
-    azure_search_key=AZURE_SEARCH_KEY,
-    index_name=index_name,
-    embedding_function=embeddings.embed_query,
-    fields=fields
-)
+#Azure AI Search, or the local index when SEARCH_BACKEND=local
+vector_store = create_vector_store(index_name, embedding_deployment, fields)
 
 html2text = Html2TextTransformer()
 
@@ -186,7 +181,9 @@ for i in range(math.ceil(amountDocs / batchSize)):
     print("loading from " + str(start) + " to " + str(end))
     # Upload to azure search with batch size, because otherwise we get an error: Request is too large
     vector_store.add_documents(documents[start:end])
-    time.sleep(2)
+    bump_index_generation(index_name)
+    if get_backend("search") == "azure":
+        time.sleep(2)
 
 print('done loading modeldocs: ', datetime.datetime.now())
 # docs = vector_store.similarity_search("Wanneer wordt Brusselse woonfiscaliteit hervormd?", k=2, filters="source eq '3f37ed58-cd2b-4c76-af56-b1b5fb5a8861'")
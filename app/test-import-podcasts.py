@@ -5,8 +5,8 @@ from chat.coman_schemes import ComanScheme
 sys.path.insert(0, "app/loaders")
 import os
 from dotenv import load_dotenv
-from langchain_community.vectorstores.azuresearch import AzureSearch
-from langchain_openai import AzureOpenAIEmbeddings
+from api.index_generation import bump_index_generation
+from chat.backends import create_embeddings, create_vector_store, get_backend
 from azure.search.documents.indexes.models import (
     SearchableField,
     SearchField,
@@ -20,10 +20,8 @@ import time
 
 load_dotenv()
 
-AZURE_SEARCH_KEY = str(os.getenv("AZURE_SEARCH_KEY"))
-embeddings = AzureOpenAIEmbeddings(
-    azure_deployment=str(os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME")),
-)
+embedding_deployment = str(os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME"))
+embeddings = create_embeddings(embedding_deployment)
 
 fields = [
     SimpleField(
@@ -31,6 +29,8 @@ fields = [
         type=SearchFieldDataType.String,
         key=True,
         filterable=True,
+        #The local copies of the index are synced in the order of the id
+        sortable=True,
     ),
     SearchableField(
         name="content",
@@ -70,13 +70,8 @@ fields = [
 ]
 
 index_name: str = "podcasts-index"
-vector_store: AzureSearch = AzureSearch(
-    azure_search_endpoint=str(os.getenv("AZURE_SEARCH_BASE_URL")),
-    azure_search_key=AZURE_SEARCH_KEY,
-    index_name=index_name,
-    embedding_function=embeddings.embed_query,
-    fields=fields
-)
+#Azure AI Search, or the local index when SEARCH_BACKEND=local
+vector_store = create_vector_store(index_name, embedding_deployment, fields)
 
 print('start loading: ', datetime.datetime.now())
 loader = PodcastLoader.PodcastLoader("C:\\Users\\TomVermeulen\\OneDrive - OPEN REAL ESTATE INFORMATION SERVICES AFGEKORT ORIS\\Documents\\Podcasts\\Vastgoedactueel", "C:\\Users\\TomVermeulen\\OneDrive - OPEN REAL ESTATE INFORMATION SERVICES AFGEKORT ORIS\\Documents\\Podcasts\\Vastgoedpraat")
@@ -94,5 +89,7 @@ for i in range(math.ceil(amountDocs / batchSize)):
     print("loading from " + str(start) + " to " + str(end))
     # Upload to azure search with batch size, because otherwise we get an error: Request is too large
     vector_store.add_documents(documents[start:end])
-    time.sleep(2)
+    bump_index_generation(index_name)
+    if get_backend("search") == "azure":
+        time.sleep(2)
 
@@ -1,7 +1,7 @@
 import os
 from dotenv import load_dotenv
-from langchain_community.vectorstores.azuresearch import AzureSearch
-from langchain_openai import AzureOpenAIEmbeddings
+from api.index_generation import bump_index_generation
+from chat.backends import create_embeddings, create_vector_store, get_backend
 from langchain_community.document_transformers import Html2TextTransformer
 from langchain.schema import Document
 from vivo import VivoLoader
@@ -17,10 +17,8 @@ import math
 
 load_dotenv()
 
-AZURE_SEARCH_KEY = str(os.getenv("AZURE_SEARCH_KEY"))
-embeddings = AzureOpenAIEmbeddings(
-    azure_deployment=str(os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME")),
-)
+embedding_deployment = str(os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME"))
+embeddings = create_embeddings(embedding_deployment)
 
 fields = [
     SimpleField(
@@ -28,6 +26,8 @@ fields = [
         type=SearchFieldDataType.String,
         key=True,
         filterable=True,
+        #The local copies of the index are synced in the order of the id
+        sortable=True,
     ),
     SearchableField(
         name="content",
@@ -91,13 +91,8 @@ fields = [
 ]
 
 index_name: str = os.getenv("AZURE_SEARCH_INDEX_NAME")
-vector_store: AzureSearch = AzureSearch(
-    azure_search_endpoint=str(os.getenv("AZURE_SEARCH_BASE_URL")),
-    azure_search_key=AZURE_SEARCH_KEY,
-    index_name=index_name,
-    embedding_function=embeddings.embed_query,
-    fields=fields
-)
+#Azure AI Search, or the local index when SEARCH_BACKEND=local
+vector_store = create_vector_store(index_name, embedding_deployment, fields)
 
 html2text = Html2TextTransformer()
 
@@ -120,6 +115,8 @@ for i in range(math.ceil(amountDocs / batchSize)):
     print("loading from " + str(start) + " to " + str(end))
     # Upload to azure search with batch size, because otherwise we get an error: Request is too large
     vector_store.add_documents(documents[start:end])
-    time.sleep(2)
+    bump_index_generation(index_name)
+    if get_backend("search") == "azure":
+        time.sleep(2)
 
 print('done loading: ', datetime.datetime.now())
\ No newline at end of file
@@ -0,0 +1,6 @@
+import os
+import sys
+
+#The modules are imported like in main.py: api.* and chat.* from the app folder
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
@@ -0,0 +1,71 @@
+import asyncio
+from langchain_core.chat_history import InMemoryChatMessageHistory
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableLambda
+from chat.conversational_rag_chain import SESSION_HISTORY_CONFIG, with_session_history
+from chat.local_backends import HashEmbeddings
+import api.answer_cache
+import api.chat
+from api.answer_cache import SemanticAnswerCache
+
+def create_answer_cache(max_size_per_scope: int = 1000, ttl_seconds: float = 60, max_scopes: int = 16) -> SemanticAnswerCache:
+    return SemanticAnswerCache(["coman-index"], max_size_per_scope=max_size_per_scope, ttl_seconds=ttl_seconds, similarity_threshold=0.95, max_scopes=max_scopes)
+
+def test_oldest_entries_are_evicted():
+    answer_cache = create_answer_cache(max_size_per_scope=50)
+    embeddings = HashEmbeddings(dimensions=64)
+    questions = [f"vraag {i}" for i in range(200)]
+    for question in questions:
+        answer_cache.set("scope", embeddings.embed_query(question), question)
+    assert answer_cache.stats()["size"] == 50
+    assert answer_cache.get("scope", embeddings.embed_query(questions[-1])) == questions[-1]
+    assert answer_cache.get("scope", embeddings.embed_query(questions[-50])) == questions[-50]
+    assert answer_cache.get("scope", embeddings.embed_query(questions[0])) is None
+
+def test_least_recently_used_scopes_are_evicted():
+    answer_cache = create_answer_cache(max_scopes=3)
+    embedding = HashEmbeddings(dimensions=64).embed_query("vraag")
+    for prompt in range(3):
+        answer_cache.set(("prompt", prompt), embedding, prompt)
+    assert answer_cache.get(("prompt", 0), embedding) == 0
+    for prompt in range(3, 100):
+        answer_cache.set(("prompt", prompt), embedding, prompt)
+        answer_cache.get(("prompt", 0), embedding)
+    assert answer_cache.stats()["scopes"] == 3
+    assert answer_cache.get(("prompt", 0), embedding) == 0
+    assert answer_cache.get(("prompt", 99), embedding) == 99
+    assert answer_cache.get(("prompt", 1), embedding) is None
+
+def test_expired_entries_are_removed(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(api.answer_cache.time, "monotonic", lambda: now[0])
+    answer_cache = create_answer_cache(ttl_seconds=10)
+    embeddings = HashEmbeddings(dimensions=64)
+    answer_cache.set("scope", embeddings.embed_query("oude vraag"), "oud")
+    now[0] += 5
+    answer_cache.set("scope", embeddings.embed_query("nieuwe vraag"), "nieuw")
+    now[0] += 6
+    assert answer_cache.get("scope", embeddings.embed_query("oude vraag")) is None
+    assert answer_cache.get("scope", embeddings.embed_query("nieuwe vraag")) == "nieuw"
+    assert answer_cache.stats()["size"] == 1
+
+def test_cached_answer_leaves_the_history_like_a_generated_answer(monkeypatch):
+    answer = {"answer": "Een huurwaarborg is maximaal twee maanden huur.", "context": [Document(page_content="huurwaarborg", metadata={"source": "coman-1"})]}
+    #The rag chain is replaced by one that always gives the same answer, the chat history is handled like in the real chain
+    chain = with_session_history(RunnableLambda(lambda inputs: {**inputs, **answer}), lambda session_history: session_history, SESSION_HISTORY_CONFIG)
+    async def prepare_chain(question):
+        return chain, None
+    monkeypatch.setattr(api.chat, "prepare_chain", prepare_chain)
+    monkeypatch.setattr(api.chat, "get_cached_embeddings", lambda deployment: HashEmbeddings(dimensions=64))
+    monkeypatch.setattr(api.chat, "log_interaction", lambda *args: None)
+    answer_cache = create_answer_cache()
+
+    generated_history = InMemoryChatMessageHistory()
+    generated = asyncio.run(api.chat.chat("Wat is een huurwaarborg?", generated_history, answer_cache))
+    cached_history = InMemoryChatMessageHistory()
+    cached = asyncio.run(api.chat.chat("Wat is een huurwaarborg?", cached_history, answer_cache))
+
+    assert answer_cache.stats()["hits"] == 1
+    assert cached_history.messages == generated_history.messages
+    assert [message.type for message in cached_history.messages] == ["human", "ai"]
+    assert cached == generated
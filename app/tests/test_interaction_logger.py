@@ -0,0 +1,44 @@
+import json
+from api.interaction_logger import MAX_TRANSACTION_BYTES, MAX_TRANSACTION_SIZE, InteractionLogWriter
+from chat.local_backends import InMemoryTableClient
+
+class RecordingTableClient(InMemoryTableClient):
+    """Table client that records the transactions and rejects them above the limits of Azure Table Storage"""
+
+    def __init__(self):
+        super().__init__("chatlogs")
+        self.transactions = []
+
+    def submit_transaction(self, operations, **kwargs):
+        if len(operations) > MAX_TRANSACTION_SIZE or sum(len(json.dumps(entity)) for _, entity in operations) > MAX_TRANSACTION_BYTES:
+            raise ValueError("The transaction is too large")
+        self.transactions.append(len(operations))
+        return super().submit_transaction(operations, **kwargs)
+
+def log_entry(row_key: str, documents_size: int = 100) -> dict:
+    return {"PartitionKey": "LLMLogs", "RowKey": row_key, "Question": "Wat is een huurwaarborg?", "Documents": "x" * documents_size}
+
+def test_transactions_are_split_on_size():
+    table_client = RecordingTableClient()
+    writer = InteractionLogWriter(lambda: table_client)
+    #100 entries of 100 KB don't fit in one transaction of 4 MiB
+    writer._write([log_entry(str(i), 100_000) for i in range(MAX_TRANSACTION_SIZE)])
+    assert writer.stats()["written"] == MAX_TRANSACTION_SIZE
+    assert len(table_client.transactions) > 1
+    assert len(table_client.list_entities()) == MAX_TRANSACTION_SIZE
+
+def test_transactions_are_split_on_count():
+    table_client = RecordingTableClient()
+    writer = InteractionLogWriter(lambda: table_client)
+    writer._write([log_entry(str(i)) for i in range(MAX_TRANSACTION_SIZE + 1)])
+    assert table_client.transactions == [MAX_TRANSACTION_SIZE, 1]
+
+def test_failed_transactions_are_spilled(tmp_path):
+    table_client = RecordingTableClient()
+    table_client.create_entity(log_entry("1"))
+    spill_path = tmp_path / "spill.jsonl"
+    writer = InteractionLogWriter(lambda: table_client, spill_path=str(spill_path))
+    #The existing entity fails the whole transaction
+    writer._write([log_entry("0"), log_entry("1")])
+    assert writer.stats() == {"queued": 0, "written": 0, "spilled": 2, "dropped": 0, "failed": 2}
+    assert [json.loads(line)["RowKey"] for line in spill_path.read_text().splitlines()] == ["0", "1"]
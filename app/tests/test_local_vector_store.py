@@ -0,0 +1,129 @@
+import json
+import random
+import numpy as np
+from chat.local_backends import HashEmbeddings
+from chat.local_vector_store import RRF_K, GraphIndex, LocalVectorStore, VectorStorage
+from chat.odata_filter import compile_filter
+import chat.local_vector_store
+
+CONTENTS = [
+    "de huurwaarborg bedraagt maximaal twee maanden huur",
+    "de opzeg van een huurovereenkomst door de verhuurder",
+    "het btw tarief voor renovatie van woningen",
+    "de registratie van een huurovereenkomst",
+    "fiscale aftrek van een hypothecaire lening",
+]
+
+def create_store(**kwargs) -> LocalVectorStore:
+    store = LocalVectorStore(HashEmbeddings(dimensions=256), **kwargs)
+    store.add_texts(CONTENTS, [{"source": f"doc-{i}", "type": "Syllabi" if i % 2 else "Actua"} for i in range(len(CONTENTS))])
+    return store
+
+def test_text_ranking_scores_rare_terms_higher():
+    store = create_store()
+    ranking = store._text_ranking("huurwaarborg huurovereenkomst", None, None)
+    #huurwaarborg is in one document, huurovereenkomst in two
+    assert [row for _, row in ranking] == [0, 1, 3] or [row for _, row in ranking] == [0, 3, 1]
+    assert ranking[0][0] > ranking[1][0]
+    assert store._text_ranking("hypotheek", None, None) == []
+
+def test_hybrid_ranking_fuses_the_text_and_vector_rankings():
+    store = create_store()
+    query = "registratie huurovereenkomst"
+    embedding = store.embed_query(query)
+    text_ranks = {row: rank for rank, (_, row) in enumerate(store._text_ranking(query, None, None), start=1)}
+    vector_ranks = {row: rank for rank, (_, row) in enumerate(store._vector_ranking(embedding, len(CONTENTS), None), start=1)}
+    hybrid = store._hybrid_ranking(query, embedding, len(CONTENTS), None)
+    for score, row in hybrid:
+        expected = sum(1 / (RRF_K + ranks[row]) for ranks in (text_ranks, vector_ranks) if row in ranks)
+        assert abs(score - expected) < 1e-9
+    assert hybrid[0][1] == 3
+    assert [score for score, _ in hybrid] == sorted((score for score, _ in hybrid), reverse=True)
+
+def test_searches_apply_the_filter():
+    store = create_store()
+    results = store.hybrid_search_with_score("huur", k=5, filters="type eq 'Syllabi'")
+    assert results and all(doc.metadata["type"] == "Syllabi" for doc, _ in results)
+    results = store.vector_search_with_score("huur", k=5, filters="type eq 'Actua'")
+    assert results and all(doc.metadata["type"] == "Actua" for doc, _ in results)
+
+def test_semantic_search_falls_back_to_hybrid_search():
+    store = create_store()
+    hybrid = store.hybrid_search_with_score("huurwaarborg", k=3)
+    semantic = store.semantic_hybrid_search_with_score_and_rerank("huurwaarborg", k=3)
+    assert [doc.page_content for doc, _, _ in semantic] == [doc.page_content for doc, _ in hybrid]
+    assert [(score, reranker_score) for _, score, reranker_score in semantic] == [(score, score) for _, score in hybrid]
+    assert all(doc.metadata["captions"] == {} and doc.metadata["answers"] == "" for doc, _, _ in semantic)
+
+def test_graph_index_finds_the_nearest_neighbours():
+    random_state = np.random.default_rng(0)
+    centers = random_state.normal(size=(20, 32))
+    vectors = centers[random_state.integers(0, 20, 2000)] + 0.3 * random_state.normal(size=(2000, 32))
+    storage = VectorStorage()
+    storage.add(vectors)
+    graph = GraphIndex(storage, max_neighbors=16)
+    graph.add_pending()
+    recall = []
+    for query in random_state.normal(size=(20, 32)):
+        query = query / np.linalg.norm(query)
+        exact = set(np.argsort(-storage.similarities(query))[:10].tolist())
+        approximate = {row for _, row in graph.search(query, 64)[:10]}
+        recall.append(len(exact & approximate) / 10)
+    assert np.mean(recall) >= 0.9
+
+def test_graph_store_ranks_like_the_exact_store():
+    exact = create_store()
+    graph = create_store(index_type="graph")
+    for query in ["huur", "btw renovatie", "lening"]:
+        #Documents without a shared word have the same score, so the scores are compared and not the order of the documents
+        assert [round(score, 6) for _, score in graph.vector_search_with_score(query, k=3)] == [round(score, 6) for _, score in exact.vector_search_with_score(query, k=3)]
+
+class PagedSearchClient:
+    """The documents of an index, returned in a different order on every search that is not ordered like Azure AI Search can do"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.searches = []
+
+    def search(self, search_text, filter=None, order_by=None, select=None, top=50, skip=None):
+        self.searches.append({"filter": filter, "order_by": order_by, "skip": skip})
+        results = [document for document in self.documents if compile_filter(filter)(document)]
+        if order_by == ["id asc"]:
+            results.sort(key=lambda document: document["id"])
+        else:
+            random.shuffle(results)
+        return iter(results[skip or 0:(skip or 0) + top])
+
+def create_index_documents(count: int):
+    embeddings = HashEmbeddings(dimensions=16)
+    return [
+        #Like the documents in the Azure indexes: the metadata as json and also as separate fields
+        {"id": f"doc-'{i:03}'", "content": f"document {i}", "is_public": "True" if i % 3 else "False", "content_vector": embeddings.embed_query(f"document {i}"), "metadata": json.dumps({"source": f"doc-{i}", "is_public": "True" if i % 3 else "False"})}
+        for i in range(count)
+    ]
+
+def test_sync_pages_on_the_id(monkeypatch):
+    monkeypatch.setattr(chat.local_vector_store, "SYNC_PAGE_SIZE", 4)
+    documents = create_index_documents(10)
+    client = PagedSearchClient(random.sample(documents, len(documents)))
+    store = LocalVectorStore(lambda text: [])
+    assert store.sync_from_search_client(client) == 10
+    assert sorted(store.ids) == sorted(document["id"] for document in documents)
+    assert all(search["skip"] is None and search["order_by"] == ["id asc"] for search in client.searches)
+    assert len(client.searches) == 3
+
+def test_sync_with_a_filter(monkeypatch):
+    monkeypatch.setattr(chat.local_vector_store, "SYNC_PAGE_SIZE", 2)
+    store = LocalVectorStore(lambda text: [])
+    assert store.sync_from_search_client(PagedSearchClient(create_index_documents(10)), filter="is_public eq 'True'") == 6
+    assert all(metadata["is_public"] == "True" for metadata in store.metadatas)
+
+def test_sync_again_replaces_the_documents(monkeypatch):
+    monkeypatch.setattr(chat.local_vector_store, "SYNC_PAGE_SIZE", 4)
+    store = LocalVectorStore(lambda text: [], index_type="graph")
+    store.sync_from_search_client(PagedSearchClient(create_index_documents(10)))
+    documents = create_index_documents(7)
+    assert store.sync_from_search_client(PagedSearchClient(documents)) == 7
+    assert sorted(store.ids) == sorted(document["id"] for document in documents)
+    assert len(store.storage) == len(store.graph) == 7
+    assert store.vector_search_with_score_by_vector(documents[5]["content_vector"], k=1)[0][0].metadata["source"] == "doc-5"
@@ -0,0 +1,24 @@
+from langchain_core.documents import Document
+from chat.multi_index_retriever import fuse
+
+def candidates(index: str, scores):
+    return [(Document(page_content=f"{index} {i}", metadata={"source": f"{index}-{i}", "type": "Syllabi"}), score) for i, score in enumerate(scores)]
+
+def sources(documents):
+    return [document.metadata["source"] for document in documents]
+
+def test_weak_hits_of_one_index_stay_below_the_strong_hits_of_another():
+    strong = candidates("coman", [0.9, 0.85, 0.8])
+    weak = candidates("modeldocs", [0.3, 0.25])
+    fused = fuse([strong, weak], [{}, {}], [1.0, 1.0])
+    assert sources(fused) == ["coman-0", "coman-1", "coman-2", "modeldocs-0", "modeldocs-1"]
+
+def test_a_single_weak_hit_is_not_the_best():
+    fused = fuse([candidates("coman", [0.9, 0.5]), candidates("modeldocs", [0.6])], [{}, {}], [1.0, 1.0])
+    assert sources(fused) == ["coman-0", "modeldocs-0", "coman-1"]
+
+def test_duplicates_keep_their_best_score():
+    coman = candidates("coman", [0.9, 0.5])
+    duplicate = [(Document(page_content="coman 1", metadata={"source": "coman-1", "type": "Syllabi"}), 0.95)]
+    fused = fuse([coman, duplicate], [{}, {}], [1.0, 1.0])
+    assert sources(fused) == ["coman-1", "coman-0"]
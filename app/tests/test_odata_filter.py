@@ -0,0 +1,44 @@
+import pytest
+from chat.odata_filter import compile_filter
+
+DOCUMENT = {"type": "Syllabi", "is_public": "True", "year": 2021, "domains": ["huur", "fiscaal"], "title": "Huur 'en' pacht"}
+
+def test_comparisons():
+    assert compile_filter("type eq 'Syllabi'")(DOCUMENT)
+    assert compile_filter("type ne 'Actua'")(DOCUMENT)
+    assert compile_filter("year gt 2020 and year le 2021")(DOCUMENT)
+    assert not compile_filter("year lt 2021")(DOCUMENT)
+    assert not compile_filter("missing gt 1")(DOCUMENT)
+
+def test_booleans_stored_as_strings():
+    assert compile_filter("is_public eq 'True'")(DOCUMENT)
+    assert compile_filter("is_public eq true")(DOCUMENT)
+
+def test_and_or_not_and_parentheses():
+    assert compile_filter("type eq 'Actua' or (year eq 2021 and not type eq 'Media')")(DOCUMENT)
+    assert not compile_filter("not (type eq 'Syllabi' or year eq 2000)")(DOCUMENT)
+
+def test_quotes_in_literals():
+    assert compile_filter("title eq 'Huur ''en'' pacht'")(DOCUMENT)
+
+def test_search_in():
+    assert compile_filter("search.in(type, 'Actua,Syllabi', ',')")(DOCUMENT)
+    assert compile_filter("search.in(type, 'Actua Syllabi')")(DOCUMENT)
+    assert not compile_filter("search.in(type, 'Actua,Media', ',')")(DOCUMENT)
+
+def test_collection_lambdas():
+    assert compile_filter("domains/any(domain: search.in(domain, 'fiscaal,btw', ','))")(DOCUMENT)
+    assert not compile_filter("domains/all(domain: domain eq 'huur')")(DOCUMENT)
+    assert not compile_filter("missing/any(value: value eq 'huur')")(DOCUMENT)
+
+def test_empty_filter_matches_everything():
+    assert compile_filter(None)(DOCUMENT)
+    assert compile_filter("  ")(DOCUMENT)
+
+def test_invalid_filters():
+    with pytest.raises(ValueError):
+        compile_filter("type eq")
+    with pytest.raises(ValueError):
+        compile_filter("type like 'Syllabi'")
+    with pytest.raises(ValueError):
+        compile_filter("(type eq 'Syllabi'")
@@ -0,0 +1,82 @@
+import asyncio
+import gc
+import time
+from typing import List, Tuple
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.retrievers import BaseRetriever
+from chat.chat_state import ChatState
+from chat.local_backends import LocalChatModel
+from chat.question_rewriter import create_cached_history_aware_retriever, create_question_rewriter, get_question_rewrite_cache_stats
+
+PROMPT = ChatPromptTemplate.from_messages([MessagesPlaceholder("chat_history"), ("human", "{input}")])
+INPUTS = {"input": "En voor huurders?", "chat_history": [HumanMessage("Wat is een huurwaarborg?"), AIMessage("Twee maanden huur.")]}
+
+def test_stats_of_dropped_rewriters_are_forgotten():
+    size = get_question_rewrite_cache_stats()["size"]
+    rewriter = create_question_rewriter(LocalChatModel(), PROMPT)
+    rewriter.rewrite(INPUTS, {})
+    assert get_question_rewrite_cache_stats()["size"] == size + 1
+    #The rewriter is dropped with the chain that holds it
+    del rewriter
+    gc.collect()
+    assert get_question_rewrite_cache_stats()["size"] == size
+
+class SlowRetriever(BaseRetriever):
+    """Retriever that writes its documents to the ChatState like the index retrievers, the original question is retrieved slowly"""
+
+    slow_query: str
+
+    def _get_relevant_documents(self, query: str, *, run_manager) -> List[Document]:
+        if query == self.slow_query:
+            time.sleep(0.2)
+        documents = [Document(page_content=query)]
+        ChatState.current().documents = documents
+        return documents
+
+class RetrieverRuns(BaseCallbackHandler):
+    """The queries and documents of the retriever runs the callbacks of the request see"""
+
+    def __init__(self):
+        self.queries = []
+        self.documents = []
+
+    def on_retriever_start(self, serialized, query, **kwargs):
+        self.queries.append(query)
+
+    def on_retriever_end(self, documents, **kwargs):
+        self.documents.append([document.page_content for document in documents])
+
+def speculative_retrieval(rewrite: str, callbacks: list | None = None) -> Tuple[List[Document], ChatState]:
+    retriever = create_cached_history_aware_retriever(LocalChatModel(response=rewrite), SlowRetriever(slow_query=INPUTS["input"]), PROMPT, speculative=True, speculative_similarity=0.9)
+    async def retrieve():
+        state = ChatState.start(INPUTS["input"], "chain")
+        documents = await retriever.ainvoke(INPUTS, {"callbacks": callbacks or []})
+        #Give a discarded retrieval the time to finish in its executor thread
+        await asyncio.sleep(0.4)
+        return documents, state
+    return asyncio.run(retrieve())
+
+def test_discarded_speculative_retrieval_leaves_the_chat_state():
+    documents, state = speculative_retrieval("Wat is de huurwaarborg voor huurders?")
+    assert [document.page_content for document in documents] == ["Wat is de huurwaarborg voor huurders?"]
+    assert state.documents == documents
+
+def test_used_speculative_retrieval_sets_the_chat_state():
+    documents, state = speculative_retrieval("En voor huurders?")
+    assert [document.page_content for document in documents] == ["En voor huurders?"]
+    assert state.documents == documents
+
+def test_discarded_speculative_retrieval_is_not_seen_by_the_callbacks():
+    runs = RetrieverRuns()
+    speculative_retrieval("Wat is de huurwaarborg voor huurders?", [runs])
+    assert runs.queries == ["Wat is de huurwaarborg voor huurders?"]
+    assert runs.documents == [["Wat is de huurwaarborg voor huurders?"]]
+
+def test_used_speculative_retrieval_is_seen_by_the_callbacks_once():
+    runs = RetrieverRuns()
+    speculative_retrieval("En voor huurders?", [runs])
+    assert runs.queries == ["En voor huurders?"]
+    assert runs.documents == [["En voor huurders?"]]
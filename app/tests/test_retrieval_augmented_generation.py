@@ -0,0 +1,35 @@
+import asyncio
+from typing import List
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from chat.local_backends import HashEmbeddings, LocalChatModel
+import api.retrieval_augmented_generation
+from api.retrieval_augmented_generation import retrieval_augmented_generation
+
+PAGE_CONTENT = "<bron1>\n2024-01-01\n" + " ".join(f"Zin {i} gaat over onderwerp {i} van het syllabus." for i in range(60)) + "</bron1>\n"
+
+class FixedRetriever(BaseRetriever):
+    def _get_relevant_documents(self, query: str, *, run_manager) -> List[Document]:
+        return [Document(page_content=PAGE_CONTENT, metadata={"source": "coman-1"})]
+
+class RecordingChatModel(LocalChatModel):
+    prompts: List[str] = []
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.prompts.append(messages[0].content)
+        return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+def test_original_page_content_is_returned(monkeypatch):
+    llm = RecordingChatModel()
+    monkeypatch.setenv("COMPRESSION_MAX_SENTENCES", "5")
+    monkeypatch.setattr(api.retrieval_augmented_generation, "init_custom_retriever", lambda top_k, filters, score_threshold: FixedRetriever())
+    monkeypatch.setattr(api.retrieval_augmented_generation, "init_llm", lambda: llm)
+    monkeypatch.setattr(api.retrieval_augmented_generation, "init_embeddings", lambda: HashEmbeddings(dimensions=64))
+
+    result = asyncio.run(retrieval_augmented_generation("Waarover gaat zin 7?", 3, 0.7, "Antwoord kort.", "CIB_MEMBER", True))
+
+    assert [document.page_content for document in result["context"]] == [PAGE_CONTENT]
+    #Only the prompt gets the compressed document
+    prompt, = llm.prompts
+    assert "Zin 7 gaat over onderwerp 7" in prompt
+    assert len(prompt) < len(PAGE_CONTENT)
@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+from api.filters import SearchFilters
+from chat.local_backends import AsyncInMemorySearchClient, HashEmbeddings
+from chat.local_vector_store import LocalVectorStore
+import api.search
+
+COMAN_INDEX = "coman-index"
+MODELDOCS_INDEX = "modeldocs-index"
+
+def create_client(documents):
+    """An in-memory search client with the (content, source, date) documents"""
+    vector_store = LocalVectorStore(HashEmbeddings(dimensions=64))
+    vector_store.add_texts([content for content, _, _ in documents], [{"source": source, "date": date} for _, source, date in documents])
+    return AsyncInMemorySearchClient(vector_store)
+
+@pytest.fixture
+def indexes(monkeypatch):
+    monkeypatch.setenv("AZURE_SEARCH_INDEX_NAME", COMAN_INDEX)
+    monkeypatch.setenv("AZURE_SEARCH_MODELDOCS_INDEX_NAME", MODELDOCS_INDEX)
+    #Every source is chunked, so the indexes return several hits per source
+    clients = {
+        COMAN_INDEX: create_client([
+            ("huur huur huur waarborg", "coman-1", "2020-01-01"),
+            ("huur waarborg bij opzeg", "coman-1", "2020-01-01"),
+            ("huur", "coman-2", "2024-01-01"),
+            ("huur en waarborg", "coman-3", "2022-01-01"),
+            ("waarborg van de huur", "coman-3", "2022-01-01"),
+        ]),
+        MODELDOCS_INDEX: create_client([
+            ("model huur huur waarborg", "model-1", "2019-01-01"),
+            ("model huur", "model-2", "2023-01-01"),
+            ("model van de huur", "model-2", "2023-01-01"),
+        ]),
+    }
+    monkeypatch.setattr(api.search, "init_async_search_client", lambda index_name: clients[index_name])
+    return clients
+
+def search_filters(field: str, order: str, **kwargs) -> SearchFilters:
+    #Built like the request body of /api/search in main.py, which imports the filters as api.filters
+    return SearchFilters(typeFilter=[], categoryFilter=[], domainFilter=[], sortingFilter={"field": field, "order": order}, **kwargs)
+
+def simple_text_search(filters: SearchFilters, top: int = 10, skip: int = 0):
+    return asyncio.run(api.search.search("huur waarborg", False, "simple_text", False, filters, top, skip))
+
+def test_sorting_of_the_api_filters():
+    filters = search_filters("Score", "desc")
+    assert api.search.get_sorting(filters, True) == (api.search.SortField.SCORE, api.search.SortOrder.DESC)
+
+def test_simple_text_sorted_on_score(indexes):
+    result = simple_text_search(search_filters("Score", "desc"))
+    scores = [item.score for item in result.results]
+    assert scores == sorted(scores, reverse=True)
+
+def test_simple_text_sorted_on_date(indexes):
+    result = simple_text_search(search_filters("Date", "asc"))
+    dates = [item.document.metadata["date"] for item in result.results]
+    assert dates == sorted(dates)
+
+def test_simple_text_count_of_unique_sources(indexes):
+    #Without any filter, both indexes are searched
+    result = simple_text_search(search_filters("Score", "desc", excludeTypeFilter=[]))
+    assert not result.count_is_approximate
+    assert result.count == len(result.results) == 5
+
+def test_simple_text_paging_to_the_end(indexes):
+    #The default filters exclude types, so only the coman index is searched
+    first_page = simple_text_search(search_filters("Date", "desc"), top=2)
+    assert first_page.count_is_approximate
+    assert first_page.count > 2
+    #Once the last result is read, the count is exact and the page after it is empty
+    last_page = simple_text_search(search_filters("Date", "desc"), top=2, skip=2)
+    assert [item.document.metadata["source"] for item in last_page.results] == ["coman-1"]
+    assert (last_page.count, last_page.count_is_approximate) == (3, False)
+    assert simple_text_search(search_filters("Date", "desc"), top=2, skip=4).results == []
+
+def test_only_the_requested_fields_are_returned(indexes):
+    #The source is fetched to merge the results, but only the date was requested
+    result = asyncio.run(api.search.search("huur waarborg", False, "simple_text", False, search_filters("Score", "desc"), 10, 0, fields=["date"]))
+    assert result.results
+    assert all(item.document.metadata.keys() == {"date"} for item in result.results)
@@ -0,0 +1,20 @@
+import json
+from chat.local_backends import HashEmbeddings, InMemorySearchClient
+from chat.local_vector_store import LocalVectorStore
+import api.search_in_vector_store
+from api.search_in_vector_store import search_in_vector_store
+
+def test_metadata_of_azure_ai_search_retriever(monkeypatch):
+    vector_store = LocalVectorStore(HashEmbeddings(dimensions=64))
+    vector_store.add_texts(["huur en waarborg"], [{"source": "coman-1", "date": "2024-01-01"}], ids=["1"])
+    monkeypatch.setattr(api.search_in_vector_store, "init_search_client", lambda index_name: InMemorySearchClient(vector_store))
+
+    document, = search_in_vector_store("huur", addVectors=False)
+    assert document.page_content == "huur en waarborg"
+    #Every field of the index except the content, the search score and the emptied vector, like AzureAISearchRetriever returned them
+    assert set(document.metadata) == {"id", "source", "date", "metadata", "@search.score", "content_vector"}
+    assert json.loads(document.metadata["metadata"]) == {"source": "coman-1", "date": "2024-01-01"}
+    assert document.metadata["content_vector"] == []
+
+    document, = search_in_vector_store("huur", addVectors=False, fields=["date"])
+    assert set(document.metadata) == {"date", "@search.score", "content_vector"}